@@ -0,0 +1,689 @@
+"""
+Lhat-Server 端到端基准测试（负载生成器）
+
+在临时目录里启动一个本地服务器，再用真实协议模拟N个客户端：
+注册(REGISTER) -> 登录(USER_NAME) -> 加入聊天室 -> 按设定速率发送TEXT_MESSAGE，
+最后统计吞吐量、投递延迟分位数(p50/p99/p999)、服务器CPU和内存占用，并把结果保存为JSON。
+
+用法：
+    python bench/lhat_bench.py login_storm --clients 200
+    python bench/lhat_bench.py large_room --clients 100 --rate 300 --duration 10
+    python bench/lhat_bench.py small_rooms --clients 100 --room-size 5
+    python bench/lhat_bench.py private --clients 100
+    python bench/lhat_bench.py slow_readers --clients 100 --slow-fraction 0.1
+    python bench/lhat_bench.py connect_storm --clients 10000
+    python bench/lhat_bench.py idle_memory --counts 10000,100000
+    python bench/lhat_bench.py compare bench/results/a.json bench/results/b.json
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import resource
+import selectors
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from server_operations import pack  # noqa: E402
+
+ROOT_USER = ('root', '25d55ad283aa400af464c76d713c07ad')  # 服务器初始化时创建的root账户
+SCENARIOS = ('login_storm', 'large_room', 'small_rooms', 'private', 'slow_readers', 'connect_storm', 'idle_memory')
+DECODER = json.JSONDecoder()
+
+# 启动服务器的引导代码，先改settings再导入服务器，这样类属性也能生效
+LAUNCHER = '''
+import sys
+sys.path.insert(0, {root!r})
+from defines import settings
+for option, value in {overrides!r}.items():
+    setattr(settings, option, value)
+from lhat_server import Server
+Server.ip = {ip!r}
+Server.port = {port!r}
+Server().run()
+'''
+
+
+def percentile(sorted_values: list, fraction: float):
+    """
+    计算分位数
+    :param sorted_values: 已排序的数值
+    :param fraction: 分位，例如0.99
+    :return: 分位数，没有数据时返回None
+    """
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def freePort(ip: str) -> int:
+    """
+    找一个空闲端口，避免上一次运行留下的TIME_WAIT导致绑定失败
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind((ip, 0))
+        return sock.getsockname()[1]
+
+
+def readCounters(metrics_address: tuple) -> dict:
+    """
+    从服务器的指标服务读取不带标签的计数器
+    :param metrics_address: 指标服务地址
+    :return: 指标名到数值的映射
+    """
+    with urllib.request.urlopen(f'http://{metrics_address[0]}:{metrics_address[1]}/metrics', timeout=5) as response:
+        text = response.read().decode()
+    counters = {}
+    for line in text.splitlines():
+        if line and not line.startswith('#') and '{' not in line:
+            name, value = line.rsplit(' ', 1)
+            counters[name] = float(value)
+    return counters
+
+
+def recordBytes(count: int = 10000) -> int:
+    """
+    在本进程中创建一批连接记录，用tracemalloc统计每条记录（含地址元组）占用的字节数
+    :param count: 创建的记录数
+    :return: 每条记录的平均字节数
+    """
+    import tracemalloc
+    from defines.User import User
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    records = [
+        User(None, (f'127.0.0.{index % 250}', 10000 + index), last_active=time.monotonic())
+        for index in range(count)
+    ]
+    used = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    del records
+    return used // count
+
+
+def gitCommit(root: str = ROOT_DIR) -> str:
+    """
+    获取当前的git提交，用于对比不同版本的结果
+    :param root: 仓库目录
+    """
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=root, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+class ServerProcess:
+    """
+    在临时工作目录中运行的服务器进程，数据库和日志都不会碰到仓库目录。
+    """
+
+    def __init__(self, ip: str, port: int, overrides: dict, root: str = ROOT_DIR):
+        """
+        初始化服务器进程
+        :param ip: 监听地址
+        :param port: 监听端口
+        :param overrides: 需要覆盖的settings选项
+        :param root: 服务器代码所在目录，可以指向另一个版本的检出，用于对比
+        """
+        self.address = (ip, port)
+        self.overrides = overrides
+        self.root = root
+        self.work_dir = tempfile.mkdtemp(prefix='lhat-bench-')
+        self.process = None
+
+    def start(self):
+        """
+        启动服务器，并等待端口可以连接
+        """
+        code = LAUNCHER.format(root=self.root, overrides=self.overrides, ip=self.address[0], port=self.address[1])
+        with open(os.path.join(self.work_dir, 'server_output.txt'), 'w') as output:
+            self.process = subprocess.Popen(
+                [sys.executable, '-c', code], cwd=self.work_dir, stdout=output, stderr=subprocess.STDOUT
+            )
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f'Server exited early, see {self.work_dir}/server_output.txt')
+            try:
+                socket.create_connection(self.address, timeout=0.2).close()
+                return
+            except OSError:
+                time.sleep(0.05)
+        raise RuntimeError('Server did not start listening in time.')
+
+    def alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def cpuSeconds(self):
+        """
+        读取服务器进程已使用的CPU时间（用户态+内核态），仅支持Linux
+        """
+        try:
+            with open(f'/proc/{self.process.pid}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+        except (OSError, ValueError, IndexError):
+            return None
+
+    def memory(self) -> dict:
+        """
+        读取服务器进程的内存占用（当前RSS和峰值RSS，单位字节），仅支持Linux
+        """
+        result = {'rss_bytes': None, 'peak_rss_bytes': None}
+        try:
+            with open(f'/proc/{self.process.pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        result['rss_bytes'] = int(line.split()[1]) * 1024
+                    elif line.startswith('VmHWM:'):
+                        result['peak_rss_bytes'] = int(line.split()[1]) * 1024
+        except (OSError, ValueError):
+            pass
+        return result
+
+    def stop(self):
+        if self.alive():
+            self.process.terminate()
+            try:
+                self.process.wait(5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+
+class BenchClient:
+    """
+    模拟客户端，说真实的Lhat协议。
+    """
+
+    def __init__(self, name: str, password: str, reading: bool = True):
+        """
+        初始化模拟客户端
+        :param name: 用户名
+        :param password: 密码（与官方客户端一致，发送的是md5值）
+        :param reading: 是否读取服务器发来的消息，慢读者场景下为False
+        """
+        self.name = name
+        self.password = password
+        self.reading = reading
+        self.sock = None
+        self.buffer = b''
+        self.rooms = set()
+        self.login_sent = 0.0
+        self.login_latency = None
+        self.room_manifests = 0
+
+    def connect(self, address: tuple):
+        self.sock = socket.create_connection(address, timeout=10)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
+
+    def sendFrame(self, message: str, to: str, message_type: str):
+        self.sock.sendall(pack(message, self.name, to, message_type))
+
+    def feed(self, data: bytes) -> list:
+        """
+        解析收到的数据。服务器转发的消息不一定带结束符，所以按JSON对象切分，结束符只用来切分非JSON的回复
+        :param data: 新收到的数据
+        :return: 完整的消息列表
+        """
+        self.buffer += data
+        text = self.buffer.decode('latin-1')  # 消息由json.dumps生成，都是ASCII，偏移量与字节一致
+        frames = []
+        position = 0
+        while True:
+            while position < len(text) and text[position] in '\0\r\n ':
+                position += 1
+            if position >= len(text):
+                break
+            try:
+                frame, position = DECODER.raw_decode(text, position)
+            except json.JSONDecodeError:
+                end = text.find('\0', position)
+                if end < 0:
+                    break  # 消息还没收完整
+                frame, position = text[position:end], end + 1
+            frames.append(frame)
+        self.buffer = self.buffer[position:]
+        return frames
+
+
+class LoadGenerator:
+    """
+    负载生成器，用一个选择器驱动所有模拟客户端。
+    """
+
+    def __init__(self, address: tuple, options):
+        """
+        初始化负载生成器
+        :param address: 服务器地址
+        :param options: 命令行参数
+        """
+        self.address = address
+        self.options = options
+        self.select = selectors.DefaultSelector()
+        self.latencies: list = []  # 投递延迟（秒）
+        self.delivered = 0  # 投递到客户端的基准消息数
+        self.undecodable = 0  # 无法解析的消息数
+        self.errors = 0  # 发送失败次数
+
+    def register(self, clients: list):
+        """
+        注册所有模拟客户端，每次注册使用一个单独的连接，服务器回复后会主动断开
+        """
+        for client in clients:
+            with socket.create_connection(self.address, timeout=10) as sock:
+                sock.sendall(pack(f'{client.name}\r\n{client.password}', client.name, '', 'REGISTER'))
+                sock.recv(64)
+
+    def connect(self, client: BenchClient):
+        client.connect(self.address)
+        if client.reading:
+            self.select.register(client.sock, selectors.EVENT_READ, data=client)
+
+    def pump(self, timeout: float):
+        """
+        处理一轮可读事件
+        :param timeout: 最长等待时间
+        """
+        for key, _ in self.select.select(timeout):
+            client: BenchClient = key.data
+            try:
+                data = client.sock.recv(65536)
+            except OSError:
+                data = b''
+            if not data:
+                self.select.unregister(client.sock)
+                continue
+            for frame in client.feed(data):
+                self.onFrame(client, frame)
+
+    def onFrame(self, client: BenchClient, frame):
+        """
+        处理一条收到的消息
+        """
+        if not isinstance(frame, dict):
+            if frame not in ('successful', 'failed'):
+                self.undecodable += 1
+            return
+        message_type = frame.get('type')
+        if message_type == 'TEXT_MESSAGE':
+            text = frame.get('message', '')
+            if isinstance(text, str) and text.startswith('bench '):
+                self.delivered += 1
+                self.latencies.append((time.perf_counter_ns() - int(text.split(' ')[1])) / 1e9)
+        elif message_type == 'USER_MANIFEST' and client.login_latency is None:
+            try:
+                if client.name in json.loads(frame['message']):
+                    client.login_latency = time.perf_counter() - client.login_sent
+            except (ValueError, TypeError):
+                self.undecodable += 1
+        elif message_type == 'ROOM_MANIFEST':
+            client.room_manifests += 1
+
+    def waitUntil(self, condition, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if condition():
+                return True
+            self.pump(0.01)
+        return condition()
+
+    def login(self, clients: list) -> dict:
+        """
+        所有客户端同时登录，登录延迟为发送USER_NAME到收到包含自己的USER_MANIFEST之间的时间
+        """
+        for client in clients:
+            self.connect(client)
+        start = time.perf_counter()
+        for client in clients:
+            client.login_sent = time.perf_counter()
+            client.sendFrame(f'{client.name}\r\n{client.password}', '', 'USER_NAME')
+        readers = [client for client in clients if client.reading]
+        self.waitUntil(lambda: all(client.login_latency is not None for client in readers), self.options.timeout)
+        elapsed = time.perf_counter() - start
+        latencies = sorted(client.login_latency for client in readers if client.login_latency is not None)
+        return {
+            'logins': len(latencies),
+            'logins_per_second': len(latencies) / elapsed if elapsed else None,
+            'login_p50': percentile(latencies, 0.5),
+            'login_p99': percentile(latencies, 0.99),
+            'login_p999': percentile(latencies, 0.999),
+        }
+
+    def createRooms(self, rooms: list):
+        """
+        用root账户创建聊天室，创建完成后root下线，避免它收到基准消息
+        """
+        admin = BenchClient(*ROOT_USER)
+        self.connect(admin)
+        admin.login_sent = time.perf_counter()
+        admin.sendFrame(f'{admin.name}\r\n{admin.password}', '', 'USER_NAME')
+        self.waitUntil(lambda: admin.login_latency is not None, self.options.timeout)
+        for room in rooms:
+            admin.sendFrame(f'room create {room}', '', 'COMMAND')
+            expected = admin.room_manifests + 1
+            self.waitUntil(lambda: admin.room_manifests >= expected, self.options.timeout)
+        self.select.unregister(admin.sock)
+        admin.sock.close()
+
+    def joinRooms(self, memberships: dict):
+        """
+        让客户端加入聊天室
+        :param memberships: 客户端到聊天室名的映射
+        """
+        for client, room in memberships.items():
+            client.sendFrame(f'room join {room}', '', 'COMMAND')
+            client.rooms.add(room)
+            if client.reading:
+                expected = client.room_manifests + 1
+                self.waitUntil(lambda: client.room_manifests >= expected, self.options.timeout)
+
+    def connectStorm(self, metrics_address: tuple) -> dict:
+        """
+        尽可能快地发起大量连接，通过服务器的指标统计每秒接收的连接数
+        :param metrics_address: 服务器指标服务地址
+        """
+        count = self.options.clients
+        before = readCounters(metrics_address)
+        sockets = []
+        start = time.perf_counter()
+        for _ in range(count):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            sock.connect_ex(self.address)
+            sockets.append(sock)
+        connect_elapsed = time.perf_counter() - start
+        accepted = rejected = 0
+        milestones = {0.5: None, 0.9: None, 0.99: None}  # 处理完一定比例的连接所用的时间
+        deadline = time.monotonic() + self.options.timeout
+        while time.monotonic() < deadline:
+            counters = readCounters(metrics_address)
+            accepted = counters['lhat_connections_accepted_total'] - before['lhat_connections_accepted_total']
+            rejected = counters['lhat_connections_rejected_total'] - before['lhat_connections_rejected_total']
+            for fraction in milestones:
+                if milestones[fraction] is None and accepted + rejected >= count * fraction:
+                    milestones[fraction] = time.perf_counter() - start
+            if accepted + rejected >= count:
+                break
+            time.sleep(0.01)
+        elapsed = time.perf_counter() - start
+        for sock in sockets:
+            sock.close()
+        return {
+            'connects': count,
+            'connect_calls_seconds': connect_elapsed,
+            'accepted': int(accepted),
+            'rejected': int(rejected),
+            'seconds_to_drain': elapsed,
+            'seconds_to_50_percent': milestones[0.5],
+            'seconds_to_90_percent': milestones[0.9],
+            'seconds_to_99_percent': milestones[0.99],
+            'accepts_per_second': (accepted + rejected) / elapsed,
+            'accepts_per_second_to_90_percent': count * 0.9 / milestones[0.9] if milestones[0.9] else None,
+        }
+
+    def idleMemory(self, server: ServerProcess, metrics_address: tuple) -> dict:
+        """
+        逐级建立大量空闲连接，用服务器RSS的增长计算每个空闲连接占用的内存
+        回环地址上会轮流绑定127.0.0.x作为源地址，避免单个源地址的临时端口不够用
+        :param server: 本地服务器进程
+        :param metrics_address: 服务器指标服务地址
+        """
+        counts = sorted(int(count) for count in self.options.counts.split(','))
+        fd_limit = resource.getrlimit(resource.RLIMIT_NOFILE)[1]
+        loopback = self.address[0].startswith('127.')
+        baseline = server.memory()['rss_bytes']
+        before = readCounters(metrics_address)['lhat_connections_accepted_total']
+        sockets = []
+        levels = {}
+        for count in counts:
+            if count + 64 > fd_limit:  # 服务器和本进程各自需要这么多文件描述符
+                levels[str(count)] = {'skipped': f'RLIMIT_NOFILE hard limit {fd_limit} is too low'}
+                continue
+            while len(sockets) < count:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                if loopback:
+                    sock.bind((f'127.0.{len(sockets) // 250 % 250}.{len(sockets) % 250 + 2}', 0))
+                sock.setblocking(False)
+                sock.connect_ex(self.address)
+                sockets.append(sock)
+            deadline = time.monotonic() + self.options.timeout
+            accepted = 0
+            while time.monotonic() < deadline:
+                accepted = readCounters(metrics_address)['lhat_connections_accepted_total'] - before
+                if accepted >= count:
+                    break
+                time.sleep(0.05)
+            time.sleep(1)  # 等待服务器处理完最后一批连接
+            rss = server.memory()['rss_bytes']
+            levels[str(count)] = {
+                'accepted': int(accepted),
+                'rss_bytes': rss,
+                'bytes_per_connection': (rss - baseline) / accepted if accepted else None,
+            }
+        for sock in sockets:
+            sock.close()
+        return {'baseline_rss_bytes': baseline, 'levels': levels, 'record_bytes': recordBytes()}
+
+    def drive(self, senders: list, pick_target, expected_per_message) -> dict:
+        """
+        按设定的总速率发送消息，然后等待投递完成
+        :param senders: 发送消息的客户端
+        :param pick_target: 为发送者选择聊天对象（聊天室名或用户名）的函数
+        :param expected_per_message: 计算一条消息应该投递给几个读取中的客户端的函数
+        """
+        rate = self.options.rate
+        duration = self.options.duration
+        sent = 0
+        expected = 0
+        start = time.perf_counter()
+        while True:
+            elapsed = time.perf_counter() - start
+            if elapsed >= duration:
+                break
+            due = int(elapsed * rate)
+            while sent < due:
+                client = senders[sent % len(senders)]
+                target = pick_target(client)
+                try:
+                    client.sendFrame(f'bench {time.perf_counter_ns()} {sent}', target, 'TEXT_MESSAGE')
+                    expected += expected_per_message(client, target)
+                except OSError:
+                    self.errors += 1
+                sent += 1
+            self.pump(0.001)
+        send_elapsed = time.perf_counter() - start
+        self.waitUntil(lambda: self.delivered >= expected, self.options.drain)
+        total_elapsed = time.perf_counter() - start
+        latencies = sorted(self.latencies)
+        return {
+            'sent': sent,
+            'send_rate': sent / send_elapsed,
+            'expected_deliveries': expected,
+            'delivered': self.delivered,
+            'delivery_ratio': self.delivered / expected if expected else None,
+            'deliveries_per_second': self.delivered / total_elapsed,
+            'latency_p50': percentile(latencies, 0.5),
+            'latency_p99': percentile(latencies, 0.99),
+            'latency_p999': percentile(latencies, 0.999),
+            'latency_max': latencies[-1] if latencies else None,
+            'undecodable_frames': self.undecodable,
+            'send_errors': self.errors,
+        }
+
+
+def runScenario(options) -> dict:
+    """
+    运行一个场景
+    :param options: 命令行参数
+    :return: 结果字典
+    """
+    server = None
+    soft_limit, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard_limit, hard_limit))  # 服务器进程也会继承这个上限
+    metrics_address = None
+    if options.metrics:
+        host, port = options.metrics.rsplit(':', 1)
+        metrics_address = (host, int(port))
+    if options.external:
+        host, port = options.external.rsplit(':', 1)
+        address = (host, int(port))
+    else:
+        address = (options.ip, options.port or freePort(options.ip))
+        metrics_address = metrics_address or (options.ip, freePort(options.ip))
+        server = ServerProcess(*address, {
+            'rate_limit': False,  # 否则基准测试测到的是限流器
+            'log': False,
+            'record': False,
+            'metrics': True,
+            'metrics_address': metrics_address[0],
+            'metrics_port': metrics_address[1],
+            'max_connections': options.clients + 16,
+            'max_connections_per_ip': options.clients + 16,
+        } if options.scenario != 'idle_memory' else {
+            'log': False,
+            'metrics': True,
+            'metrics_address': metrics_address[0],
+            'metrics_port': metrics_address[1],
+            'max_connections': 1 << 30,
+            'max_connections_per_ip': 1 << 30,
+            'max_pending_connections': 1 << 30,  # 空闲连接都不登录
+            'login_timeout': 0.0,
+        })
+        server.start()
+    generator = LoadGenerator(address, options)
+    prefix = f'b{random.randrange(36 ** 4):04x}'  # 每次运行使用不同的用户名，支持对同一个外部服务器重复测试
+    password = hashlib.md5(b'bench').hexdigest()
+    slow_count = int(options.clients * options.slow_fraction) if options.scenario == 'slow_readers' else 0
+    clients = [
+        BenchClient(f'{prefix}_{index}', password, reading=index >= slow_count)
+        for index in range(options.clients)
+    ]
+    result = {'scenario': options.scenario, 'commit': gitCommit(), 'timestamp': time.time(), 'params': {
+        key: value for key, value in vars(options).items() if key not in ('output',)
+    }}
+    try:
+        cpu_before = server.cpuSeconds() if server else None
+        wall_before = time.perf_counter()
+        if options.scenario == 'connect_storm':
+            if not metrics_address:
+                raise RuntimeError('connect_storm needs --metrics when using --external')
+            result['admission'] = generator.connectStorm(metrics_address)
+            clients = []
+        elif options.scenario == 'idle_memory':
+            if not server:
+                raise RuntimeError('idle_memory measures RSS of a local server, it cannot use --external')
+            result['memory'] = generator.idleMemory(server, metrics_address)
+            clients = []
+        else:
+            generator.register(clients)
+            cpu_before = server.cpuSeconds() if server else None
+            wall_before = time.perf_counter()
+            result['login'] = generator.login(clients)
+        readers = [client for client in clients if client.reading]
+        default_room = 'Lhat! Chatting Room'
+
+        if options.scenario in ('large_room', 'slow_readers'):
+            result['traffic'] = generator.drive(
+                readers, lambda client: default_room, lambda client, target: len(readers)
+            )
+        elif options.scenario == 'small_rooms':
+            room_count = max(1, options.clients // options.room_size)
+            rooms = [f'{prefix}_room_{index}' for index in range(room_count)]
+            generator.createRooms(rooms)
+            generator.joinRooms({client: rooms[index % room_count] for index, client in enumerate(clients)})
+            members = {room: sum(1 for client in readers if room in client.rooms) for room in rooms}
+            result['traffic'] = generator.drive(
+                readers,
+                lambda client: next(iter(client.rooms)),
+                lambda client, target: members[target],
+            )
+        elif options.scenario == 'private':
+            names = [client.name for client in readers]
+            result['traffic'] = generator.drive(
+                readers,
+                lambda client: random.choice([name for name in names if name != client.name] or names),
+                lambda client, target: 2,  # 发送者和接收者各收到一份
+            )
+
+        wall = time.perf_counter() - wall_before
+        if server:
+            cpu_after = server.cpuSeconds()
+            result['server'] = {
+                'alive': server.alive(),
+                'cpu_seconds': cpu_after - cpu_before if None not in (cpu_before, cpu_after) else None,
+                'cpu_percent': 100 * (cpu_after - cpu_before) / wall if None not in (cpu_before, cpu_after) else None,
+                **server.memory(),
+                'work_dir': server.work_dir,
+            }
+    finally:
+        if server:
+            server.stop()
+    return result
+
+
+def compareResults(old_path: str, new_path: str):
+    """
+    对比两次运行的结果，打印数值字段的变化
+    """
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print(f'{old.get("scenario")} {old.get("commit")} -> {new.get("commit")}')
+    for section in ('admission', 'login', 'traffic', 'server'):
+        for key, new_value in new.get(section, {}).items():
+            old_value = old.get(section, {}).get(key)
+            if isinstance(new_value, (int, float)) and isinstance(old_value, (int, float)) \
+                    and not isinstance(new_value, bool):
+                change = f'{(new_value - old_value) / old_value * 100:+.1f}%' if old_value else 'n/a'
+                print(f'  {section}.{key}: {old_value:.6g} -> {new_value:.6g} ({change})')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Lhat-Server end-to-end benchmark')
+    parser.add_argument('scenario', choices=SCENARIOS + ('compare',))
+    parser.add_argument('files', nargs='*', help='two result files, only for compare')
+    parser.add_argument('--clients', type=int, default=100, help='number of simulated clients')
+    parser.add_argument('--counts', default='10000,100000', help='connection counts measured by idle_memory')
+    parser.add_argument('--rate', type=float, default=200, help='total messages per second')
+    parser.add_argument('--duration', type=float, default=10, help='seconds of sending')
+    parser.add_argument('--room-size', type=int, default=5, help='members per room in small_rooms')
+    parser.add_argument('--slow-fraction', type=float, default=0.1, help='share of clients that never read')
+    parser.add_argument('--timeout', type=float, default=30, help='seconds to wait for setup steps')
+    parser.add_argument('--drain', type=float, default=5, help='seconds to wait for deliveries after sending')
+    parser.add_argument('--ip', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=0, help='0 picks a free port')
+    parser.add_argument('--external', help='host:port of an already running server, skips CPU/RSS')
+    parser.add_argument('--metrics', help='host:port of the metrics endpoint of an external server')
+    parser.add_argument('--output', default=os.path.join(ROOT_DIR, 'bench', 'results'))
+    options = parser.parse_args()
+
+    if options.scenario == 'compare':
+        if len(options.files) != 2:
+            parser.error('compare needs exactly two result files')
+        compareResults(*options.files)
+        return
+
+    result = runScenario(options)
+    os.makedirs(options.output, exist_ok=True)
+    path = os.path.join(
+        options.output, f'{options.scenario}-{time.strftime("%Y%m%d-%H%M%S")}-{result["commit"]}.json'
+    )
+    with open(path, 'w') as f:
+        json.dump(result, f, indent=2)
+    print(json.dumps(result, indent=2))
+    print(f'Saved to {path}')
+
+
+if __name__ == '__main__':
+    main()
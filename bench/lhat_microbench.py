@@ -0,0 +1,576 @@
+"""
+Lhat-Server 进程内微基准测试
+
+不监听端口、不使用sql/server.db：服务器使用内存数据库，客户端是只记录发送字节数的假socket，
+IO多路复用换成不会真正注册文件描述符的SelectSelector。直接调用processMessage、processNewLogin
+和closeConnection，分别测量群聊分发、私聊、登录、断开以及每个COMMAND子命令的耗时。
+批量用户操作在线程中执行，测量的是从发出命令到结果交回事件循环的总耗时；upgrade会让本进程退出，不测量。
+
+每个用例先预热，再跑若干轮，每轮调用若干次，统计每次调用的最小值、中位数、平均值和标准差，
+结果保存为JSON，可以用compare对比两次提交的结果。
+
+fanout用真实的本地TCP连接测量大聊天室群聊从分发到所有send()完成的耗时，
+分别在事件循环中直接写和使用并行写出线程，以及使用写出线程时事件循环本身被占用的时间（dispatch），
+每个成员占用两个文件描述符，超出上限的规模会跳过。
+
+recv用一对本地socket发送数据后调用serveClient，测量接收路径的耗时，并用tracemalloc统计接收和切分时的峰值临时内存
+（统计内存时processMessage换成空函数），包括单条消息、一次读到多条消息、一条消息分两次读到和大消息。
+
+用法：
+    python bench/lhat_microbench.py
+    python bench/lhat_microbench.py --filter fanout --rounds 50
+    python bench/lhat_microbench.py --list
+    python bench/lhat_microbench.py fanout --members 1000,10000,50000 --workers 3
+    python bench/lhat_microbench.py recv
+    python bench/lhat_microbench.py compare bench/results/micro-a.json bench/results/micro-b.json
+"""
+import argparse
+import contextlib
+import gc
+import hashlib
+import itertools
+import json
+import os
+import random
+import resource
+import selectors
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, 'bench'))
+
+from defines import settings  # noqa: E402
+from server_operations import pack  # noqa: E402
+from lhat_bench import gitCommit  # noqa: E402
+from defines.User import User  # noqa: E402
+from defines.FanoutPool import FanoutPool  # noqa: E402
+
+ROOT_USER = ('root', '25d55ad283aa400af464c76d713c07ad')
+PASSWORD = hashlib.md5(b'bench').hexdigest()
+ROOM = 'mb_room'
+FANOUT_SIZES = (10, 100, 1000)  # 群聊分发用例的聊天室人数
+
+
+class FakeSocket:
+    """
+    假的客户端socket，只统计发送的次数和字节数，不保存数据，长时间运行也不会占用内存
+    """
+    _fds = itertools.count(100000)  # 文件描述符只用于IO多路复用的字典键，不对应真实的文件
+
+    def __init__(self):
+        self._fd = next(self._fds)
+        self.send_calls = 0
+        self.bytes_sent = 0
+        self.closed = False
+
+    def fileno(self) -> int:
+        return -1 if self.closed else self._fd
+
+    def send(self, data) -> int:
+        self.send_calls += 1
+        self.bytes_sent += len(data)
+        return len(data)
+
+    def setblocking(self, flag):
+        pass
+
+    def setsockopt(self, *args):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class Harness:
+    """
+    进程内的服务器，以及登录到它上面的假客户端
+    """
+
+    def __init__(self, users: int):
+        """
+        创建服务器并登录一批用户
+        :param users: 登录的普通用户数，root另外登录
+        """
+        settings.log = False
+        settings.record = False
+        settings.rate_limit = False
+        settings.metrics = False
+        settings.mailbox = True
+        settings.snapshot_interval = 0
+        from lhat_server import Server
+        Server.database = ':memory:'
+        self.server = Server()
+        self.server.main_sock.close()
+        self.server.select = selectors.SelectSelector()  # 只维护字典，不会对假文件描述符做系统调用
+        self.server.loop_thread = threading.get_ident()  # 假装在事件循环线程里，发送时不唤醒
+        self.ports = itertools.count(20000)
+        self.root = self.login(*ROOT_USER)
+        self.users = []
+        for index in range(users):
+            self.createAccount(f'mb_{index}')
+            self.users.append(self.login(f'mb_{index}', PASSWORD))
+        self.server.createRoom(ROOM, 'root')
+        self.flush()
+
+    def createAccount(self, name: str, permission: str = 'User'):
+        """
+        直接在数据库中创建账户
+        """
+        self.server.sqlExecute(settings.append_user, (name, PASSWORD, permission, 0))
+        self.server.sql_connection.commit()
+        self.server.sql_exist_user.add(name)
+
+    def connect(self) -> FakeSocket:
+        """
+        建立一个未登录的假连接
+        """
+        sock = FakeSocket()
+        self.server.acceptConnection(sock, ('127.0.0.1', next(self.ports)))
+        return sock
+
+    def login(self, name: str, password: str) -> FakeSocket:
+        """
+        建立连接并同步完成登录，不启动登录线程
+        """
+        sock = self.connect()
+        self.server.select.get_key(sock).data.login_deadline = 0
+        self.server.processNewLogin(sock, self.server.select.get_key(sock).data.getAddress(), f'{name}\r\n{password}')
+        return sock
+
+    def close(self, sock: FakeSocket):
+        """
+        断开一个假连接
+        """
+        self.server.closeConnection(sock, self.server.select.get_key(sock).data.getAddress())
+
+    def flush(self):
+        """
+        和事件循环一样，先广播本轮的用户列表，再把发送队列写到假socket里
+        """
+        self.server.flushPresence()
+        self.server.flushWrites()
+
+    def message(self, sock: FakeSocket, text: str, to: str, message_type: str = 'TEXT_MESSAGE', message_id=None):
+        """
+        以某个连接的身份交给processMessage处理一条消息，和serveClient一样先去掉结束符
+        """
+        record = self.server.select.get_key(sock).data
+        frame = pack(text, record.getUserName(), to, message_type, message_id).strip(b'\0')
+        self.server.processMessage(frame, sock, record.getAddress())
+
+    def command(self, text: str, sock: FakeSocket = None):
+        """
+        以root（或指定连接）的身份执行一条命令
+        """
+        sock = sock or self.root
+        record = self.server.select.get_key(sock).data
+        self.message(sock, text, record.getUserName(), 'COMMAND')
+
+
+def buildCases(harness: Harness) -> dict:
+    """
+    所有用例，名称 -> (每次调用前执行的准备函数或None, 被测函数)
+    准备函数不计入耗时，用于恢复被测命令修改过的状态，保证每次调用做的是同一件事
+    """
+    server = harness.server
+    root_record = server.select.get_key(harness.root).data
+    for size in FANOUT_SIZES:
+        server.createRoom(f'{ROOM}_{size}', 'root')
+        for sock in harness.users[:size]:
+            record = server.select.get_key(sock).data
+            record.addRoom(f'{ROOM}_{size}')
+            server.presence.join(record.getUserName(), (f'{ROOM}_{size}',), record)
+    victim = {}
+
+    def ensureRoomAbsent(name):
+        if name in server.chatting_rooms:
+            server.deleteRoom(name)
+
+    def ensureRoom(name):
+        if name not in server.chatting_rooms:
+            server.createRoom(name, 'root')
+
+    def leaveRoom():
+        if root_record.inRoom(ROOM):
+            root_record.removeRoom(ROOM)
+
+    def joinRoom():
+        if not root_record.inRoom(ROOM):
+            root_record.addRoom(ROOM)
+
+    def deleteAccount(name):
+        server.sqlExecute(settings.delete_user, (name,))
+        if name in server.sql_exist_user:
+            server.sql_exist_user.discard(name)
+
+    def recreateAccount(name):
+        if name not in server.sql_exist_user:
+            harness.createAccount(name)
+
+    def loginVictim():
+        harness.flush()
+        recreateAccount('mb_victim')
+        server.sqlExecute('UPDATE USERS SET BAN = 0 WHERE USER_NAME = ?', ('mb_victim',))
+        if 'mb_victim' not in server.user_connections:
+            victim['sock'] = harness.login('mb_victim', PASSWORD)
+
+    def setPermission(name, permission):
+        server.user_connections[name].setPermission(permission)
+
+    def touchPresence(room):
+        # 一个不发送的成员退出再加入，使该聊天室在下一次广播时有变化
+        server.presence.leave('mb_ghost', (room,))
+        server.presence.join('mb_ghost', (room,), None)
+
+    def runLoopCalls():
+        # 批量操作在线程中执行，写完后把结果交给事件循环，这里代替事件循环执行，直到操作完成
+        while server.bulk_running:
+            if server.loop_calls:
+                func, args = server.loop_calls.popleft()
+                func(*args)
+            else:
+                time.sleep(0.0001)
+
+    def bulk(command):
+        harness.command(command)
+        runLoopCalls()
+
+    bulk_names = [f'mb_bulk_{index}' for index in range(100)]
+
+    def deleteBulkAccounts():
+        for name in bulk_names:
+            deleteAccount(name)
+
+    def restoreBulkAccounts():
+        for name in bulk_names:
+            recreateAccount(name)
+        server.sqlExecute('UPDATE USERS SET BAN = 0 WHERE USER_NAME LIKE ?', ('mb_bulk_%',))
+
+    def finishSnapshot():
+        if server.snapshot.worker is not None:
+            server.snapshot.worker.join()
+            server.snapshot.poll()
+
+    server.snapshot.path = 'mb.snapshot'  # 当前目录是临时目录
+    recreateAccount('mb_login')
+    recreateAccount('mb_victim')
+    text = 'x' * 64
+    message_ids = (f'mb-{index}' for index in itertools.count())
+    cases = {
+        'fanout_default_room': (None, lambda: harness.message(harness.root, text, settings.default_room)),
+        'room_message_new_id': (None, lambda: harness.message(harness.root, text, ROOM, message_id=next(message_ids))),
+        'room_message_duplicate': (None, lambda: harness.message(harness.root, text, ROOM, message_id='mb-resent')),
+        'private_online': (None, lambda: harness.message(harness.root, text, 'mb_1')),
+        'private_offline_mailbox': (
+            lambda: server.mailbox.clear('mb_login'), lambda: harness.message(harness.root, text, 'mb_login')
+        ),
+        'login_and_close': (None, lambda: harness.close(harness.login('mb_login', PASSWORD))),
+        'flush_writes': (lambda: harness.message(harness.root, text, settings.default_room), harness.flush),
+        'presence_default_room': (lambda: touchPresence(settings.default_room), server.flushPresence),
+        'presence_room_100': (lambda: touchPresence(f'{ROOM}_100'), server.flushPresence),
+        'room_create': (lambda: ensureRoomAbsent('mb_new'), lambda: harness.command('room create mb_new')),
+        'room_join': (leaveRoom, lambda: harness.command(f'room join {ROOM}')),
+        'room_list': (None, lambda: harness.command('room list')),
+        'room_info': (None, lambda: harness.command(f'room info {ROOM}')),
+        'room_leave': (joinRoom, lambda: harness.command(f'room leave {ROOM}')),
+        'room_delete': (lambda: ensureRoom('mb_del'), lambda: harness.command('room delete mb_del')),
+        'manager_add': (lambda: setPermission('mb_2', 'User'), lambda: harness.command('manager add mb_2')),
+        'manager_delete': (lambda: setPermission('mb_2', 'Manager'), lambda: harness.command('manager delete mb_2')),
+        'manager_list': (None, lambda: harness.command('manager list all')),
+        'kick': (loginVictim, lambda: harness.command('kick mb_victim')),
+        'update': (None, lambda: harness.command('update')),
+        'update_page': (None, lambda: harness.command('update page 100 prefix mb_1')),
+        'update_page_after': (None, lambda: harness.command('update page 100 after mb_5')),
+        'user_create': (lambda: deleteAccount('mb_created'), lambda: harness.command('user create mb_created User pw')),
+        'user_setpwd': (None, lambda: harness.command('user setpwd mb_3 pw')),
+        'user_setper': (None, lambda: harness.command('user setper mb_3 User')),
+        'user_delete': (lambda: recreateAccount('mb_deleted'), lambda: harness.command('user delete mb_deleted')),
+        'user_ban': (loginVictim, lambda: harness.command('user ban mb_victim')),
+        'user_restore': (None, lambda: harness.command('user restore mb_victim')),
+        'option_show': (None, lambda: harness.command('option show')),
+        'option_set': (None, lambda: harness.command('option set chatRate 5')),
+        'resetpwd': (None, lambda: harness.command('resetpwd 25d55ad283aa400af464c76d713c07ad')),
+        'profile_cpu_start_stop': (
+            None, lambda: (harness.command('profile cpu start 60'), harness.command('profile cpu stop'))
+        ),
+        'profile_mem_snapshot': (
+            None, lambda: (harness.command('profile mem start'), harness.command('profile mem snapshot'),
+                           harness.command('profile mem stop'))
+        ),
+        'stats_latency': (None, lambda: harness.command('stats latency')),
+        'stats_latency_reset': (None, lambda: harness.command('stats latency reset')),
+        'capture_start_stop': (None, lambda: (harness.command('capture start'), harness.command('capture stop'))),
+        'snapshot': (finishSnapshot, lambda: harness.command('snapshot')),  # 事件循环的耗时，不含写文件的线程
+        'user_bulkcreate_100': (
+            deleteBulkAccounts, lambda: bulk('user bulkcreate User ' + ' '.join(f'{name}:pw' for name in bulk_names))
+        ),
+        'user_bulkban_100': (restoreBulkAccounts, lambda: bulk('user bulkban ' + ' '.join(bulk_names))),
+        'user_bulksetper_100': (
+            restoreBulkAccounts, lambda: bulk('user bulksetper Manager ' + ' '.join(bulk_names))
+        ),
+    }
+    for size in FANOUT_SIZES:
+        if size <= len(harness.users):
+            cases[f'fanout_room_{size}'] = (None, lambda room=f'{ROOM}_{size}': harness.message(harness.root, text, room))
+    # upgrade会启动新进程并让本进程退出，不适合反复调用，不在这里测量
+    return cases
+
+
+def attachMembers(harness: Harness, count: int) -> list:
+    """
+    用真实的本地TCP连接直接加入一批已登录的成员，不经过登录流程，避免每次登录都广播用户列表
+    :param count: 成员数
+    :return: 客户端一侧的socket
+    """
+    server = harness.server
+    clients = []
+    with socket.create_server(('127.0.0.1', 0), backlog=1024) as listener:
+        for index in range(count):
+            client = socket.create_connection(listener.getsockname())
+            conn, address = listener.accept()
+            conn.setblocking(False)
+            client.setblocking(False)
+            record = User(conn, address, last_active=time.monotonic())
+            record.login('User', index, f'fan_{index}')
+            server.select.register(conn, selectors.EVENT_READ, data=record)
+            server.user_connections[record.getUserName()] = record
+            clients.append(client)
+    return clients
+
+
+def drainClients(clients: list):
+    """
+    读掉客户端收到的数据，避免发送缓冲区写满后测到的是积压队列
+    """
+    for client in clients:
+        try:
+            while client.recv(1 << 16):
+                pass
+        except BlockingIOError:
+            pass
+
+
+def fanoutCases(options):
+    """
+    大聊天室群聊用例，每个规模使用一个新的服务器，测完后关闭所有连接
+    :return: 生成器，每次给出(名称, Harness, 准备函数, 被测函数)
+    """
+    soft_limit, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard_limit, hard_limit))
+    text = 'x' * 64
+    for members in (int(count) for count in options.members.split(',')):
+        if members * 2 + 256 > hard_limit:
+            print(f'fanout_{members}: skipped, needs {members * 2 + 256} file descriptors, limit is {hard_limit}')
+            continue
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            harness = Harness(0)
+        clients = attachMembers(harness, members)
+        server = harness.server
+
+        def broadcast():
+            harness.message(harness.root, text, settings.default_room)
+            harness.flush()
+            server.waitFanout()  # 写出线程不阻塞事件循环，这里等它们写完，测的仍是所有send()完成的耗时
+
+        server.fanout_pool = None
+        yield f'fanout_{members}_inline', harness, lambda: drainClients(clients), broadcast
+        server.fanout_pool = FanoutPool(options.workers)
+        settings.fanout_threshold = 0  # 成员直接加入在线列表，不在presence中，按0人计
+        yield f'fanout_{members}_workers_{options.workers}', harness, lambda: drainClients(clients), broadcast
+
+        def dispatch():
+            harness.message(harness.root, text, settings.default_room)
+            harness.flush()
+
+        def settle():
+            server.waitFanout()
+            drainClients(clients)
+
+        # 只测事件循环被占用的时间：分发给写出线程后立即返回，上一次的写出在准备函数中等完
+        yield f'fanout_{members}_dispatch_{options.workers}', harness, settle, dispatch
+        for key in list(server.select.get_map().values()):
+            if isinstance(key.data, User) and key.fileobj is not harness.root:
+                key.fileobj.close()
+        for client in clients:
+            client.close()
+
+
+def recvCases(harness: Harness) -> dict:
+    """
+    接收路径用例，用一对本地socket直接加入一个已登录的成员，被测函数从客户端一侧发送数据，
+    像事件循环一样反复调用serveClient，直到服务器读完这些数据
+    :return: {名称: (准备函数, 被测函数)}
+    """
+    server = harness.server
+    conn, client = socket.socketpair()
+    conn.setblocking(False)
+    record = User(conn, ('127.0.0.1', next(harness.ports)), last_active=time.monotonic())
+    record.login('User', 0, 'recv_0')
+    server.select.register(conn, selectors.EVENT_READ, data=record)
+    server.user_connections[record.getUserName()] = record
+    key = server.select.get_key(conn)
+    heartbeat = pack('', 'recv_0', '', 'HEARTBEAT')
+    large = pack('x' * 4000, 'recv_0', '', 'HEARTBEAT')  # 心跳的内容会被忽略，只测接收和解码
+
+    def serve(*chunks):
+        def target():
+            for chunk in chunks:
+                client.sendall(chunk)
+                goal = server.metrics.bytes_in + len(chunk)
+                while server.metrics.bytes_in < goal:
+                    server.serveClient(key, selectors.EVENT_READ)
+        return target
+
+    return {
+        'recv_single': (None, serve(heartbeat)),
+        'recv_coalesced_8': (None, serve(heartbeat * 8)),
+        'recv_split': (None, serve(heartbeat[:20], heartbeat[20:])),
+        'recv_large_4k': (None, serve(large)),
+    }
+
+
+def measureAllocations(target, iterations: int, warmup: int) -> dict:
+    """
+    用tracemalloc统计被测函数每次调用的峰值临时内存，以及调用后残留的内存
+    :return: 每次调用的峰值字节数和残留字节数
+    """
+    tracemalloc.start()
+    try:
+        for _ in range(warmup):
+            target()
+        peaks = []
+        start = tracemalloc.get_traced_memory()[0]
+        for _ in range(iterations):
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            target()
+            peaks.append(tracemalloc.get_traced_memory()[1] - before)
+        retained = tracemalloc.get_traced_memory()[0] - start
+    finally:
+        tracemalloc.stop()
+    return {'peak_bytes': statistics.median(peaks), 'retained_bytes': retained / iterations}
+
+
+def runCase(harness: Harness, setup, target, rounds: int, iterations: int, warmup: int) -> dict:
+    """
+    运行一个用例
+    :return: 每次调用耗时（秒）的统计
+    """
+    timings = []
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):  # 丢掉服务器打印的日志
+        for index in range(warmup + rounds):
+            elapsed = 0
+            for _ in range(iterations):
+                if setup:
+                    setup()
+                start = time.perf_counter_ns()
+                target()
+                elapsed += time.perf_counter_ns() - start
+                harness.flush() if target is not harness.flush else None
+            if index >= warmup:
+                timings.append(elapsed / iterations / 1e9)
+    return {
+        'rounds': rounds,
+        'iterations': iterations,
+        'min': min(timings),
+        'median': statistics.median(timings),
+        'mean': statistics.fmean(timings),
+        'stddev': statistics.stdev(timings) if len(timings) > 1 else 0.0,
+        'ops_per_second': 1 / statistics.median(timings) if statistics.median(timings) else None,
+    }
+
+
+def compareResults(old_path: str, new_path: str):
+    """
+    对比两次运行的结果，打印每个用例中位数的变化
+    """
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print(f'{old.get("commit")} -> {new.get("commit")}')
+    for name, case in new['cases'].items():
+        if name in old['cases']:
+            before, after = old['cases'][name]['median'], case['median']
+            print(f'  {name:<28} {before * 1e6:10.1f}us -> {after * 1e6:10.1f}us ({(after - before) / before * 100:+.1f}%)')
+        else:
+            print(f'  {name:<28} {"new":>12} -> {case["median"] * 1e6:10.1f}us')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Lhat-Server in-process microbenchmarks')
+    parser.add_argument('action', nargs='?', default='run', choices=('run', 'fanout', 'recv', 'compare'))
+    parser.add_argument('files', nargs='*', help='two result files, only for compare')
+    parser.add_argument('--users', type=int, default=1000, help='logged in users')
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--iterations', type=int, default=20, help='calls per round')
+    parser.add_argument('--warmup', type=int, default=2, help='rounds not counted')
+    parser.add_argument('--filter', default='', help='only run cases whose name contains this')
+    parser.add_argument('--list', action='store_true', help='list the cases and exit')
+    parser.add_argument('--members', default='1000,10000,50000', help='room sizes measured by fanout')
+    parser.add_argument('--workers', type=int, default=max(settings.fanout_workers, 1), help='writer threads for fanout')
+    parser.add_argument('--disable-gc', action='store_true', help='disable the garbage collector while timing')
+    parser.add_argument('--output', default=os.path.join(ROOT_DIR, 'bench', 'results'))
+    options = parser.parse_args()
+
+    if options.action == 'compare':
+        if len(options.files) != 2:
+            parser.error('compare needs exactly two result files')
+        compareResults(*options.files)
+        return
+
+    random.seed(0)
+    os.chdir(tempfile.mkdtemp(prefix='lhat-micro-'))  # 服务器会创建logs等目录，不放在仓库里
+    if options.action == 'fanout':
+        cases = fanoutCases(options)
+    elif options.action == 'recv':
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            harness = Harness(0)
+            cases = [(name, harness, setup, target) for name, (setup, target) in recvCases(harness).items()]
+    else:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):  # 登录时服务器会打印日志
+            harness = Harness(options.users)
+            cases = [(name, harness, setup, target) for name, (setup, target) in buildCases(harness).items()]
+        if options.list:
+            print('\n'.join(case[0] for case in cases))
+            return
+    result = {'commit': gitCommit(), 'timestamp': time.time(), 'python': sys.version.split()[0],
+              'params': {key: value for key, value in vars(options).items() if key not in ('output', 'files')},
+              'cases': {}}
+    for name, harness, setup, target in cases:
+        if options.filter not in name:
+            continue
+        gc.collect()
+        if options.disable_gc:
+            gc.disable()
+        try:
+            stats = runCase(harness, setup, target, options.rounds, options.iterations, options.warmup)
+        finally:
+            gc.enable()
+        if options.action == 'recv':
+            harness.server.processMessage = lambda *args: None  # 只统计接收和切分的分配，不含解码和处理
+            try:
+                stats.update(measureAllocations(target, options.rounds * options.iterations, options.warmup))
+            finally:
+                del harness.server.processMessage
+        result['cases'][name] = stats
+        print(f'{name:<28} median {stats["median"] * 1e6:10.1f}us  min {stats["min"] * 1e6:10.1f}us  '
+              f'stddev {stats["stddev"] * 1e6:8.1f}us' +
+              (f'  peak {stats["peak_bytes"]:8.0f}B  retained {stats["retained_bytes"]:6.1f}B' if 'peak_bytes' in stats else ''))
+    os.makedirs(options.output, exist_ok=True)
+    prefix = options.action if options.action in ('fanout', 'recv') else 'micro'
+    path = os.path.join(options.output, f'{prefix}-{time.strftime("%Y%m%d-%H%M%S")}-{result["commit"]}.json')
+    with open(path, 'w') as f:
+        json.dump(result, f, indent=2)
+    print(f'Saved to {path}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,400 @@
+"""
+Lhat-Server 流量回放
+
+把服务器录制的流量（settings.capture或capture start命令生成的.lhcap文件）回放到本地服务器：
+每条录制的连接对应一个真实的TCP连接，客户端发来的原始数据按录制时的时间间隔原样发送，
+可以按N倍速或尽可能快地发送。录制中登录的用户会先在新服务器上注册，密码哈希与录制时相同。
+
+服务器原样转发的消息（群聊、私聊）用消息字节识别，统计从发送到每个接收者收到的投递延迟，
+再结合吞吐量、CPU和内存，对比两个版本的服务器在同一负载下的表现。
+
+用法：
+    python bench/lhat_replay.py info records/capture-20240101-120000.lhcap
+    python bench/lhat_replay.py run records/capture-20240101-120000.lhcap --speed 4
+    python bench/lhat_replay.py run capture.lhcap --speed 0 --servers /path/to/old/checkout,.
+    python bench/lhat_replay.py compare bench/results/replay-a.json bench/results/replay-b.json
+"""
+import argparse
+import json
+import os
+import resource
+import selectors
+import socket
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, 'bench'))
+
+from defines.Capture import Capture  # noqa: E402
+from server_operations import pack  # noqa: E402
+from lhat_bench import ServerProcess, freePort, gitCommit, percentile  # noqa: E402
+
+
+def splitFrames(data: bytes) -> list:
+    """
+    按结束符切分原始数据，去掉与服务器相同的填充字符，得到服务器转发时使用的消息字节
+    """
+    return [frame.strip(b'\x00\xcc') for frame in data.split(b'\0') if frame.strip(b'\x00\xcc')]
+
+
+def loadCapture(path: str) -> tuple:
+    """
+    读取录制文件
+    :param path: 录制文件路径
+    :return: (事件列表, 录制中登录的用户名 -> 密码哈希)
+    """
+    events = list(Capture.read(path))
+    accounts = {}
+    for _, _, event, payload in events:
+        if event != Capture.DATA or b'"USER_NAME"' not in payload:
+            continue
+        for frame in splitFrames(payload):
+            try:
+                message = json.loads(frame)
+            except ValueError:
+                continue
+            if isinstance(message, dict) and message.get('type') == 'USER_NAME' and '\r\n' in message.get('message', ''):
+                name, password = message['message'].split('\r\n', 1)
+                accounts[name] = password
+    return events, accounts
+
+
+def describeCapture(events: list) -> dict:
+    """
+    统计录制文件的概况
+    """
+    connections = {conn_id for _, conn_id, event, _ in events if event == Capture.OPEN}
+    data = [payload for _, _, event, payload in events if event == Capture.DATA]
+    return {
+        'duration': events[-1][0] / 1e9 if events else 0.0,
+        'connections': len(connections),
+        'chunks': len(data),
+        'frames': sum(len(splitFrames(payload)) for payload in data),
+        'bytes': sum(len(payload) for payload in data),
+    }
+
+
+class ReplayConnection:
+    """
+    回放中的一个连接
+    """
+
+    def __init__(self, conn_id: int, sock: socket.socket):
+        self.conn_id = conn_id
+        self.sock = sock
+        self.outbound = bytearray()  # 还没写出去的数据
+        self.inbound = b''  # 还没凑成完整消息的数据
+        self.closing = False  # 录制中已断开，写完剩下的数据后关闭
+        self.gated = False  # 发出登录类消息后等待服务器回复，之后的数据先暂存，否则倍速回放时会在登录完成前发出
+        self.held: list = []  # 等待回复期间暂存的数据
+
+
+class Replayer:
+    """
+    单线程的回放器，按时间顺序执行录制的事件，同时读取服务器发来的消息
+    """
+
+    def __init__(self, address: tuple, speed: float):
+        """
+        初始化回放器
+        :param address: 服务器地址
+        :param speed: 回放倍速，为0时不等待，尽可能快地发送
+        """
+        self.address = address
+        self.speed = speed
+        self.select = selectors.DefaultSelector()
+        self.connections: dict[int, ReplayConnection] = {}
+        self.sent_at: dict[bytes, float] = {}  # 发出的消息 -> 发送时间，用于计算投递延迟
+        self.latencies: list = []
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.frames_received = 0
+        self.bytes_received = 0
+        self.last_received_at = 0.0  # 最后一次收到消息的时间，吞吐量按此计算，不含等待投递的空闲时间
+        self.connect_errors = 0
+        self.send_errors = 0
+        self.max_lag = 0.0  # 落后于录制时间的最大秒数，偏大时说明回放器或服务器跟不上
+
+    def register(self, accounts: dict):
+        """
+        在服务器上注册录制中登录过的用户，已存在的用户（例如root）会注册失败，不影响登录
+        """
+        for name, password in accounts.items():
+            try:
+                with socket.create_connection(self.address, timeout=10) as sock:
+                    sock.sendall(pack(f'{name}\r\n{password}', name, '', 'REGISTER'))
+                    sock.recv(64)
+            except OSError:
+                self.connect_errors += 1
+
+    def open(self, conn_id: int):
+        try:
+            sock = socket.create_connection(self.address, timeout=10)
+        except OSError:
+            self.connect_errors += 1
+            return
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
+        connection = ReplayConnection(conn_id, sock)
+        self.connections[conn_id] = connection
+        self.select.register(sock, selectors.EVENT_READ, data=connection)
+
+    def write(self, conn_id: int, payload: bytes):
+        connection = self.connections.get(conn_id)
+        if connection is None:  # 连接失败，或已被服务器断开
+            self.send_errors += 1
+            return
+        self.enqueue(connection, payload)
+
+    def enqueue(self, connection: ReplayConnection, payload: bytes):
+        """
+        发送一段录制的数据，连接正在等待登录回复时先暂存
+        """
+        if connection.gated:
+            connection.held.append(payload)
+            return
+        if b'"USER_NAME"' in payload or b'"REGISTER"' in payload or b'"RESUME"' in payload:
+            connection.gated = True
+        now = time.perf_counter()
+        for frame in splitFrames(payload):
+            self.sent_at.setdefault(frame, now)
+            self.frames_sent += 1
+        self.bytes_sent += len(payload)
+        connection.outbound += payload
+        self.flush(connection)
+
+    def flush(self, connection: ReplayConnection):
+        """
+        尽量写出连接的待发送数据，写不完时关注可写事件
+        """
+        try:
+            sent = connection.sock.send(connection.outbound) if connection.outbound else 0
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self.send_errors += 1
+            self.drop(connection)
+            return
+        del connection.outbound[:sent]
+        if connection.outbound:
+            self.select.modify(connection.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, data=connection)
+        else:
+            self.select.modify(connection.sock, selectors.EVENT_READ, data=connection)
+            if connection.closing and not connection.gated:
+                self.drop(connection)
+
+    def close(self, conn_id: int):
+        connection = self.connections.get(conn_id)
+        if connection is not None:
+            connection.closing = True
+            self.flush(connection)
+
+    def drop(self, connection: ReplayConnection):
+        if self.connections.get(connection.conn_id) is connection:
+            del self.connections[connection.conn_id]
+            self.select.unregister(connection.sock)
+            connection.sock.close()
+
+    def pump(self, timeout: float):
+        """
+        处理一轮读写事件
+        :param timeout: 最长等待时间
+        """
+        for key, mask in self.select.select(max(timeout, 0)):
+            connection: ReplayConnection = key.data
+            if mask & selectors.EVENT_WRITE:
+                self.flush(connection)
+            if self.connections.get(connection.conn_id) is not connection:  # 本轮已经关闭
+                continue
+            if not mask & selectors.EVENT_READ:
+                continue
+            try:
+                data = connection.sock.recv(65536)
+            except BlockingIOError:
+                continue
+            except OSError:
+                data = b''
+            if not data:
+                self.drop(connection)
+                continue
+            now = time.perf_counter()
+            if connection.gated:  # 服务器已回复登录，放行暂存的数据
+                connection.gated = False
+                held, connection.held = connection.held, []
+                for payload in held:
+                    self.enqueue(connection, payload)
+                if connection.closing and not connection.held:
+                    self.flush(connection)
+                if self.connections.get(connection.conn_id) is not connection:
+                    continue
+            self.bytes_received += len(data)
+            self.last_received_at = now
+            frames = (connection.inbound + data).split(b'\0')
+            connection.inbound = frames.pop()
+            for frame in frames:
+                if not frame:
+                    continue
+                self.frames_received += 1
+                sent = self.sent_at.get(frame)
+                if sent is not None:
+                    self.latencies.append(now - sent)
+
+    def replay(self, events: list, drain: float) -> dict:
+        """
+        按录制的时间回放所有事件
+        :param events: 录制的事件
+        :param drain: 发送完后等待投递的秒数
+        :return: 统计结果
+        """
+        start = time.perf_counter()
+        handlers = {Capture.OPEN: lambda conn_id, payload: self.open(conn_id),
+                    Capture.DATA: self.write,
+                    Capture.CLOSE: lambda conn_id, payload: self.close(conn_id)}
+        for offset, conn_id, event, payload in events:
+            if self.speed > 0:
+                due = start + offset / 1e9 / self.speed
+                while time.perf_counter() < due:
+                    self.pump(due - time.perf_counter())
+                self.max_lag = max(self.max_lag, time.perf_counter() - due)
+            else:
+                self.pump(0)
+            handlers[event](conn_id, payload)
+        sending = time.perf_counter() - start
+        deadline = time.perf_counter() + drain
+        last_received = self.frames_received
+        quiet_since = time.perf_counter()
+        while time.perf_counter() < deadline and self.connections:
+            self.pump(0.05)
+            if self.frames_received != last_received:
+                last_received, quiet_since = self.frames_received, time.perf_counter()
+            elif time.perf_counter() - quiet_since > 0.5:  # 半秒内没有新消息，视为投递完毕
+                break
+        wall = time.perf_counter() - start
+        for connection in list(self.connections.values()):
+            self.drop(connection)
+        latencies = sorted(self.latencies)
+        active = self.last_received_at - start if self.last_received_at else 0.0
+        return {
+            'sending_seconds': sending,
+            'wall_seconds': wall,
+            'max_lag': self.max_lag,
+            'frames_sent': self.frames_sent,
+            'bytes_sent': self.bytes_sent,
+            'frames_received': self.frames_received,
+            'bytes_received': self.bytes_received,
+            'received_per_second': self.frames_received / active if active else None,
+            'deliveries': len(latencies),
+            'latency_p50': percentile(latencies, 0.5),
+            'latency_p99': percentile(latencies, 0.99),
+            'latency_p999': percentile(latencies, 0.999),
+            'latency_max': latencies[-1] if latencies else None,
+            'connect_errors': self.connect_errors,
+            'send_errors': self.send_errors,
+        }
+
+
+def replayAgainst(root: str, events: list, accounts: dict, options) -> dict:
+    """
+    启动指定目录的服务器并回放
+    :param root: 服务器代码所在目录
+    :return: 结果字典
+    """
+    address = (options.ip, freePort(options.ip))
+    overrides = {
+        'log': False,
+        'record': False,
+        'max_connections': 1 << 30,
+        'max_connections_per_ip': 1 << 30,
+        'max_pending_connections': 1 << 30,
+    }
+    if not options.rate_limit:
+        overrides['rate_limit'] = False  # 倍速回放时会触发限流，默认关闭
+    server = ServerProcess(*address, overrides, root=os.path.abspath(root))
+    server.start()
+    replayer = Replayer(address, options.speed)
+    try:
+        replayer.register(accounts)
+        cpu_before = server.cpuSeconds()
+        traffic = replayer.replay(events, options.drain)
+        cpu_after = server.cpuSeconds()
+        result = {
+            'commit': gitCommit(os.path.abspath(root)),
+            'root': os.path.abspath(root),
+            'traffic': traffic,
+            'server': {
+                'alive': server.alive(),
+                'cpu_seconds': cpu_after - cpu_before if None not in (cpu_before, cpu_after) else None,
+                **server.memory(),
+                'work_dir': server.work_dir,
+            },
+        }
+    finally:
+        server.stop()
+    return result
+
+
+def compareResults(old: dict, new: dict):
+    """
+    打印两次回放的吞吐量和延迟变化
+    """
+    print(f'{old.get("commit")} -> {new.get("commit")}')
+    for section in ('traffic', 'server'):
+        for key, new_value in new.get(section, {}).items():
+            old_value = old.get(section, {}).get(key)
+            if isinstance(new_value, (int, float)) and isinstance(old_value, (int, float)) \
+                    and not isinstance(new_value, bool):
+                change = f'{(new_value - old_value) / old_value * 100:+.1f}%' if old_value else 'n/a'
+                print(f'  {section}.{key}: {old_value:.6g} -> {new_value:.6g} ({change})')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Lhat-Server traffic replay')
+    parser.add_argument('action', choices=('info', 'run', 'compare'))
+    parser.add_argument('files', nargs='+', help='capture file, or two result files for compare')
+    parser.add_argument('--speed', type=float, default=1.0, help='replay speed, 0 sends as fast as possible')
+    parser.add_argument('--servers', default=ROOT_DIR, help='comma separated server checkouts to replay against')
+    parser.add_argument('--drain', type=float, default=5, help='seconds to wait for deliveries after sending')
+    parser.add_argument('--rate-limit', action='store_true', help='keep the flood control of the server')
+    parser.add_argument('--ip', default='127.0.0.1')
+    parser.add_argument('--output', default=os.path.join(ROOT_DIR, 'bench', 'results'))
+    options = parser.parse_args()
+
+    if options.action == 'compare':
+        if len(options.files) != 2:
+            parser.error('compare needs exactly two result files')
+        with open(options.files[0]) as f:
+            old = json.load(f)
+        with open(options.files[1]) as f:
+            new = json.load(f)
+        compareResults(old, new)
+        return
+
+    events, accounts = loadCapture(options.files[0])
+    summary = describeCapture(events)
+    if options.action == 'info':
+        print(json.dumps({**summary, 'accounts': len(accounts)}, indent=2))
+        return
+
+    soft_limit, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard_limit, hard_limit))  # 服务器进程也会继承这个上限
+    results = []
+    roots = options.servers.split(',')
+    for index, root in enumerate(roots):
+        result = {'capture': os.path.abspath(options.files[0]), 'capture_summary': summary,
+                  'timestamp': time.time(), 'params': {'speed': options.speed, 'rate_limit': options.rate_limit},
+                  **replayAgainst(root, events, accounts, options)}
+        os.makedirs(options.output, exist_ok=True)
+        path = os.path.join(options.output, f'replay-{time.strftime("%Y%m%d-%H%M%S")}-{result["commit"]}-{index}.json')
+        with open(path, 'w') as f:
+            json.dump(result, f, indent=2)
+        print(json.dumps(result, indent=2))
+        print(f'Saved to {path}')
+        results.append(result)
+    if len(results) == 2:
+        compareResults(*results)
+
+
+if __name__ == '__main__':
+    main()
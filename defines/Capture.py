@@ -0,0 +1,115 @@
+import os
+import struct
+import threading
+import time
+
+
+class Capture:
+    """
+    流量录制，把客户端发来的原始数据连同连接号和单调时钟时间戳写入二进制文件，
+    用bench/lhat_replay.py回放到本地服务器，对比不同版本在同一负载下的表现。
+    文件格式：8字节魔数，之后每条记录为定长头（相对开始时间的纳秒数、连接号、事件类型、数据长度）加数据。
+    """
+    MAGIC = b'LHATCAP1'
+    HEADER = struct.Struct('<QIBI')
+    OPEN, DATA, CLOSE = 0, 1, 2  # 事件类型：连接建立、收到数据、连接断开
+    flush_interval: float = 1.0  # 至少每隔多少秒把缓冲写入磁盘，服务器被杀掉时最多丢失这么久的数据
+
+    def __init__(self, output_dir: str, limit: int):
+        """
+        开始录制
+        :param output_dir: 录制文件所在目录
+        :param limit: 录制文件的字节数上限，达到后停止写入，为0时不限制
+        """
+        self.path = os.path.join(output_dir, f'capture-{time.strftime("%Y%m%d-%H%M%S", time.localtime())}.lhcap')
+        self.limit = limit
+        self.size: int = len(self.MAGIC)  # 已写入的字节数
+        self.full: bool = False  # 是否已达到上限
+        self._file = open(self.path, 'wb', buffering=1 << 16)
+        self._file.write(self.MAGIC)
+        self._lock = threading.Lock()  # 登录线程也可能关闭连接
+        self._start = time.monotonic_ns()
+        self._last_flush = time.monotonic()
+        self._ids: dict = {}  # socket -> 连接号
+        self._next_id: int = 0
+
+    def _write(self, sock, event: int, payload: bytes = b''):
+        with self._lock:
+            if self.full or self._file.closed:
+                return
+            conn_id = self._ids.get(sock)
+            if conn_id is None:  # 新连接，或开始录制前就建立的连接，补一条建立记录
+                self._next_id += 1
+                conn_id = self._ids[sock] = self._next_id
+                self._record(conn_id, self.OPEN, b'')
+            if event == self.CLOSE:
+                del self._ids[sock]
+            if event != self.OPEN:
+                self._record(conn_id, event, payload)
+            now = time.monotonic()
+            if now - self._last_flush >= self.flush_interval:
+                self._file.flush()
+                self._last_flush = now
+
+    def _record(self, conn_id: int, event: int, payload: bytes):
+        length = self.HEADER.size + len(payload)
+        if self.limit and self.size + length > self.limit:
+            self.full = True
+            self._file.flush()
+            return
+        self._file.write(self.HEADER.pack(time.monotonic_ns() - self._start, conn_id, event, len(payload)))
+        self._file.write(payload)
+        self.size += length
+
+    def open(self, sock):
+        """
+        记录连接建立
+        :param sock: 客户端连接
+        """
+        self._write(sock, self.OPEN)
+
+    def data(self, sock, payload: bytes):
+        """
+        记录收到的原始数据
+        :param sock: 客户端连接
+        :param payload: recv读到的数据，未做任何处理
+        """
+        self._write(sock, self.DATA, payload)
+
+    def close(self, sock):
+        """
+        记录连接断开
+        :param sock: 客户端连接
+        """
+        if sock in self._ids:  # 录制期间没有数据的旧连接不必记录
+            self._write(sock, self.CLOSE)
+
+    def stop(self) -> str:
+        """
+        停止录制
+        :return: 录制文件路径
+        """
+        with self._lock:
+            self._file.close()
+            self._ids.clear()
+        return self.path
+
+    @classmethod
+    def read(cls, path: str):
+        """
+        读取录制文件
+        :param path: 录制文件路径
+        :return: 生成器，每次给出(相对开始时间的纳秒数, 连接号, 事件类型, 数据)
+        """
+        with open(path, 'rb') as f:
+            if f.read(len(cls.MAGIC)) != cls.MAGIC:
+                raise ValueError(f'{path} is not a Lhat capture file.')
+            while True:
+                header = f.read(cls.HEADER.size)
+                if len(header) < cls.HEADER.size:  # 文件末尾，或录制时被中断留下的半条记录
+                    return
+                offset, conn_id, event, length = cls.HEADER.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length:
+                    return
+                yield offset, conn_id, event, payload
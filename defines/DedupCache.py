@@ -0,0 +1,59 @@
+import time
+from collections import OrderedDict
+
+
+class DedupCache:
+    """
+    消息去重缓存，记录最近见过的(发送者, 消息编号)。
+    客户端超时后不确定消息是否送达而重发时，带着同一个编号的消息在分发前就被丢弃，不会重复广播和记录。
+    按最近使用排序：命中时移到末尾并刷新时间，所以从头开始就是最久没见过的，
+    过期的条目每次加入时从头部顺带清理，条目数超过上限时淘汰最旧的，占用的内存有上限。
+    只在事件循环线程中使用，不加锁。
+    """
+
+    def __init__(self, capacity: int, window: float):
+        """
+        初始化去重缓存
+        :param capacity: 最多记录的条目数
+        :param window: 条目保留的秒数，超过后同一编号的消息视为新消息
+        """
+        self.capacity = capacity
+        self.window = window
+        self._entries: OrderedDict[str, float] = OrderedDict()  # 发送者\0消息编号 -> 最近一次见到的单调时间
+        self.hits = 0  # 被丢弃的重复消息数
+        self.misses = 0  # 第一次见到的消息数
+
+    def seen(self, key: str) -> bool:
+        """
+        检查消息是否已经见过，没见过时记录下来
+        :param key: 发送者和消息编号，用\\0连接（用户名中不会出现\\0）
+        :return: 窗口内已经见过时返回True
+        """
+        now = time.monotonic()
+        entries = self._entries
+        last = entries.get(key)
+        if last is not None and now - last < self.window:
+            entries[key] = now
+            entries.move_to_end(key)
+            self.hits += 1
+            return True
+        self.misses += 1
+        entries[key] = now
+        entries.move_to_end(key)
+        deadline = now - self.window
+        while entries:  # 头部是最久没见过的，过期的顺带清理
+            oldest, last = next(iter(entries.items()))
+            if last >= deadline and len(entries) <= self.capacity:
+                break
+            del entries[oldest]
+        return False
+
+    def discard(self, key: str):
+        """
+        忘记一条消息，用于消息没有送达的情况，客户端重发时重新处理
+        :param key: 发送者和消息编号
+        """
+        self._entries.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
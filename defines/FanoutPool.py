@@ -0,0 +1,75 @@
+import queue
+import threading
+
+
+class FanoutPool:
+    """
+    并行写出线程池，大聊天室群聊的一轮消息交给它写，事件循环分发完就返回，不等待写完。
+    连接按文件描述符固定分给各个线程，send()在系统调用期间会释放GIL，所以几个线程可以同时写。
+    每个连接在一轮里只由一个线程写一次；写的过程中事件循环为该连接产生的新消息先放进积压队列，
+    等这一份写完再接着写，同一连接上的消息顺序与单线程时相同。
+    线程只做非阻塞写，每写完一份就通过回调把结果交回事件循环，
+    写不完或写失败的连接由事件循环处理，积压队列、IO多路复用等状态都不在线程里修改。
+    """
+
+    def __init__(self, workers: int):
+        """
+        启动写出线程
+        :param workers: 线程数，每个线程负责一份连接
+        """
+        self.partitions = workers
+        self._tasks = [queue.SimpleQueue() for _ in range(workers)]
+        for index, tasks in enumerate(self._tasks):
+            threading.Thread(target=self._run, args=(tasks,), name=f"fanout-{index}", daemon=True).start()
+
+    def _run(self, tasks: queue.SimpleQueue):
+        while True:
+            batch, done = tasks.get()
+            unfinished, frame_count, byte_count = self._write(batch)
+            done(batch, unfinished, frame_count, byte_count)
+
+    @staticmethod
+    def _write(batch: list) -> tuple:
+        """
+        写出一份连接的消息
+        :param batch: (连接, 控制消息列表或None, 聊天消息列表或None)
+        :return: (没写完的连接列表, 写出的消息数, 写出的字节数)
+        """
+        unfinished = []
+        frame_count = 0
+        byte_count = 0
+        for sock, control, chat in batch:
+            frames = control + chat if control and chat else control or chat
+            data = frames[0] if len(frames) == 1 else b"".join(frames)
+            try:
+                sent = sock.send(data)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            except OSError:  # 连接已断开
+                sent = -1
+            frame_count += len(frames)
+            if sent > 0:
+                byte_count += sent
+            if sent != len(data):
+                unfinished.append((sock, control, frames, sent))
+        return unfinished, frame_count, byte_count
+
+    def dispatch(self, pending: dict, pending_chat: dict, done):
+        """
+        把本轮的消息分给写出线程后立即返回，调用前需要先把有积压或正在写的连接挑出去
+        :param pending: 连接 -> 控制消息列表
+        :param pending_chat: 连接 -> 聊天消息列表
+        :param done: 每写完一份在写出线程中调用，参数为(这一份的连接列表, 没写完或写失败的连接列表, 写出的消息数, 写出的字节数)，
+                     没写完的连接为(连接, 控制消息列表, 本次写入的所有消息, 写出的字节数)，写失败时字节数为-1
+        :return: 无返回值
+        """
+        batches = [[] for _ in range(self.partitions)]
+        partitions = self.partitions
+        for sock, chat in pending_chat.items():
+            batches[sock.fileno() % partitions].append((sock, pending.get(sock), chat))
+        for sock, control in pending.items():
+            if sock not in pending_chat:
+                batches[sock.fileno() % partitions].append((sock, control, None))
+        for tasks, batch in zip(self._tasks, batches):
+            if batch:
+                tasks.put((batch, done))
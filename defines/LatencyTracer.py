@@ -0,0 +1,186 @@
+import time
+
+# 追踪的阶段，按消息经过的顺序排列，每个阶段的耗时是从上一个已记录的阶段到本阶段的时间
+STAGES = ('frame', 'decode', 'dispatch', 'record', 'fanout_start', 'fanout_end', 'done', 'flush', 'total')
+
+
+class HdrHistogram:
+    """
+    对数-线性分桶的直方图，与HdrHistogram的思路相同：
+    每个2的幂区间再等分为若干子桶，相对误差固定，记录时只做一次位运算和字典自增。
+    只保存出现过的桶，空闲时几乎不占内存。
+    """
+    __slots__ = ('counts', 'count', 'total', 'min', 'max')
+    sub_bits: int = 4  # 每个2的幂区间分为2**sub_bits个子桶，相对误差不超过1/16
+
+    def __init__(self):
+        """
+        初始化直方图
+        """
+        self.counts: dict[int, int] = {}  # 桶编号 -> 次数
+        self.count = 0
+        self.total = 0
+        self.min = 0
+        self.max = 0
+
+    def _index(self, value: int) -> int:
+        shift = value.bit_length() - self.sub_bits - 1
+        if shift <= 0:  # 小数值每个值一个桶
+            return value
+        return (shift << self.sub_bits) + (value >> shift)
+
+    def _upperBound(self, index: int) -> int:
+        shift = (index >> self.sub_bits) - 1
+        if shift <= 0:
+            return index
+        return (((index & ((1 << self.sub_bits) - 1)) | (1 << self.sub_bits)) + 1 << shift) - 1
+
+    def observe(self, value: int):
+        """
+        记录一次观测值
+        :param value: 非负整数，例如纳秒数
+        """
+        index = self._index(value)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        if not self.count or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        self.count += 1
+        self.total += value
+
+    def percentile(self, fraction: float) -> int:
+        """
+        计算分位数
+        :param fraction: 分位，例如0.99
+        :return: 分位数所在桶的上界，不超过最大值
+        """
+        if not self.count:
+            return 0
+        rank = max(1, round(self.count * fraction))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(self._upperBound(index), self.max)
+        return self.max
+
+
+class Trace:
+    """
+    一条被采样的消息经过各阶段的时间戳
+    """
+    __slots__ = ('message_type', 'stamps')
+
+    def __init__(self, read_at: int):
+        """
+        开始追踪
+        :param read_at: 读到这条消息的时间，perf_counter_ns
+        """
+        self.message_type = None  # 解码后才知道，为None时说明消息没有被处理
+        self.stamps: list = [('read', read_at)]
+
+    def mark(self, stage: str):
+        """
+        记录到达某个阶段的时间
+        :param stage: 阶段名，见STAGES
+        """
+        self.stamps.append((stage, time.perf_counter_ns()))
+
+    def restart(self):
+        """
+        解码后发现消息要丢弃（例如重发的消息），只保留读取和切分的时间，改为追踪同一次读取的下一条消息
+        """
+        del self.stamps[2:]
+        self.message_type = None
+
+
+class LatencyTracer:
+    """
+    按消息采样的端到端延迟追踪，从recv读到数据开始，到本轮所有send()写出为止，
+    按消息类型和阶段分别记录直方图。未被采样的消息只多一次计数，可以在生产环境常开。
+    """
+
+    def __init__(self, sample_every: float):
+        """
+        初始化延迟追踪
+        :param sample_every: 每多少条消息采样一条，为0时不采样
+        """
+        self.sample_every = sample_every
+        self.histograms: dict[tuple, HdrHistogram] = {}  # (消息类型, 阶段) -> 直方图
+        self.traces: int = 0  # 已完成的追踪数
+        self.waiting: list[Trace] = []  # 已处理完、等待本轮写出的追踪
+        self._counter: int = 0
+
+    def begin(self, read_at: int):
+        """
+        一次读取中有消息通过了登录检查和流量控制、要交给processMessage时调用，按采样率决定是否追踪，
+        被丢弃的消息不计入采样
+        :param read_at: 读到数据的时间，perf_counter_ns
+        :return: 需要追踪时返回Trace，否则返回None
+        """
+        if self.sample_every <= 0:
+            return None
+        self._counter += 1
+        if self._counter < self.sample_every:
+            return None
+        self._counter = 0
+        return Trace(read_at)
+
+    def finish(self, trace: Trace):
+        """
+        消息处理完毕，等待本轮写出后再统计
+        :param trace: 追踪
+        """
+        trace.mark('done')
+        self.waiting.append(trace)
+
+    def flushed(self):
+        """
+        本轮的消息都已交给send()，统计等待中的追踪
+        """
+        now = time.perf_counter_ns()
+        for trace in self.waiting:
+            trace.stamps.append(('flush', now))
+            message_type = trace.message_type or 'UNDECODED'
+            previous = trace.stamps[0][1]
+            for stage, stamp in trace.stamps[1:]:
+                self._histogram(message_type, stage).observe(stamp - previous)
+                previous = stamp
+            self._histogram(message_type, 'total').observe(now - trace.stamps[0][1])
+        self.traces += len(self.waiting)
+        self.waiting.clear()
+
+    def _histogram(self, message_type: str, stage: str) -> HdrHistogram:
+        histogram = self.histograms.get((message_type, stage))
+        if histogram is None:
+            histogram = self.histograms[(message_type, stage)] = HdrHistogram()
+        return histogram
+
+    def reset(self):
+        """
+        清空所有直方图
+        """
+        self.histograms.clear()
+        self.traces = 0
+
+    def report(self) -> str:
+        """
+        生成文本报告，单位为微秒
+        :return: 报告
+        """
+        sampling = f"sampling 1/{self.sample_every:g}" if self.sample_every > 0 else "sampling off"
+        lines = [f"Latency per stage in microseconds, {sampling}, {self.traces} traces"]
+        for message_type in sorted({key[0] for key in self.histograms}):
+            lines.append(f"{message_type}")
+            lines.append(f"  {'stage':<13}{'count':>8}{'p50':>10}{'p90':>10}{'p99':>10}{'p99.9':>10}{'max':>10}")
+            for stage in STAGES:
+                histogram = self.histograms.get((message_type, stage))
+                if histogram is None:
+                    continue
+                lines.append(
+                    f"  {stage:<13}{histogram.count:>8}"
+                    + "".join(f"{histogram.percentile(fraction) / 1000:>10.1f}" for fraction in (0.5, 0.9, 0.99, 0.999))
+                    + f"{histogram.max / 1000:>10.1f}"
+                )
+        return "\n".join(lines)
@@ -0,0 +1,125 @@
+import threading
+import time
+
+
+class Mailbox:
+    """
+    离线信箱，发给不在线的注册用户的私聊消息按收件人追加写入数据库的MAILBOX表，
+    用户登录时分页取出并一次性发送，发送后删除。
+    每个收件人的消息数有上限，超过保存期限的消息不再投递。
+    """
+
+    def __init__(self, execute, commit, quota: int, expire: float):
+        """
+        初始化离线信箱
+        :param execute: 执行SQL语句的函数，参数为语句和参数，返回游标
+        :param commit: 提交事务的函数
+        :param quota: 每个收件人最多保存的消息数
+        :param expire: 消息保存的秒数，为0时永久保存
+        """
+        self._execute = execute
+        self._commit = commit
+        self.quota = quota
+        self.expire = expire
+        self._lock = threading.Lock()  # 事件循环存入消息，登录线程取出消息
+        self._counts: dict[str, int] = {}  # 收件人 -> 信箱中的消息数，避免每次存入都COUNT一次
+        self.purge()
+        for recipient, count in self._execute(
+                'SELECT RECIPIENT, COUNT(*) FROM MAILBOX GROUP BY RECIPIENT'
+        ):
+            self._counts[recipient] = count
+
+    def _cutoff(self) -> float:
+        return time.time() - self.expire if self.expire > 0 else 0.0
+
+    def count(self, recipient: str) -> int:
+        """
+        获取收件人信箱中的消息数
+        :param recipient: 收件人
+        :return: 消息数
+        """
+        return self._counts.get(recipient, 0)
+
+    def store(self, recipient: str, frame: bytes) -> bool:
+        """
+        存入一条消息
+        :param recipient: 收件人
+        :param frame: 已打包、带结束符的消息
+        :return: 存入成功返回True，信箱已满返回False
+        """
+        with self._lock:
+            if self._counts.get(recipient, 0) >= self.quota:
+                self._purgeRecipient(recipient)  # 先清掉过期的消息再判断
+                if self._counts.get(recipient, 0) >= self.quota:
+                    return False
+            self._execute(
+                'INSERT INTO MAILBOX (RECIPIENT, SENT_TIME, MESSAGE) VALUES (?, ?, ?)',
+                (recipient, time.time(), frame),
+            )
+            self._commit()
+            self._counts[recipient] = self._counts.get(recipient, 0) + 1
+        return True
+
+    def fetch(self, recipient: str, page_size: int):
+        """
+        按存入顺序分页取出收件人的所有未过期消息，每取完一页就删除这一页
+        :param recipient: 收件人
+        :param page_size: 每页的消息数
+        :return: 生成器，每次给出一页消息拼接成的字节串和这一页的消息数
+        """
+        if not self._counts.get(recipient):
+            return
+        last_id = 0
+        while True:
+            rows = self._execute(
+                'SELECT ID, MESSAGE FROM MAILBOX WHERE RECIPIENT = ? AND ID > ? AND SENT_TIME >= ? '
+                'ORDER BY ID LIMIT ?',
+                (recipient, last_id, self._cutoff(), page_size),
+            ).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            yield b''.join(row[1] for row in rows), len(rows)
+            if len(rows) < page_size:
+                break
+        with self._lock:
+            # 只删除已经取出的消息，取出期间新存入的消息留到下次登录
+            deleted = self._execute(
+                'DELETE FROM MAILBOX WHERE RECIPIENT = ? AND ID <= ?', (recipient, last_id)
+            ).rowcount
+            self._commit()
+            self._setCount(recipient, self._counts.get(recipient, 0) - deleted)
+
+    def clear(self, recipient: str):
+        """
+        清空收件人的信箱，用于删除用户
+        :param recipient: 收件人
+        """
+        with self._lock:
+            self._execute('DELETE FROM MAILBOX WHERE RECIPIENT = ?', (recipient,))
+            self._commit()
+            self._counts.pop(recipient, None)
+
+    def purge(self):
+        """
+        删除所有过期的消息
+        """
+        if self.expire <= 0:
+            return
+        self._execute('DELETE FROM MAILBOX WHERE SENT_TIME < ?', (self._cutoff(),))
+        self._commit()
+
+    def _purgeRecipient(self, recipient: str):
+        if self.expire <= 0:
+            return
+        deleted = self._execute(
+            'DELETE FROM MAILBOX WHERE RECIPIENT = ? AND SENT_TIME < ?', (recipient, self._cutoff())
+        ).rowcount
+        self._commit()
+        self._setCount(recipient, self._counts.get(recipient, 0) - deleted)
+
+    def _setCount(self, recipient: str, count: int):
+        if count > 0:
+            self._counts[recipient] = count
+        else:
+            self._counts.pop(recipient, None)
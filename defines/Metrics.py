@@ -0,0 +1,247 @@
+import bisect
+import heapq
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 延迟直方图的默认分桶（秒）
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def escapeLabel(value: str) -> str:
+    """
+    转义标签值，文本格式要求反斜杠、双引号和换行必须转义
+    :param value: 标签值
+    :return: 转义后的标签值
+    """
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Histogram:
+    """
+    直方图，分桶在创建时固定，记录时只做整数自增，不产生新对象。
+    """
+    __slots__ = ('bounds', 'counts', 'total', 'count')
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        """
+        初始化直方图
+        :param bounds: 各个分桶的上界，升序排列
+        """
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # 最后一个桶是+Inf
+        self.total = 0.0  # 所有观测值之和
+        self.count = 0  # 观测次数
+
+    def observe(self, value: float):
+        """
+        记录一次观测值
+        :param value: 观测值
+        """
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def render(self, name: str, help_text: str) -> list:
+        """
+        按文本格式输出直方图
+        :param name: 指标名
+        :param help_text: 指标说明
+        :return: 文本行列表
+        """
+        lines = [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+        cumulative = 0
+        for bound, bucket_count in zip(self.bounds, self.counts):
+            cumulative += bucket_count
+            lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f'{name}_sum {self.total}')
+        lines.append(f'{name}_count {self.count}')
+        return lines
+
+
+class Metrics:
+    """
+    服务器运行指标，计数器都是普通的整数属性，开销足够低，可以在生产环境常开。
+    除按类型统计的发出消息数外，计数器都只在事件循环线程中修改。
+    """
+
+    def __init__(self, top_rooms: int = 20):
+        """
+        初始化所有计数器和直方图
+        :param top_rooms: 按聊天室输出成员数时只输出成员最多的几个，聊天室再多指标的行数也不变
+        """
+        self.top_rooms = top_rooms
+        self._out_lock = threading.Lock()  # 登录线程、批量操作线程等也会发送消息
+        self.messages_in: dict[str, int] = {}  # 按消息类型统计的收到消息数
+        self.messages_out: dict[str, int] = {}  # 按消息类型统计的发出消息数
+        self.bytes_in: int = 0  # 收到的字节数
+        self.bytes_out: int = 0  # 实际写出的字节数，按send()的返回值统计
+        self.send_calls: int = 0  # 发送的系统调用次数
+        self.frames_sent: int = 0  # 经由这些系统调用发出的消息数
+        self.connections_accepted: int = 0  # 接受的连接数
+        self.connections_rejected: int = 0  # 因超出连接数上限被拒绝的连接数
+        self.fanout_seconds = Histogram()  # 群聊消息分发耗时
+        self.login_seconds = Histogram()  # 登录处理耗时
+        self.sql_seconds = Histogram()  # SQLite查询耗时
+        self.control_wait_seconds = Histogram()  # 控制消息从放入发送队列到开始写出的时间
+        self.chat_wait_seconds = Histogram()  # 聊天消息从放入发送队列到开始写出的时间
+
+    def countIn(self, message_type: str):
+        """
+        记录收到一条消息
+        :param message_type: 消息类型
+        """
+        self.messages_in[message_type] = self.messages_in.get(message_type, 0) + 1
+
+    def countOut(self, message_type: str):
+        """
+        记录发出一条消息，可以在任何线程中调用
+        :param message_type: 消息类型
+        """
+        with self._out_lock:
+            self.messages_out[message_type] = self.messages_out.get(message_type, 0) + 1
+
+    def render(self, server) -> str:
+        """
+        生成文本格式的指标，仅在被抓取时调用，因此可以在这里统计聊天室人数等较贵的量
+        :param server: 服务器对象
+        :return: 文本格式的指标
+        """
+        lines = [
+            '# HELP lhat_connected_sockets Client connections currently open.',
+            '# TYPE lhat_connected_sockets gauge',
+            f'lhat_connected_sockets {server.connection_count}',
+            '# HELP lhat_authenticated_users Users that finished logging in.',
+            '# TYPE lhat_authenticated_users gauge',
+            f'lhat_authenticated_users {len(server.user_connections)}',
+        ]
+        # 抓取在另一个线程中进行，事件循环可能同时增删聊天室，先复制一份再统计
+        rooms = list(server.chatting_rooms)
+        members = [(server.presence.count(room), room) for room in rooms]
+        lines += [
+            '# HELP lhat_rooms Chatting rooms that exist.',
+            '# TYPE lhat_rooms gauge',
+            f'lhat_rooms {len(rooms)}',
+            '# HELP lhat_room_members_total Members of all chatting rooms, including detached sessions.',
+            '# TYPE lhat_room_members_total gauge',
+            f'lhat_room_members_total {sum(member_count for member_count, _ in members)}',
+            f'# HELP lhat_room_members Members of the {self.top_rooms} largest chatting rooms.',
+            '# TYPE lhat_room_members gauge',
+        ]
+        for member_count, room in heapq.nlargest(self.top_rooms, members):
+            lines.append(f'lhat_room_members{{room="{escapeLabel(room)}"}} {member_count}')
+        # 积压只存在于发送缓冲区已满的连接上，抓取在另一个线程中进行，先复制一份再统计
+        blocked = list(server.blocked_writes.values())
+        lines += [
+            '# HELP lhat_blocked_connections Connections with data waiting for the socket to become writable.',
+            '# TYPE lhat_blocked_connections gauge',
+            f'lhat_blocked_connections {len(blocked)}',
+            '# HELP lhat_outbound_queued_bytes Bytes waiting in outbound queues of blocked connections.',
+            '# TYPE lhat_outbound_queued_bytes gauge',
+            f'lhat_outbound_queued_bytes {sum(queue.size for queue in blocked)}',
+            '# HELP lhat_messages_in_total Messages received, by type.',
+            '# TYPE lhat_messages_in_total counter',
+        ]
+        for message_type, message_count in list(self.messages_in.items()):
+            lines.append(f'lhat_messages_in_total{{type="{escapeLabel(str(message_type))}"}} {message_count}')
+        lines += [
+            '# HELP lhat_messages_out_total Messages sent, by type.',
+            '# TYPE lhat_messages_out_total counter',
+        ]
+        with self._out_lock:
+            messages_out = list(self.messages_out.items())
+        for message_type, message_count in messages_out:
+            lines.append(f'lhat_messages_out_total{{type="{escapeLabel(message_type)}"}} {message_count}')
+        dedup_lookups = server.dedup.hits + server.dedup.misses
+        lines += [
+            '# HELP lhat_bytes_in_total Bytes received from clients.',
+            '# TYPE lhat_bytes_in_total counter',
+            f'lhat_bytes_in_total {self.bytes_in}',
+            '# HELP lhat_bytes_out_total Bytes sent to clients.',
+            '# TYPE lhat_bytes_out_total counter',
+            f'lhat_bytes_out_total {self.bytes_out}',
+            '# HELP lhat_send_calls_total send() system calls made for client sockets.',
+            '# TYPE lhat_send_calls_total counter',
+            f'lhat_send_calls_total {self.send_calls}',
+            '# HELP lhat_frames_sent_total Frames written by those send() calls.',
+            '# TYPE lhat_frames_sent_total counter',
+            f'lhat_frames_sent_total {self.frames_sent}',
+            '# HELP lhat_frames_per_send Average frames coalesced into one send() call.',
+            '# TYPE lhat_frames_per_send gauge',
+            f'lhat_frames_per_send {self.frames_sent / self.send_calls if self.send_calls else 0}',
+            '# HELP lhat_connections_accepted_total Connections accepted.',
+            '# TYPE lhat_connections_accepted_total counter',
+            f'lhat_connections_accepted_total {self.connections_accepted}',
+            '# HELP lhat_connections_rejected_total Connections rejected by admission control.',
+            '# TYPE lhat_connections_rejected_total counter',
+            f'lhat_connections_rejected_total {self.connections_rejected}',
+            '# HELP lhat_dedup_hits_total Resent messages dropped by the dedup cache.',
+            '# TYPE lhat_dedup_hits_total counter',
+            f'lhat_dedup_hits_total {server.dedup.hits}',
+            '# HELP lhat_dedup_misses_total Messages with an id seen for the first time.',
+            '# TYPE lhat_dedup_misses_total counter',
+            f'lhat_dedup_misses_total {server.dedup.misses}',
+            '# HELP lhat_dedup_hit_ratio Share of messages with an id that were duplicates.',
+            '# TYPE lhat_dedup_hit_ratio gauge',
+            f'lhat_dedup_hit_ratio {server.dedup.hits / dedup_lookups if dedup_lookups else 0}',
+            '# HELP lhat_dedup_entries Message ids held by the dedup cache.',
+            '# TYPE lhat_dedup_entries gauge',
+            f'lhat_dedup_entries {len(server.dedup)}',
+        ]
+        lines += self.fanout_seconds.render('lhat_fanout_seconds', 'Time spent broadcasting a room message.')
+        lines += self.login_seconds.render('lhat_login_seconds', 'Time spent processing a successful login.')
+        lines += self.sql_seconds.render('lhat_sql_query_seconds', 'Time spent executing SQLite queries.')
+        lines += self.control_wait_seconds.render(
+            'lhat_control_queue_seconds', 'Time control frames wait in the outbound queue before being written.'
+        )
+        lines += self.chat_wait_seconds.render(
+            'lhat_chat_queue_seconds', 'Time chat frames wait in the outbound queue before being written.'
+        )
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsServer:
+    """
+    指标HTTP服务，在后台线程中监听本地端口，GET /metrics 返回文本格式的指标。
+    """
+
+    def __init__(self, server, address: str, port: int):
+        """
+        初始化指标HTTP服务
+        :param server: 服务器对象
+        :param address: 监听地址
+        :param port: 监听端口
+        """
+        lhat_server = server
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = lhat_server.metrics.render(lhat_server).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # 抓取请求很频繁，不写入日志
+
+        self._httpd = ThreadingHTTPServer((address, port), MetricsHandler)
+        self._httpd.daemon_threads = True
+
+    def start(self):
+        """
+        在后台线程中启动指标HTTP服务
+        """
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+
+    def stop(self):
+        """
+        停止指标HTTP服务并释放端口，平滑升级时由新进程重新监听
+        """
+        self._httpd.shutdown()
+        self._httpd.server_close()
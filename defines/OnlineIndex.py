@@ -0,0 +1,66 @@
+import bisect
+import threading
+
+
+class OnlineIndex:
+    """
+    按用户名排序的在线用户索引，登录和下线时维护，
+    分页查询用二分查找定位起点，耗时为O(log n + 页大小)，不必每次复制整个在线列表。
+    断线后保留会话的用户仍然算在线，会话丢弃时才从索引中移除。
+    """
+    _END = '\U0010ffff'  # 比任何以前缀开头的用户名都大，用于确定前缀范围的上界
+
+    def __init__(self):
+        """
+        初始化索引
+        """
+        self._names: list[str] = []  # 已排序的用户名
+        self._lock = threading.Lock()  # 登录线程也会修改索引
+
+    def add(self, name: str):
+        """
+        加入一个在线用户，已存在时不重复加入
+        :param name: 用户名
+        """
+        with self._lock:
+            index = bisect.bisect_left(self._names, name)
+            if index == len(self._names) or self._names[index] != name:
+                self._names.insert(index, name)
+
+    def discard(self, name: str):
+        """
+        移除一个在线用户，不存在时忽略
+        :param name: 用户名
+        """
+        with self._lock:
+            index = bisect.bisect_left(self._names, name)
+            if index < len(self._names) and self._names[index] == name:
+                del self._names[index]
+
+    def names(self) -> list:
+        """
+        获取全部在线用户
+        :return: 按用户名排序的列表副本
+        """
+        with self._lock:
+            return self._names[:]
+
+    def page(self, limit: int, prefix: str = '', after: str = '') -> tuple:
+        """
+        分页查询在线用户
+        :param limit: 每页最多返回的用户数
+        :param prefix: 用户名前缀，为空时不过滤
+        :param after: 上一页最后一个用户名，从它之后开始，为空时从头开始
+        :return: (本页用户名列表, 下一页的起点，没有下一页时为None, 匹配前缀的用户总数)
+        """
+        with self._lock:
+            names = self._names
+            low = bisect.bisect_left(names, prefix)
+            high = bisect.bisect_left(names, prefix + self._END, low) if prefix else len(names)
+            start = max(low, bisect.bisect_right(names, after, low, high)) if after else low
+            end = min(start + limit, high)
+            page = names[start:end]
+        return page, page[-1] if end < high and page else None, high - low
+
+    def __len__(self) -> int:
+        return len(self._names)
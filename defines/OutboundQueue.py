@@ -0,0 +1,71 @@
+from collections import deque
+
+
+class OutboundQueue:
+    """
+    一个连接因发送缓冲区已满而积压的数据，分为控制消息和聊天消息两个优先级。
+    已经开始写的数据必须先写完，之后每次取一批消息时控制消息（踢出通知、用户列表、命令回复等）优先，
+    但聊天消息等待期间连续插队的控制消息数有上限，聊天消息不会被一直压着。
+    """
+    __slots__ = ('head', 'control', 'chat', 'size', '_skipped')
+
+    def __init__(self, head: bytes = b''):
+        """
+        初始化积压队列
+        :param head: 已经开始写、必须先写完的数据
+        """
+        self.head = bytearray(head)  # 正在写的一批数据
+        self.control: deque = deque()  # (消息, 入队时间)
+        self.chat: deque = deque()  # (消息, 入队时间)
+        self.size: int = len(head)  # 积压的总字节数
+        self._skipped: int = 0  # 聊天消息等待期间已经连续写出的控制消息数
+
+    def push(self, frames: list, since: float, chat: bool):
+        """
+        追加消息
+        :param frames: 已打包的消息
+        :param since: 入队时间
+        :param chat: 是否为聊天消息
+        """
+        queue = self.chat if chat else self.control
+        for frame in frames:
+            queue.append((frame, since))
+            self.size += len(frame)
+
+    def fill(self, limit: int, control_burst: int) -> list:
+        """
+        上一批写完后，按优先级取出下一批消息放入head
+        :param limit: 一批最多取出的字节数，至少取出一条
+        :param control_burst: 聊天消息等待时最多连续取出的控制消息数
+        :return: 取出的消息的(入队时间, 是否为聊天消息)，用于统计排队时间
+        """
+        frames, taken = [], []
+        length = 0
+        while length < limit and (self.control or self.chat):
+            if self.control and (not self.chat or self._skipped < control_burst):
+                frame, since = self.control.popleft()
+                self._skipped = self._skipped + 1 if self.chat else 0
+                taken.append((since, False))
+            else:
+                frame, since = self.chat.popleft()
+                self._skipped = 0
+                taken.append((since, True))
+            frames.append(frame)
+            length += len(frame)
+        self.head += b''.join(frames)
+        return taken
+
+    def written(self, sent: int):
+        """
+        从head中去掉已经写出的数据
+        :param sent: 写出的字节数
+        """
+        del self.head[:sent]
+        self.size -= sent
+
+    def __bytes__(self) -> bytes:
+        """
+        按写出顺序拼接所有积压的数据，用于关闭连接前尽量发出和平滑升级时交接
+        """
+        return bytes(self.head) + b''.join(frame for frame, _ in self.control) + \
+            b''.join(frame for frame, _ in self.chat)
@@ -0,0 +1,109 @@
+import cProfile
+import io
+import os
+import pstats
+import time
+import tracemalloc
+
+
+class Profiler:
+    """
+    运行时性能分析，由管理员命令控制。
+    未开启时不挂任何钩子，事件循环只多一次属性判断。
+    """
+    top_count: int = 30  # 报告中列出的条目数
+    trace_frames: int = 10  # tracemalloc 记录的调用栈深度
+
+    def __init__(self, output_dir: str = 'logs'):
+        """
+        初始化性能分析器
+        :param output_dir: 报告输出目录
+        """
+        self.output_dir = output_dir
+        self.active: bool = False  # 是否有正在进行的CPU采样，事件循环据此决定是否调用tick
+        self.requester = None  # 发起CPU采样的用户名
+        self._profile = None
+        self._deadline: float = 0.0
+        self._baseline = None  # 上一次内存快照，用于对比
+
+    def _reportPath(self, kind: str) -> str:
+        return os.path.join(self.output_dir, f'{kind}-{time.strftime("%Y%m%d-%H%M%S", time.localtime())}.txt')
+
+    def startCpu(self, seconds: float, requester: str):
+        """
+        开始对事件循环进行cProfile采样
+        :param seconds: 采样时长，到期后由tick自动停止
+        :param requester: 发起采样的用户名
+        """
+        self._profile = cProfile.Profile()
+        self._deadline = time.monotonic() + seconds
+        self.requester = requester
+        self.active = True
+        self._profile.enable()
+
+    def stopCpu(self) -> str:
+        """
+        停止cProfile采样，把最热的函数写入报告
+        :return: 报告路径
+        """
+        self._profile.disable()
+        self.active = False
+        path = self._reportPath('profile')
+        stream = io.StringIO()
+        stats = pstats.Stats(self._profile, stream=stream)
+        stats.sort_stats('tottime').print_stats(self.top_count)
+        stats.sort_stats('cumulative').print_stats(self.top_count)
+        with open(path, 'w') as f:
+            f.write(stream.getvalue())
+        stats.dump_stats(path[:-4] + '.prof')  # 原始数据，可以用snakeviz等工具查看
+        self._profile = None
+        return path
+
+    def tick(self):
+        """
+        检查CPU采样是否到期，仅在active为True时由事件循环调用
+        :return: 到期时返回报告路径，否则返回None
+        """
+        if time.monotonic() >= self._deadline:
+            return self.stopCpu()
+        return None
+
+    @staticmethod
+    def memoryTracing() -> bool:
+        return tracemalloc.is_tracing()
+
+    def startMemory(self):
+        """
+        开始追踪内存分配，并记录一个基准快照
+        """
+        tracemalloc.start(self.trace_frames)
+        self._baseline = tracemalloc.take_snapshot()
+
+    def snapshotMemory(self) -> str:
+        """
+        拍一张内存快照，与上一张对比，把增长最多的分配位置写入报告
+        :return: 报告路径
+        """
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+        ))
+        current, peak = tracemalloc.get_traced_memory()
+        path = self._reportPath('tracemalloc')
+        with open(path, 'w') as f:
+            f.write(f'Traced memory: current {current} bytes, peak {peak} bytes\n\n')
+            f.write(f'Top {self.top_count} allocation sites:\n')
+            for stat in snapshot.statistics('lineno')[:self.top_count]:
+                f.write(f'{stat}\n')
+            if self._baseline is not None:
+                f.write(f'\nTop {self.top_count} differences since last snapshot:\n')
+                for stat in snapshot.compare_to(self._baseline, 'lineno')[:self.top_count]:
+                    f.write(f'{stat}\n')
+        self._baseline = snapshot
+        return path
+
+    def stopMemory(self):
+        """
+        停止追踪内存分配，释放追踪数据
+        """
+        tracemalloc.stop()
+        self._baseline = None
@@ -0,0 +1,112 @@
+import time
+
+
+class TokenBucket:
+    """
+    令牌桶，按固定速率补充令牌，每次请求消耗一个令牌。
+    """
+    __slots__ = ('tokens', 'updated', 'warned')
+
+    def __init__(self, burst: float, now: float):
+        """
+        初始化令牌桶，新桶是满的
+        :param burst: 桶容量
+        :param now: 当前单调时间
+        """
+        self.tokens = burst  # 剩余令牌数
+        self.updated = now  # 上次补充令牌的时间
+        self.warned = False  # 本轮超限是否已经提醒过客户端
+
+
+class RateLimiter:
+    """
+    限流器，为每个键维护一个令牌桶。
+    用户名和IP使用各自的限流器，速率分开设置，键也不会互相冲突（例如名为"10.0.0.1"的用户）。
+    """
+    max_keys: int = 4096  # 桶数量超过该值时，清理已经补满的桶
+
+    def __init__(self, rate: float, burst: float):
+        """
+        初始化限流器
+        :param rate: 每秒补充的令牌数
+        :param burst: 突发上限，即桶容量
+        """
+        self.rate = rate
+        self.burst = burst
+        self._buckets: dict[object, TokenBucket] = {}
+
+    def _refill(self, key, now: float) -> TokenBucket:
+        """
+        获取某个键的令牌桶，并按经过的时间补充令牌
+        :param key: 限流的键
+        :param now: 当前单调时间
+        :return: 令牌桶
+        """
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self.max_keys:
+                self.prune(now)
+            bucket = self._buckets[key] = TokenBucket(self.burst, now)
+        else:
+            bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+            bucket.updated = now
+        return bucket
+
+    def available(self, key) -> bool:
+        """
+        检查某个键是否还有令牌，不消耗，用于同时检查多个限流器时先确认都能通过
+        :param key: 限流的键
+        :return: 有令牌时返回True
+        """
+        return self._refill(key, time.monotonic()).tokens >= 1
+
+    def take(self, key):
+        """
+        为某个键消耗一个令牌，调用前应已用available确认有令牌
+        :param key: 限流的键
+        """
+        bucket = self._refill(key, time.monotonic())
+        bucket.tokens -= 1
+        bucket.warned = False
+
+    def allow(self, key) -> bool:
+        """
+        尝试为某个键消耗一个令牌
+        :param key: 限流的键，通常是用户名或IP
+        :return: 允许通过时返回True，超限时返回False
+        """
+        bucket = self._refill(key, time.monotonic())
+        if bucket.tokens >= 1:
+            bucket.tokens -= 1
+            bucket.warned = False
+            return True
+        return False
+
+    def shouldWarn(self, key) -> bool:
+        """
+        判断本轮超限是否需要提醒客户端，每轮超限只提醒一次，避免提醒本身被用来刷屏
+        :param key: 限流的键
+        :return: 需要提醒时返回True
+        """
+        bucket = self._buckets.get(key)
+        if bucket is None or bucket.warned:
+            return False
+        bucket.warned = True
+        return True
+
+    def forget(self, key):
+        """
+        移除某个键的令牌桶，通常在连接断开时调用
+        :param key: 限流的键
+        """
+        self._buckets.pop(key, None)
+
+    def prune(self, now: float):
+        """
+        清理已经补满的令牌桶，它们和新建的桶没有区别
+        :param now: 当前单调时间
+        """
+        for key in list(self._buckets):
+            bucket = self._buckets[key]
+            if bucket.tokens + (now - bucket.updated) * self.rate >= self.burst:
+                del self._buckets[key]
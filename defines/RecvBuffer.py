@@ -0,0 +1,71 @@
+class RecvBuffer:
+    """
+    事件循环共用的接收缓冲区。
+    所有连接都在事件循环线程中读取，一个连接读到的数据处理完才会读下一个连接，所以一块预先分配的bytearray就够了：
+    recv_into直接写入这块内存，按结束符切分时用find查找，只在得到一条完整的消息时复制一次交给解码。
+    没读完的半条消息才为该连接单独保存，下次读取前拷回缓冲区开头，空闲连接不占用缓冲区。
+    每个连接的读取大小随流量调整：读满时加倍，只用到四分之一时减半，不超过上下限。
+    """
+
+    def __init__(self, min_read: int, max_read: int, max_frame: int):
+        """
+        初始化接收缓冲区
+        :param min_read: 最小读取大小，新连接从这里开始
+        :param max_read: 最大读取大小
+        :param max_frame: 单条消息的最大字节数，超出时视为协议错误
+        """
+        self.min_read = min_read
+        self.max_read = max_read
+        self.max_frame = max_frame
+        self.buffer = bytearray(max_frame + max_read)
+        self.view = memoryview(self.buffer)
+        self.partial: dict = {}  # 连接 -> 没读完的半条消息
+        self.end = 0  # 上次读取后缓冲区中有效数据的长度，本次读到的数据在它前面
+
+    def read(self, sock, record) -> tuple:
+        """
+        从连接读取一次，接在该连接没读完的半条消息后面，切分出完整的消息，去掉首尾的填充字节，剩下的半条消息为该连接保存；
+        并根据读到的字节数调整该连接下次的读取大小
+        :param sock: 客户端连接
+        :param record: 连接记录，读取大小保存在它的read_size中
+        :return: (本次读到的字节数, 消息列表)，读到0字节说明对端已关闭，暂时没有数据可读时字节数为None，
+                 半条消息超过上限时消息列表为None
+        """
+        buffer = self.buffer
+        view = self.view
+        start = 0
+        if self.partial:
+            partial = self.partial.pop(sock, None)
+            if partial:
+                start = len(partial)
+                buffer[:start] = partial
+        read_size = record.read_size
+        try:
+            received = sock.recv_into(view[start:start + read_size])
+        except (BlockingIOError, InterruptedError):  # 可读事件是误报或被信号打断，半条消息放回去，下次接着读
+            if start:
+                self.partial[sock] = partial
+            return None, []
+        end = self.end = start + received
+        if received >= read_size:  # 读满了，下次多读一些
+            record.read_size = min(read_size << 1, self.max_read)
+        elif received <= read_size >> 2 and read_size > self.min_read:  # 只用到四分之一，下次少读一些
+            record.read_size = max(read_size >> 1, self.min_read)
+        frames = []
+        start = 0
+        while start < end:
+            stop = buffer.find(0, start, end)
+            if stop < 0:
+                if end - start > self.max_frame:
+                    return received, None
+                self.partial[sock] = view[start:end].tobytes()
+                break
+            left, right = start, stop
+            while left < right and buffer[left] == 0xcc:
+                left += 1
+            while right > left and buffer[right - 1] == 0xcc:
+                right -= 1
+            if right > left:  # 连续的结束符之间是空消息
+                frames.append(view[left:right].tobytes())
+            start = stop + 1
+        return received, frames
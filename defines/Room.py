@@ -0,0 +1,52 @@
+import json
+
+
+class Room:
+    """
+    聊天室信息，对应数据库ROOMS表的一行。
+    启动时只读取聊天室名称，信息在第一次用到时才从数据库读取并创建本对象。
+    """
+    __slots__ = ('_name', '_owner', '_created_time', '_settings')
+
+    def __init__(self, name: str, owner: str, created_time: float, settings: str = '{}'):
+        """
+        初始化聊天室信息
+        :param name: 聊天室名称
+        :param owner: 创建者的用户名
+        :param created_time: 创建时间戳
+        :param settings: 聊天室设置，JSON字符串
+        """
+        self._name = name
+        self._owner = owner
+        self._created_time = created_time
+        self._settings: dict = json.loads(settings or '{}')
+
+    def getName(self) -> str:
+        """
+        获取聊天室名称
+        """
+        return self._name
+
+    def getOwner(self) -> str:
+        """
+        获取聊天室创建者
+        """
+        return self._owner
+
+    def getCreatedTime(self) -> float:
+        """
+        获取聊天室创建时间戳
+        """
+        return self._created_time
+
+    def getSettings(self) -> dict:
+        """
+        获取聊天室设置
+        """
+        return self._settings
+
+    def dumpSettings(self) -> str:
+        """
+        把聊天室设置转换为JSON字符串，用于写入数据库
+        """
+        return json.dumps(self._settings, ensure_ascii=False)
@@ -0,0 +1,62 @@
+from collections import OrderedDict, deque
+
+
+class RoomHistory:
+    """
+    聊天室最近消息的环形缓冲区，保存已打包、带结束符的消息，
+    用户加入聊天室或登录时一次性回放，不需要读取磁盘上的聊天记录。
+    每个聊天室最多保存固定条数，所有聊天室合计不超过内存上限，
+    超出上限时先丢弃最久没有新消息的聊天室里最旧的消息。
+    """
+
+    def __init__(self, per_room: int, max_bytes: int):
+        """
+        初始化历史缓冲区
+        :param per_room: 每个聊天室保存的消息条数，为0时不保存
+        :param max_bytes: 所有聊天室合计保存的字节数上限
+        """
+        self.per_room = per_room
+        self.max_bytes = max_bytes
+        self.total_bytes: int = 0  # 当前保存的字节数
+        self._rooms: OrderedDict[str, deque] = OrderedDict()  # 按最后一条消息的时间排序，最久没有消息的在前
+
+    def append(self, room: str, frame: bytes):
+        """
+        记录一条聊天室消息
+        :param room: 聊天室名称
+        :param frame: 已打包、带结束符的消息
+        """
+        if self.per_room <= 0 or len(frame) > self.max_bytes:
+            return
+        frames = self._rooms.get(room)
+        if frames is None:
+            frames = self._rooms[room] = deque()
+        else:
+            self._rooms.move_to_end(room)
+        if len(frames) >= self.per_room:  # 环形缓冲区已满，覆盖最旧的一条
+            self.total_bytes -= len(frames.popleft())
+        frames.append(frame)
+        self.total_bytes += len(frame)
+        while self.total_bytes > self.max_bytes:
+            oldest_room, oldest_frames = next(iter(self._rooms.items()))
+            self.total_bytes -= len(oldest_frames.popleft())
+            if not oldest_frames:
+                del self._rooms[oldest_room]
+
+    def replay(self, room: str) -> bytes:
+        """
+        取出聊天室的最近消息，拼接为一次写入的数据
+        :param room: 聊天室名称
+        :return: 拼接后的消息，没有消息时为空字节串
+        """
+        frames = self._rooms.get(room)
+        return b''.join(frames) if frames else b''
+
+    def drop(self, room: str):
+        """
+        丢弃聊天室的所有消息，用于删除聊天室
+        :param room: 聊天室名称
+        """
+        frames = self._rooms.pop(room, None)
+        if frames:
+            self.total_bytes -= sum(len(frame) for frame in frames)
@@ -0,0 +1,99 @@
+import threading
+
+
+class RoomPresence:
+    """
+    按聊天室维护的在线成员，成员变化时只把该聊天室标记为待广播，
+    事件循环每轮只为有变化的聊天室打包一次成员列表，发给该聊天室的在线成员，
+    同一轮里多次登录、下线只广播一次，用户列表的流量从O(总人数²)降为各聊天室人数平方之和。
+    断线后保留会话的用户仍然算作成员，但不向其发送。
+    """
+
+    def __init__(self):
+        """
+        初始化在线成员表
+        """
+        self._members: dict[str, dict] = {}  # 聊天室 -> {用户名: 连接记录，断线保留会话时为None}
+        self._dirty: set[str] = set()  # 成员有变化、等待广播的聊天室
+        self._lock = threading.Lock()  # 登录线程也会修改成员表
+
+    def join(self, name: str, rooms, record, announce: bool = True):
+        """
+        用户加入聊天室，或断线恢复后重新关联连接记录
+        :param name: 用户名
+        :param rooms: 聊天室名称列表
+        :param record: 连接记录
+        :param announce: 成员有变化时是否广播，平滑升级接管连接时不需要
+        """
+        with self._lock:
+            for room in rooms:
+                members = self._members.setdefault(room, {})
+                if name not in members and announce:
+                    self._dirty.add(room)
+                members[name] = record
+
+    def leave(self, name: str, rooms):
+        """
+        用户退出聊天室或下线
+        :param name: 用户名
+        :param rooms: 聊天室名称列表
+        """
+        with self._lock:
+            for room in rooms:
+                members = self._members.get(room)
+                if members is not None and members.pop(name, False) is not False:
+                    self._dirty.add(room)
+
+    def detach(self, name: str, rooms):
+        """
+        用户意外断线、会话仍保留，仍然算作成员，但不再向其发送
+        :param name: 用户名
+        :param rooms: 聊天室名称列表
+        """
+        with self._lock:
+            for room in rooms:
+                members = self._members.get(room)
+                if members is not None and name in members:
+                    members[name] = None
+
+    def drop(self, room: str):
+        """
+        聊天室被删除
+        :param room: 聊天室名称
+        """
+        with self._lock:
+            self._members.pop(room, None)
+            self._dirty.discard(room)
+
+    def count(self, room: str) -> int:
+        """
+        获取聊天室的成员数
+        :param room: 聊天室名称
+        :return: 成员数，包括断线保留会话的用户
+        """
+        return len(self._members.get(room, ()))
+
+    def members(self, room: str) -> list:
+        """
+        获取聊天室的成员
+        :param room: 聊天室名称
+        :return: 用户名列表
+        """
+        with self._lock:
+            return list(self._members.get(room, ()))
+
+    def takeDirty(self) -> list:
+        """
+        取出所有待广播的聊天室
+        :return: [(聊天室名称, 用户名列表, 在线成员的连接记录列表)]
+        """
+        with self._lock:
+            if not self._dirty:
+                return []
+            dirty, self._dirty = self._dirty, set()
+            result = []
+            for room in dirty:
+                members = self._members.get(room)
+                if members:
+                    result.append((room, list(members), [record for record in members.values() if record is not None]))
+            return result
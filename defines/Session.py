@@ -0,0 +1,32 @@
+from collections import deque
+
+
+class Session:
+    """
+    断线后保留的会话，客户端在有效期内用恢复令牌重新连接时，
+    直接恢复用户名、权限、所在聊天室和断线期间错过的消息，不需要查询数据库。
+    会话保留期间用户仍然显示为在线，不会因为短暂断线广播用户列表。
+    """
+    __slots__ = ('token', 'name', 'permission', 'id_num', 'rooms', 'missed', 'registered', 'deadline')
+
+    def __init__(self, token: str, name: str, permission: str, id_num: int, rooms: list, missed_limit: int,
+                 registered: bool = False, deadline: float = 0.0):
+        """
+        初始化会话
+        :param token: 恢复令牌
+        :param name: 用户名
+        :param permission: 权限
+        :param id_num: id号
+        :param rooms: 所在的聊天室
+        :param missed_limit: 最多保存的错过的消息数，超出后丢弃最旧的
+        :param registered: 是否为注册用户，恢复时需要重新检查账户是否被删除或封禁
+        :param deadline: 会话到期的单调时间，平滑升级时据此把剩余的有效期交给新进程
+        """
+        self.token = token
+        self.name = name
+        self.permission = permission
+        self.id_num = id_num
+        self.rooms = rooms
+        self.missed: deque = deque(maxlen=missed_limit)  # 已打包、带结束符的消息
+        self.registered = registered
+        self.deadline = deadline
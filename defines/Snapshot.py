@@ -0,0 +1,126 @@
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+
+class Snapshot:
+    """
+    运行状态快照：注册用户名、在线用户的权限和所在聊天室、运行时修改过的选项。
+    保存时事件循环先复制一份状态，再由单独的线程序列化并写入文件，事件循环只为复制停顿，不必等待写完；
+    不fork子进程，子进程会继承其他线程持有的锁和所有客户端连接。
+    先写临时文件再改名，文件要么是旧快照要么是完整的新快照。
+    文件格式：定长头（魔数、数据库编号、用户表版本号、用户名长度、其余状态长度、CRC32），
+    之后是以\\0分隔的用户名（消息以\\0结尾，用户名中不会出现\\0），最后是JSON格式的其余状态。
+    启动时用mmap读取，用户名直接从映射的内存解码切分，数百万用户也只需要很短的时间。
+    """
+    MAGIC = b'LHATSNP1'
+    HEADER = struct.Struct('<8sQQQQI')
+
+    def __init__(self, path: str, interval: float):
+        """
+        初始化快照
+        :param path: 快照文件路径
+        :param interval: 自动保存的间隔秒数，为0时不自动保存
+        """
+        self.path = path
+        self.interval = interval
+        self.worker: threading.Thread | None = None  # 正在写快照的线程
+        self.error: str | None = None  # 上次写快照失败的原因
+        self.next_due: float = time.monotonic() + interval  # 下次自动保存的时间
+        self.copy_seconds: float = 0.0  # 上次复制状态的耗时，即事件循环因保存快照暂停的时间
+
+    def due(self, now: float) -> bool:
+        """
+        判断是否到了自动保存的时间
+        :param now: 当前单调时间
+        """
+        return self.interval > 0 and self.worker is None and now >= self.next_due
+
+    def start(self, copy, write):
+        """
+        开始在后台保存快照
+        :param copy: 无参数的函数，在当前线程中复制要保存的状态，返回传给write的参数
+        :param write: 在写快照的线程中执行序列化和写入，不能读写事件循环的状态
+        :return: 无返回值
+        """
+        started = time.monotonic()
+        self.next_due = started + self.interval
+        args = copy()
+        self.copy_seconds = time.monotonic() - started
+        self.error = None
+        self.worker = threading.Thread(target=self._run, args=(write, args), name="snapshot", daemon=True)
+        self.worker.start()
+
+    def _run(self, write, args: tuple):
+        try:
+            write(*args)
+        except Exception as e:  # 写失败时保留原来的快照，由事件循环记录原因
+            self.error = str(e)
+
+    def poll(self):
+        """
+        检查后台保存是否完成
+        :return: 仍在进行时返回None，完成时返回是否成功
+        """
+        if self.worker is None or self.worker.is_alive():
+            return None
+        self.worker = None
+        return self.error is None
+
+    @classmethod
+    def write(cls, path: str, db_id: int, generation: int, names, state: dict):
+        """
+        写入快照文件
+        :param path: 快照文件路径
+        :param db_id: 数据库编号，防止换了数据库文件后读到别的数据库的快照
+        :param generation: 用户表版本号，用户表每次增删都会加一
+        :param names: 注册用户名
+        :param state: 其余状态，可以转换为JSON
+        """
+        names_data = '\0'.join(names).encode()
+        state_data = json.dumps(state, ensure_ascii=False, separators=(',', ':')).encode()
+        checksum = zlib.crc32(state_data, zlib.crc32(names_data))
+        temp_path = f'{path}.{threading.get_ident()}.tmp'  # 后台快照和升级前的快照可能同时在写
+        with open(temp_path, 'wb') as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, db_id, generation, len(names_data), len(state_data), checksum))
+            f.write(names_data)
+            f.write(state_data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path: str):
+        """
+        读取快照文件
+        :param path: 快照文件路径
+        :return: (数据库编号, 用户表版本号, 用户名集合, 其余状态)，文件不存在或已损坏时返回None
+        """
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            return None
+        with f:
+            if os.fstat(f.fileno()).st_size < cls.HEADER.size:
+                return None
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                magic, db_id, generation, names_length, state_length, checksum = cls.HEADER.unpack_from(mapped)
+                end = cls.HEADER.size + names_length + state_length
+                if magic != cls.MAGIC or len(mapped) < end:
+                    return None
+                view = memoryview(mapped)
+                try:
+                    names_view = view[cls.HEADER.size:cls.HEADER.size + names_length]
+                    state_view = view[cls.HEADER.size + names_length:end]
+                    if zlib.crc32(state_view, zlib.crc32(names_view)) != checksum:
+                        return None
+                    names = set(str(names_view, 'utf-8').split('\0')) if names_length else set()
+                    state = json.loads(str(state_view, 'utf-8'))
+                finally:  # 映射关闭前必须释放所有视图
+                    names_view = state_view = None
+                    view.release()
+        return db_id, generation, names, state
@@ -0,0 +1,70 @@
+import math
+import time
+
+
+class TimerWheel:
+    """
+    哈希时间轮，用于大量连接的定时检查。
+    定时器按到期刻度散列到固定数量的槽里，每个刻度只查看一个槽，
+    添加、取消都是O(1)，不需要每次扫描所有连接。
+    """
+
+    def __init__(self, tick: float = 1.0, slot_count: int = 512):
+        """
+        初始化时间轮
+        :param tick: 每个刻度的秒数，也是定时器的精度
+        :param slot_count: 槽的数量，超过一圈的定时器会在转到时被跳过，直到真正到期
+        """
+        self.tick = tick
+        self._slots: list[dict] = [{} for _ in range(slot_count)]  # 每个槽：对象 -> 到期刻度
+        self._where: dict = {}  # 对象 -> 所在槽的下标
+        self._current: int = int(time.monotonic() / tick)  # 已经处理到的刻度
+
+    def __len__(self) -> int:
+        return len(self._where)
+
+    def __contains__(self, item) -> bool:
+        return item in self._where
+
+    def schedule(self, item, delay: float):
+        """
+        添加或重设一个定时器
+        :param item: 定时器对应的对象，必须可哈希
+        :param delay: 多少秒后到期
+        """
+        self.cancel(item)
+        expire = max(math.ceil((time.monotonic() + delay) / self.tick), self._current + 1)
+        index = expire % len(self._slots)
+        self._slots[index][item] = expire
+        self._where[item] = index
+
+    def cancel(self, item):
+        """
+        取消一个定时器，不存在时什么也不做
+        :param item: 定时器对应的对象
+        """
+        index = self._where.pop(item, None)
+        if index is not None:
+            del self._slots[index][item]
+
+    def advance(self) -> list:
+        """
+        推进到当前时间，取出所有到期的定时器
+        :return: 到期的对象列表
+        """
+        now = int(time.monotonic() / self.tick)
+        if now <= self._current:
+            return []
+        expired = []
+        steps = min(now - self._current, len(self._slots))  # 落后超过一圈时，每个槽只需看一次
+        for step in range(1, steps + 1):
+            slot = self._slots[(self._current + step) % len(self._slots)]
+            if not slot:
+                continue
+            for item, expire in list(slot.items()):
+                if expire <= now:
+                    del slot[item]
+                    del self._where[item]
+                    expired.append(item)
+        self._current = now
+        return expired
@@ -1,22 +1,88 @@
-from defines.settings import default_room
+from defines.settings import default_room, recv_min
 import socket
+import sys
+
+# 聊天室名称与编号的双向映射，所有用户共用，用户只保存编号
+_room_ids: dict[str, int] = {}
+_room_names: list[str | None] = []
+_free_room_ids: list[int] = []  # 已删除聊天室的编号，分配新编号时优先复用，反复创建删除聊天室时映射不会一直增长
+
+
+def roomId(room: str) -> int:
+    """
+    获取聊天室的编号，第一次出现的聊天室会分配一个新编号
+    :param room: 聊天室名称
+    :return: 聊天室编号
+    """
+    room_id = _room_ids.get(room)
+    if room_id is None:
+        room = sys.intern(room)
+        if _free_room_ids:
+            room_id = _free_room_ids.pop()
+            _room_names[room_id] = room
+        else:
+            room_id = len(_room_names)
+            _room_names.append(room)
+        _room_ids[room] = room_id
+    return room_id
+
+
+def releaseRoomId(room: str):
+    """
+    聊天室删除后释放它的编号，调用前所有用户都必须已经退出该聊天室，否则编号复用后他们会出现在新的聊天室里
+    :param room: 聊天室名称
+    """
+    if room == default_room:
+        return
+    room_id = _room_ids.pop(room, None)
+    if room_id is not None:
+        _room_names[room_id] = None
+        _free_room_ids.append(room_id)
+
+
+_default_rooms = (roomId(default_room),)  # 只在默认聊天室的用户共用这一个元组
 
 
 class User:
     """
-    用户类，用于存储每个连接到本服务器的客户端的信息。
+    连接记录，每个连接到本服务器的客户端对应一个，同时作为该连接在IO多路复用中的附加数据。
+    连接建立时只有连接信息，登录成功后由login填入用户信息。
+    使用__slots__，不创建__dict__，十万级连接时每个连接只占用这几个属性的空间。
     """
+    __slots__ = ('_socket', '_address', '_username', '_rooms', '__id_num', '__permission',
+                 'last_active', 'login_deadline', 'read_size')
 
-    def __init__(self, conn, address, permission, id_num, name):
+    def __init__(self, conn, address, permission=None, id_num=None, name=None, last_active=0.0, login_deadline=None):
         """
         初始化客户端
+        :param conn: 客户端的socket
+        :param address: 客户端的地址
+        :param permission: 权限，未登录时为None
+        :param id_num: id号，未登录时为None
+        :param name: 用户名，未登录时为None
+        :param last_active: 最后一次收到数据的时间
+        :param login_deadline: 必须完成登录的时间，为None时不限制，为0时表示正在登录
         """
         self._socket = conn  # 客户端的socket
         self._address = address  # 客户端的ip地址
         self._username = name  # 客户端的用户名
-        self._rooms = [default_room]  # 客户端所在的房间
+        self._rooms = _default_rooms  # 客户端所在的房间编号
         self.__id_num = id_num  # 客户端的id号
         self.__permission = permission
+        self.last_active = last_active  # 最后一次收到数据的时间
+        self.login_deadline = login_deadline  # 必须完成登录的时间
+        self.read_size = recv_min  # 下次从该连接读取的字节数，随流量调整
+
+    def login(self, permission, id_num, name):
+        """
+        登录成功后填入用户信息
+        :param permission: 权限
+        :param id_num: id号
+        :param name: 用户名
+        """
+        self.__permission = permission
+        self.__id_num = id_num
+        self._username = name
 
     def getPermission(self) -> str:
         """
@@ -44,7 +110,7 @@ class User:
 
     def getUserName(self) -> str:
         """
-        获取客户端的用户名
+        获取客户端的用户名，未登录时为None
         """
         return self._username
 
@@ -52,15 +118,23 @@ class User:
         """
         获取客户端所在的房间
         """
-        return self._rooms
+        return [_room_names[room_id] for room_id in self._rooms]
+
+    def inRoom(self, room: str) -> bool:
+        """
+        判断客户端是否在某个房间，群聊分发时对每个用户调用，不创建新对象
+        :param room: 房间名，字符串
+        """
+        return _room_ids.get(room) in self._rooms
 
     def addRoom(self, room: str):
         """
         客户端加入房间
         :param room: 房间名，字符串
         """
-        if room not in self._rooms:
-            self._rooms.append(room)
+        room_id = roomId(room)
+        if room_id not in self._rooms:
+            self._rooms += (room_id,)
         else:
             print('The room already exists!')
 
@@ -70,8 +144,10 @@ class User:
         """
         if room == default_room:
             print('Leaving the default room is not allowed!')
-        elif room in self._rooms:
-            self._rooms.remove(room)
+        elif self.inRoom(room):
+            room_id = _room_ids[room]
+            rooms = tuple(joined for joined in self._rooms if joined != room_id)
+            self._rooms = _default_rooms if rooms == _default_rooms else rooms
         else:
             print('The room does not exist!')
 
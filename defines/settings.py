@@ -9,6 +9,7 @@ VERSION = "v1.6.0"  # Lhat Server版本
 ip_address = '127.0.0.1'  # 服务器建立的ip地址，通常为localhost（127.0.0.1）
 network_port = 8080  # 服务器的端口，内网穿透的时候要填写本地端口为此
 default_room = 'Lhat! Chatting Room'  # 默认聊天室名称
+database = 'sql/server.db'  # 数据库文件路径，为':memory:'时使用内存数据库（例如基准测试），重启后数据不保留
 
 log = True  # 是否记录日志
 record = True  # 是否记录聊天记录
@@ -16,8 +17,132 @@ force_account = True  # 是否强制用户系统，为True时，游客无法加
 allow_register = True  # 是否允许注册新用户，Manager权限以上可以在运行后更改
 lock_server = False  # 为保证服务器通讯安全，可以锁定服务器，仅Admin权限用户可加入，但是已加入普通用户不会被踢出
 
+# ADMISSION 连接准入控制
+
+listen_backlog = 4096  # 监听队列长度，重连风暴时队列太短会导致客户端SYN超时，实际上限受系统somaxconn限制
+accept_batch = 64  # 每次事件循环最多接收的新连接数
+max_connections = 10000  # 全局最大连接数，超出时新连接直接被重置
+max_connections_per_ip = 64  # 单个IP的最大连接数
+max_outbound_bytes = 4 * 1024 * 1024  # 单个连接最多积压的待发送字节数，超出时视为慢速连接并断开
+max_pending_connections = 1024  # 尚未登录的连接数上限，防止慢速连接耗尽文件描述符
+login_timeout = 10.0  # 连接建立后多少秒内必须完成登录或注册，否则断开，为0时不限制，运行后可通过option命令修改
+
+# RECEIVE 接收
+
+recv_min = 1024  # 每个连接最小的单次读取字节数，新连接从这里开始，读满时加倍，只用到四分之一时减半
+recv_max = 64 * 1024  # 每个连接最大的单次读取字节数
+max_frame_bytes = 64 * 1024  # 客户端单条消息的最大字节数，超出时断开连接
+
+# OUTBOUND 发送调度，控制消息（踢出通知、用户列表、命令回复等）优先于聊天消息
+
+control_burst = 32  # 聊天消息积压时最多连续插队的控制消息数，之后至少写出一条聊天消息，防止聊天消息被一直压着
+write_batch = 64 * 1024  # 积压时每次从队列取出写入的字节数，越小控制消息插队越及时，系统调用也越多
+
+# FANOUT 并行写出
+
+fanout_workers = 3  # 写出线程数，大聊天室的群聊交给它们并行写，事件循环不等待写完，为0时始终在事件循环中写
+fanout_threshold = 2000  # 聊天室成员数达到多少时，向它群聊的那一轮使用写出线程，小聊天室的群聊仍在事件循环中直接写
+
+# FLOOD CONTROL 流量控制，按用户名和IP分别限流，速率分开设置，运行后可通过option命令修改
+
+rate_limit = True  # 是否启用流量控制
+chat_rate = 5.0  # 聊天消息每秒补充的令牌数
+chat_burst = 10  # 聊天消息的突发上限
+command_rate = 2.0  # 命令每秒补充的令牌数
+command_burst = 5  # 命令的突发上限
+login_rate = 0.5  # 登录及注册每秒补充的令牌数，登录前没有用户名，只按IP限流
+login_burst = 5  # 登录及注册的突发上限
+ip_chat_rate = 50.0  # 同一IP的聊天消息每秒补充的令牌数，NAT和校园网后面的用户共用一个IP，应比单个用户宽松
+ip_chat_burst = 100  # 同一IP的聊天消息的突发上限
+ip_command_rate = 20.0  # 同一IP的命令每秒补充的令牌数
+ip_command_burst = 50  # 同一IP的命令的突发上限
+
+# HEARTBEAT 心跳与空闲连接回收，运行后可通过option命令修改
+
+heartbeat_interval = 30.0  # 连接空闲多少秒后由服务器发送心跳，半开连接会因此暴露出来，为0时不发送
+idle_timeout = 0.0  # 连接空闲多少秒后直接断开，客户端需要回复心跳才能保持在线，为0时不断开
+timer_tick = 1.0  # 时间轮每个刻度的秒数
+timer_slots = 512  # 时间轮的槽数
+
+# METRICS 运行指标
+
+metrics = False  # 是否启用本地指标HTTP服务，文本格式，可供Prometheus抓取
+metrics_address = '127.0.0.1'  # 指标服务监听地址，不建议暴露到公网
+metrics_port = 9100  # 指标服务监听端口
+metrics_top_rooms = 20  # 按聊天室输出成员数时只输出成员最多的几个聊天室，所有聊天室的总成员数另有一项
+latency_sample = 100  # 每多少条消息追踪一条从收到到写出各阶段的延迟，用stats latency命令查看，为0时不追踪，运行后可通过option命令修改
+
+# MAILBOX 离线信箱
+
+mailbox = True  # 是否为不在线的注册用户保存私聊消息，登录时一并发送
+mailbox_quota = 200  # 每个用户最多保存的离线消息数，超出后新消息不再保存
+mailbox_expire = 7 * 24 * 3600  # 离线消息保存的秒数，过期后不再投递，为0时永久保存
+mailbox_page = 50  # 登录时每次从数据库取出的离线消息数
+
+# HISTORY 聊天室最近消息
+
+history_size = 50  # 每个聊天室在内存中保存的最近消息条数，加入聊天室或登录时回放，为0时不保存
+history_memory = 16 * 1024 * 1024  # 所有聊天室最近消息合计占用的字节数上限
+
+# SESSION 断线重连
+
+session_ttl = 30.0  # 断线后会话保留的秒数，客户端在此期间可以用恢复令牌直接恢复登录，为0时不发放令牌
+session_missed = 200  # 会话保留期间最多保存的错过的消息数
+
+# DEDUP 消息去重，客户端在消息中带上id字段时，同一用户重发的同一编号的消息只分发一次
+
+dedup_entries = 50000  # 最多记录的消息编号数，超出时淘汰最久没见过的，每条约占200字节，为0时不去重
+dedup_window = 600.0  # 消息编号保留的秒数，超过后同一编号的消息视为新消息
+dedup_id_max = 64  # 消息编号的最大长度，更长的编号不参与去重
+
+# USER LIST 在线用户列表
+
+user_page_size = 100  # update page命令默认每页返回的用户数
+user_page_max = 1000  # update page命令每页最多返回的用户数
+presence_max_members = 10000  # 成员数超过该值的聊天室不再推送成员列表，客户端用update page查询，为0时不限制
+
+# UPGRADE 平滑升级
+
+upgrade_timeout = 30.0  # 平滑升级时等待新进程接管的秒数，超时后旧进程继续服务
+handoff_batch = 250  # 每条交接消息携带的文件描述符数，不能超过内核的SCM_MAX_FD（253）
+
+# BULK 批量用户操作
+
+bulk_progress = 1000  # 批量创建、封禁、设置权限时，每检查多少条向管理员发送一次进度
+
+# SNAPSHOT 运行状态快照
+
+snapshot_interval = 300.0  # 每隔多少秒在后台保存一次运行状态快照（注册用户名、在线用户的权限和聊天室、运行时修改的选项），为0时不保存也不加载
+snapshot_path = 'sql/state.snapshot'  # 快照文件路径，启动时如果与数据库一致则直接加载，不必全表扫描
+snapshot_user_ttl = 24 * 3600.0  # 快照中的用户下线超过多少秒后不再恢复其权限和聊天室
+
+# CAPTURE 流量录制，用bench/lhat_replay.py回放
+
+capture = False  # 是否在启动时开始录制客户端发来的原始数据，运行后也可以用capture命令开关
+capture_limit = 1024 * 1024 * 1024  # 录制文件的字节数上限，达到后停止写入，为0时不限制
+
+# PROFILE 运行时性能分析
+
+profile_max_seconds = 600.0  # profile cpu start 的最长采样秒数，超出时按此值采样
+
 # SQL COMMANDS
 
+create_meta_table = '''CREATE TABLE IF NOT EXISTS META(
+KEY VARCHAR(20) PRIMARY KEY NOT NULL,
+VALUE INTEGER NOT NULL
+);'''
+
+init_meta = 'INSERT OR IGNORE INTO META (KEY, VALUE) VALUES (?, ?)'
+
+get_meta = 'SELECT VALUE FROM META WHERE KEY = ?'
+
+# USERS表每次增删都使META中的用户表版本号加一，快照中的版本号与之相同时才说明快照中的用户名是最新的
+create_users_insert_trigger = '''CREATE TRIGGER IF NOT EXISTS USERS_INSERTED AFTER INSERT ON USERS
+BEGIN UPDATE META SET VALUE = VALUE + 1 WHERE KEY = 'users_generation'; END;'''
+
+create_users_delete_trigger = '''CREATE TRIGGER IF NOT EXISTS USERS_DELETED AFTER DELETE ON USERS
+BEGIN UPDATE META SET VALUE = VALUE + 1 WHERE KEY = 'users_generation'; END;'''
+
 create_table = '''CREATE TABLE IF NOT EXISTS USERS(
 USER_NAME VARCHAR(20) PRIMARY KEY NOT NULL,
 PASSWORD CHAR(32) NOT NULL,
@@ -25,6 +150,28 @@ PERMISSION VARCHAR(8) NOT NULL,
 BAN INTEGER NOT NULL
 );'''
 
+create_rooms_table = '''CREATE TABLE IF NOT EXISTS ROOMS(
+ROOM_NAME VARCHAR(20) PRIMARY KEY NOT NULL,
+OWNER VARCHAR(20) NOT NULL,
+CREATED_TIME REAL NOT NULL,
+SETTINGS TEXT NOT NULL
+);'''
+
+append_room = 'INSERT OR IGNORE INTO ROOMS (ROOM_NAME, OWNER, CREATED_TIME, SETTINGS) VALUES(?, ?, ?, ?)'
+
+delete_room = 'DELETE FROM ROOMS WHERE ROOM_NAME = ?'
+
+get_room_info = 'SELECT * FROM ROOMS WHERE ROOM_NAME = ?'
+
+create_mailbox_table = '''CREATE TABLE IF NOT EXISTS MAILBOX(
+ID INTEGER PRIMARY KEY AUTOINCREMENT,
+RECIPIENT VARCHAR(20) NOT NULL,
+SENT_TIME REAL NOT NULL,
+MESSAGE BLOB NOT NULL
+);'''
+
+create_mailbox_index = 'CREATE INDEX IF NOT EXISTS MAILBOX_RECIPIENT ON MAILBOX (RECIPIENT, ID)'
+
 append_user = 'INSERT INTO USERS (USER_NAME, PASSWORD, PERMISSION, BAN) VALUES(?, ?, ?, ?)'
 
 delete_user = 'DELETE FROM USERS WHERE USER_NAME = ?'
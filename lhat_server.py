@@ -1,16 +1,39 @@
 import socket
 import selectors  # IO多路复用
 import os
-import types
 import threading
 import sqlite3
 import hashlib
+import itertools
 import time
 import json
+import math
+import secrets
+import struct
+import subprocess
+import sys
+from collections import deque
 
 from server_operations import pack, unpack
 from defines import settings
-from defines.User import User
+from defines.User import User, releaseRoomId
+from defines.RateLimiter import RateLimiter
+from defines.Metrics import Metrics, MetricsServer
+from defines.Profiler import Profiler
+from defines.TimerWheel import TimerWheel
+from defines.Mailbox import Mailbox
+from defines.RoomHistory import RoomHistory
+from defines.Room import Room
+from defines.Session import Session
+from defines.Capture import Capture
+from defines.LatencyTracer import LatencyTracer
+from defines.OutboundQueue import OutboundQueue
+from defines.FanoutPool import FanoutPool
+from defines.OnlineIndex import OnlineIndex
+from defines.RoomPresence import RoomPresence
+from defines.Snapshot import Snapshot
+from defines.RecvBuffer import RecvBuffer
+from defines.DedupCache import DedupCache
 
 # SQL命令，用于便捷地操作数据库
 create_table = settings.create_table
@@ -19,6 +42,17 @@ delete_user = settings.delete_user
 get_user_info = settings.get_user_info
 reset_user_password = settings.reset_user_password
 set_permission = settings.set_permission
+create_rooms_table = settings.create_rooms_table
+append_room = settings.append_room
+delete_room = settings.delete_room
+get_room_info = settings.get_room_info
+create_mailbox_table = settings.create_mailbox_table
+create_mailbox_index = settings.create_mailbox_index
+create_meta_table = settings.create_meta_table
+init_meta = settings.init_meta
+get_meta = settings.get_meta
+create_users_insert_trigger = settings.create_users_insert_trigger
+create_users_delete_trigger = settings.create_users_delete_trigger
 
 
 class Server:
@@ -31,11 +65,21 @@ class Server:
     ip: str = settings.ip_address  # 服务器IP地址
     port: int = settings.network_port  # 服务器端口
     default_room: str = settings.default_room  # 默认聊天室名称
+    database: str = settings.database  # 数据库文件路径
     user_connections: dict  # 用户连接列表
     need_handle_messages: list  # 消息队列
-    chatting_rooms: list  # 聊天室列表
-    sql_exist_user: list  # 数据库中的用户
+    pending_writes: dict  # 本轮事件循环中每个连接待发送的控制消息
+    pending_chat: dict  # 本轮事件循环中每个连接待发送的聊天消息
+    blocked_writes: dict  # 因发送缓冲区已满而没写完的数据，等待可写事件
+    chatting_rooms: dict  # 聊天室名称 -> 聊天室信息，信息尚未读取时为None
+    sql_exist_user: set  # 数据库中的用户
     client_id: int  # 用于给每个连接分配的id
+    connection_count: int  # 当前连接数
+    ip_connections: dict  # 每个IP的当前连接数
+    metrics: Metrics  # 运行指标
+    profiler: Profiler  # 运行时性能分析
+    timer_wheel: TimerWheel  # 连接的空闲检查定时器
+    PRE_AUTH_TYPES: frozenset = frozenset(("USER_NAME", "REGISTER", "RESUME", "HEARTBEAT"))  # 未登录的连接允许发送的消息类型
 
     # SETTINGS
     logable: bool  # 是否记录日志
@@ -43,6 +87,15 @@ class Server:
     force_account: bool  # 是否强制用户系统，为True时，游客无法加入聊天室
     allow_register: bool  # 是否允许注册新用户，Manager权限以上可以在运行后更改
     lock_server: bool  # 为保证服务器通讯安全，可以锁定服务器，仅Admin权限用户可加入，但是已加入普通用户不会被踢出
+    rate_limit: bool  # 是否启用流量控制
+    chat_limiter: RateLimiter  # 聊天消息限流器
+    command_limiter: RateLimiter  # 命令限流器
+    login_limiter: RateLimiter  # 登录及注册限流器，按IP
+    ip_chat_limiter: RateLimiter  # 按IP的聊天消息限流器
+    ip_command_limiter: RateLimiter  # 按IP的命令限流器
+    heartbeat_interval: float  # 连接空闲多少秒后发送心跳
+    idle_timeout: float  # 连接空闲多少秒后断开
+    login_timeout: float  # 连接建立后多少秒内必须完成登录
 
     @staticmethod
     def checkDir():
@@ -55,14 +108,6 @@ class Server:
             if not os.path.exists(dir_name):
                 os.mkdir(dir_name)
 
-    @staticmethod
-    def sync():
-        """
-        服务器同步，通常用于避免TCP粘包。
-        :return: 无返回值
-        """
-        time.sleep(0.0005)  # 同步用途的主线程阻塞时间延迟
-
     def __init__(self):
         """
         初始化服务器
@@ -75,51 +120,143 @@ class Server:
         self.force_account: bool = settings.force_account
         self.allow_register: bool = settings.allow_register
         self.lock_server: bool = settings.lock_server
+        self.rate_limit: bool = settings.rate_limit
+        self.chat_limiter = RateLimiter(settings.chat_rate, settings.chat_burst)
+        self.command_limiter = RateLimiter(settings.command_rate, settings.command_burst)
+        self.login_limiter = RateLimiter(settings.login_rate, settings.login_burst)
+        self.ip_chat_limiter = RateLimiter(settings.ip_chat_rate, settings.ip_chat_burst)
+        self.ip_command_limiter = RateLimiter(settings.ip_command_rate, settings.ip_command_burst)
+        self.heartbeat_interval: float = settings.heartbeat_interval
+        self.idle_timeout: float = settings.idle_timeout
+        self.login_timeout: float = settings.login_timeout
 
         self.log("Server arguments set.")
         self.log("=====NEW SERVER INITIALIZING BELOW=====", show_time=False)
         self.user_connections: dict[str, User] = {}  # 创建一个空的用户连接列表
         self.need_handle_messages: list[bytes] = []  # 创建一个空的消息队列
-        self.chatting_rooms: list[str] = [self.default_room]  # 创建一个聊天室列表
-        self.sql_exist_user: list[str] = []  # 数据库中的用户
+        # 所有连接共用的接收缓冲区，recv_into直接写入，只为没读完的半条消息单独保存数据
+        self.recv_buffer: RecvBuffer = RecvBuffer(settings.recv_min, settings.recv_max, settings.max_frame_bytes)
+        self.pending_writes: dict[socket.socket, list[bytes]] = {}  # 本轮待发送的控制消息，轮末合并写入
+        self.pending_chat: dict[socket.socket, list[bytes]] = {}  # 本轮待发送的聊天消息，排在控制消息后面
+        self.blocked_writes: dict[socket.socket, OutboundQueue] = {}  # 没写完的数据，只在事件循环线程中修改
+        self.round_started: float = 0.0  # 本轮事件循环开始的时间，作为本轮消息的入队时间
+        # 并行写出线程池，一轮要写的连接很多时（大聊天室群聊）分给多个线程同时写
+        self.fanout_pool: FanoutPool | None = FanoutPool(settings.fanout_workers) if settings.fanout_workers > 0 else None
+        self.fanout_round: bool = False  # 本轮是否向大聊天室群聊过，是则交给写出线程写
+        # 写出线程正在写的连接 -> None；写完之前连接被关闭时，改为关闭前还要发出的数据，写完后再发出并关闭
+        self.fanout_inflight: dict[socket.socket, bytes | None] = {}
+        self.send_lock: threading.Lock = threading.Lock()  # 登录线程也会发送消息
+        self.loop_thread: int = 0  # 事件循环所在的线程
+        # 其他线程发送消息后，通过这对socket唤醒事件循环，让消息及时写出
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.wakeup_writer.setblocking(False)
+        # 其他线程要修改连接、在线列表等状态时，放到这里交给事件循环执行，这些字典在事件循环中遍历时不加锁
+        self.loop_calls: deque = deque()
+        self.chatting_rooms: dict[str, Room | None] = {}  # 聊天室，启动时从数据库读取名称
+        self.sql_exist_user: set[str] = set()  # 数据库中的用户
         self.client_id: int = 0  # 创建一个id，用于给每个连接分配一个id
+        self.connection_count: int = 0  # 当前连接数
+        self.ip_connections: dict[str, int] = {}  # 每个IP的当前连接数
+        self.metrics: Metrics = Metrics(settings.metrics_top_rooms)  # 运行指标，计数开销很低，所以始终开启
+        self.profiler: Profiler = Profiler("logs")  # 运行时性能分析，由管理员命令开启
+        self.tracer: LatencyTracer = LatencyTracer(settings.latency_sample)  # 按采样追踪各阶段延迟
+        self.timer_wheel: TimerWheel = TimerWheel(settings.timer_tick, settings.timer_slots)  # 空闲检查定时器
+        self.metrics_server = None  # 指标HTTP服务，平滑升级前需要停止
+        # 以下三个会话表只在事件循环线程中读写，登录线程通过callInLoop交给事件循环
+        self.session_tokens: dict[str, str] = {}  # 在线用户名 -> 恢复令牌
+        self.sessions: dict[str, Session] = {}  # 恢复令牌 -> 断线后保留的会话
+        self.detached_users: dict[str, Session] = {}  # 用户名 -> 断线后保留的会话
+        self.online_index: OnlineIndex = OnlineIndex()  # 按用户名排序的在线用户，包括断线后保留会话的用户
+        self.presence: RoomPresence = RoomPresence()  # 各聊天室的在线成员，成员变化时只向该聊天室广播用户列表
+        self.dedup: DedupCache = DedupCache(settings.dedup_entries, settings.dedup_window)  # 最近见过的消息编号
+        self.snapshot: Snapshot = Snapshot(settings.snapshot_path, settings.snapshot_interval)  # 运行状态快照
+        self.bulk_running: bool = False  # 是否有批量用户操作正在执行，同一时间只执行一个
+        self.upgrade_phase: str | None = None  # 平滑升级的阶段：draining、starting、confirming，没有升级时为None
+        self.upgrade_deadline: float = 0.0  # 平滑升级超时的单调时间
+        self.upgrade_requester = None  # 发起升级的管理员的连接
+        self.upgrade_child = None  # 新进程
+        self.upgrade_channel: socket.socket | None = None  # 与新进程通信的Unix socket
+        self.upgrade_parked: list = []  # 状态已经交出、暂停服务的(socket, 事件, 连接记录)
+        self.restored_users: dict[str, list] = {}  # 快照中在线用户的[权限, 所在聊天室, 最后在线的时间]，重新登录时恢复
+        # 启动时各选项的值，快照中的选项只有在启动值没有变化（没有修改settings.py）时才恢复
+        self.option_defaults: dict = self.getOptionValues()
+        self.room_history: RoomHistory = RoomHistory(settings.history_size, settings.history_memory)  # 聊天室最近消息
+        # 流量录制，未开启时为None，收包路径只多一次判断
+        self.capture: Capture | None = Capture("records", settings.capture_limit) if settings.capture else None
         self.log("Initializing server... ", end="")
         self.select: selectors.DefaultSelector = selectors.DefaultSelector()  # 创建IO多路复用
         self.main_sock: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  # 创建socket
         self.main_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
+        self.main_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)  # 重启时不必等待TIME_WAIT
         self.log("Done!", show_time=False)
         self.log("Now the server can be ran.")
 
         self.sql_connection: sqlite3.Connection = sqlite3.connect(
-            "sql/server.db", check_same_thread=False
+            self.database, check_same_thread=False
         )  # 创建数据库连接
         self.log("SQLite3 database connected.")
         self.sql_cursor: sqlite3.Cursor = self.sql_connection.cursor()  # 创建数据库游标
+        self.sql_lock: threading.Lock = threading.Lock()  # 数据库连接在多个线程间共享
         self.log("SQLite3 cursor created.")
-        self.sql_cursor.execute(create_table)  # 创建数据库表，名为USERS
+        if self.database != ":memory:":  # WAL模式下批量操作用独立的连接写入时，不阻塞其他连接的查询
+            self.sqlExecute("PRAGMA journal_mode=WAL")
+        self.sqlExecute(create_table)  # 创建数据库表，名为USERS
         self.sql_connection.commit()
         self.log("USERS table exists now.")
-        self.sql_cursor.execute("SELECT USER_NAME FROM USERS")  # 获取数据库中的用户名
-        for name in self.sql_cursor:
-            self.sql_exist_user.append(name[0])  # 将用户名添加到列表中
+        self.sqlExecute(create_meta_table)  # 数据库编号和用户表版本号，用于判断快照是否与数据库一致
+        self.sqlExecute(init_meta, ("database_id", secrets.randbits(63)))
+        self.sqlExecute(init_meta, ("users_generation", 0))
+        self.sqlExecute(create_users_insert_trigger)
+        self.sqlExecute(create_users_delete_trigger)
+        self.sql_connection.commit()
+        self.database_id: int = self.sqlExecute(get_meta, ("database_id",)).fetchone()[0]
+        snapshot = Snapshot.load(self.snapshot.path) if settings.snapshot_interval > 0 else None
+        if snapshot is not None and snapshot[0] != self.database_id:  # 其他数据库的快照
+            snapshot = None
+        if snapshot is not None and snapshot[1] == self.getUserGeneration():
+            self.sql_exist_user = snapshot[2]  # 快照之后用户表没有变化，不必全表扫描
+            self.log(f"{len(self.sql_exist_user)} users loaded from the snapshot.")
+        else:
+            # 获取数据库中的用户名
+            self.sql_exist_user = {name for name, in self.sqlExecute("SELECT USER_NAME FROM USERS")}
         if "root" not in self.sql_exist_user:  # 如果数据库中没有root用户，则创建
-            self.sql_cursor.execute(
+            self.sqlExecute(
                 append_user, ("root", "25d55ad283aa400af464c76d713c07ad", "Admin", 0)
             )
-            self.sql_exist_user.append("root")
+            self.sql_exist_user.add("root")
             self.log("Root account not found, created.")
         else:  # 如果数据库中有root用户，则检查权限是否正确
-            self.sql_cursor.execute(set_permission, ("Admin", "root"))
+            self.sqlExecute(set_permission, ("Admin", "root"))
         self.sql_connection.commit()
+        self.sqlExecute(create_rooms_table)  # 聊天室表，重启后聊天室仍然存在
+        self.sqlExecute(append_room, (self.default_room, "Server", time.time(), "{}"))
+        self.sql_connection.commit()
+        # 只读取名称，聊天室信息在第一次用到时再读取，十万个聊天室也能很快启动
+        self.chatting_rooms = dict.fromkeys(name for name, in self.sqlExecute("SELECT ROOM_NAME FROM ROOMS"))
+        self.log(f"ROOMS table exists now, {len(self.chatting_rooms)} rooms found.")
+        if snapshot is not None:
+            self.restoreSnapshot(snapshot[3])
+        self.sqlExecute(create_mailbox_table)  # 离线信箱，只追加写入，登录投递后删除
+        self.sqlExecute(create_mailbox_index)
+        self.sql_connection.commit()
+        self.mailbox: Mailbox = Mailbox(
+            self.sqlExecute, self.sql_connection.commit, settings.mailbox_quota, settings.mailbox_expire
+        )
+        self.log("MAILBOX table exists now.")
 
-    def run(self):
+    def run(self, handoff: socket.socket = None):
         """
         启动服务器
+        :param handoff: 平滑升级时与旧进程通信的Unix socket，为None时正常启动
         :return: 无返回值，因为服务器一直运行，直到程序结束
         """
-        # main_sock是用于监听的socket，用于接收客户端的连接
-        self.main_sock.bind((self.ip, self.port))
-        self.main_sock.listen(20)  # 监听，最多accept 20个连接数
+        if handoff is None:
+            # main_sock是用于监听的socket，用于接收客户端的连接
+            self.main_sock.bind((self.ip, self.port))
+            self.main_sock.listen(settings.listen_backlog)  # 监听，队列长度见settings.py
+        else:  # 从旧进程接管监听socket和所有连接
+            self.takeOver(handoff)
         self.log("================================", show_time=False)
         self.log(f"Running server on {self.ip}:{self.port}")
         self.log("  To change the settings, \n  please visit settings.py")
@@ -128,107 +265,326 @@ class Server:
                 "Warning, force account is enabled!!! \n"
                 "  Guest will not be able to login."
             )
+        if settings.metrics:
+            self.metrics_server = MetricsServer(self, settings.metrics_address, settings.metrics_port)
+            self.metrics_server.start()
+            self.log(f"Metrics available on http://{settings.metrics_address}:{settings.metrics_port}/metrics")
         self.log("Waiting for connection...")
         self.main_sock.setblocking(False)  # 设置为非阻塞
         self.select.register(
             self.main_sock, selectors.EVENT_READ, data=""
         )  # 注册socket到IO多路复用，以便于多连接
+        self.select.register(self.wakeup_reader, selectors.EVENT_READ, data="wakeup")
+        self.loop_thread = threading.get_ident()
         while True:
-            events: list[tuple[selectors.SelectorKey, int]] = self.select.select(timeout=None)  # 阻塞等待IO事件
+            # 阻塞等待IO事件，最多等一个时间轮刻度
+            events: list[tuple[selectors.SelectorKey, int]] = self.select.select(timeout=self.timer_wheel.tick)
+            self.round_started = time.perf_counter()
             for key, mask in events:  # 事件循环，key用于获取连接，mask用于获取事件类型
                 if key.data == "":  # 如果是新连接
                     self.createConnection(key.fileobj)  # 接收连接
+                elif key.data == "wakeup":  # 其他线程有消息要发送
+                    self.drainWakeup()
+                elif key.data == "upgrade":  # 平滑升级时新进程发来消息
+                    self.continueUpgrade()
                 else:  # 如果是已连接
                     self.serveClient(key, mask)  # 处理连接
+            while self.loop_calls:  # 其他线程交给事件循环执行的操作
+                func, args = self.loop_calls.popleft()
+                func(*args)
+            self.reapIdleConnections()
+            if self.snapshot.worker is not None or self.snapshot.due(time.monotonic()):
+                self.checkSnapshot()
+            if self.profiler.active:  # 仅在CPU采样期间检查是否到期
+                self.checkProfiler()
+            if self.upgrade_phase != "confirming":  # 连接已经交给新进程时不再写，升级失败后再写
+                self.flushPresence()  # 本轮成员有变化的聊天室，各广播一次用户列表
+                self.flushWrites()  # 本轮产生的消息，每个连接合并为一次写入
+            if self.upgrade_phase is not None:
+                self.stepUpgrade()
+            if self.tracer.waiting:  # 被采样的消息已全部交给send()
+                self.tracer.flushed()
             time.sleep(0.0001)  # 因为是阻塞的，所以sleep不会漏消息，同时降低负载
 
     def createConnection(self, sock: socket.socket):
         """
-        创建一个新连接
+        接收新连接，每次唤醒最多接收accept_batch个，超出连接数上限的连接直接重置
         :param sock: 创建的socket对象
         :return: 无返回值
         """
         conn: socket.socket
         address: tuple[str, int]
 
-        conn, address = sock.accept()  # 接收连接，并创建一个新的连接
+        rejected = 0
+        for _ in range(settings.accept_batch):
+            try:
+                conn, address = sock.accept()  # 接收连接，并创建一个新的连接
+            except (BlockingIOError, InterruptedError):  # 队列已经取空
+                break
+            except OSError as error:  # 通常是文件描述符用尽，留在队列里等下一轮
+                self.log(f"Failed to accept connection: {error}")
+                break
+            if self.connection_count >= settings.max_connections or \
+                    self.connection_count - len(self.user_connections) >= settings.max_pending_connections or \
+                    self.ip_connections.get(address[0], 0) >= settings.max_connections_per_ip:
+                # 设置SO_LINGER为0，关闭时直接发送RST，不占用TIME_WAIT
+                conn.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+                conn.close()
+                rejected += 1
+                continue
+            self.acceptConnection(conn, address)
+        if rejected:
+            self.metrics.connections_rejected += rejected
+            self.log(f"{rejected} connections rejected, limit reached.")
+
+    def acceptConnection(self, conn: socket.socket, address: tuple):
+        """
+        初始化一个已接收的连接，并注册到IO多路复用
+        :param conn: 新连接
+        :param address: 客户端地址
+        :return: 无返回值
+        """
+        self.connection_count += 1
+        self.ip_connections[address[0]] = self.ip_connections.get(address[0], 0) + 1
+        self.metrics.connections_accepted += 1
         self.log(f"Connection established: {address[0]}:{address[1]}")
         conn.setblocking(False)  # 设置为非阻塞
         conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)  # 设置为非延迟发送
-        namespace: types.SimpleNamespace = types.SimpleNamespace(address=address, inbytes=b"")  # 创建一个空的命名空间，用于存储连接信息
-        self.select.register(conn, selectors.EVENT_READ | selectors.EVENT_WRITE, data=namespace)  # 注册连接到IO多路复用，以便于多连接
+        now = time.monotonic()
+        # 连接记录，登录成功后填入用户信息，同一个对象也会放入在线用户列表
+        record = User(
+            conn, address,
+            last_active=now,
+            login_deadline=now + self.login_timeout if self.login_timeout > 0 else None,
+        )
+        # 注册连接到IO多路复用，以便于多连接，只关注可读事件，否则每轮循环都要遍历所有空闲连接
+        self.select.register(conn, selectors.EVENT_READ, data=record)
+        if self.capture:
+            self.capture.open(conn)
+        if record.login_deadline is not None:
+            self.timer_wheel.schedule(conn, self.login_timeout)
+        else:
+            self.scheduleIdleCheck(conn, record.last_active)
 
     def serveClient(self, key, mask):
         """
         用于服务客户端的函数
         :param key: 传入的键，内含很多成员变量
-        :param mask: 用于判断客户端目前是否可用，是一个布尔变量
+        :param mask: 事件类型，只有存在没写完的数据时才会注册可写事件
         :return: 无返回值
         """
         sock: socket.socket = key.fileobj  # 获取socket
-        data: types.SimpleNamespace = key.data  # 获取命名空间
+        data: User = key.data  # 获取连接记录
+        address = data.getAddress()
+        trace = None  # 被采样时记录消息经过各阶段的时间
+        if mask & selectors.EVENT_WRITE:  # 发送缓冲区腾出了空间，继续写没写完的数据
+            if not self.resumeWrite(sock, data):
+                return
         if mask & selectors.EVENT_READ:  # 如果可读，则开始从客户端读取消息
             try:
-                data.inbytes = sock.recv(1024)  # 从客户端读取消息
+                # 读到共用的接收缓冲区里，不挂在连接记录上，空闲连接不占用缓冲区
+                received, frames = self.recv_buffer.read(sock, data)  # 按结束符切分，一次可能读到多条消息
             except ConnectionError:  # 如果读取失败，则说明客户端已断开连接
-                self.closeConnection(sock, data.address)
+                self.closeConnection(sock, address, resumable=True)
                 return
-            if data.inbytes:  # 如果消息列表不为空
-                try:
-                    data.inbytes = data.inbytes.strip(b"\x00\xcc\0")  # 尝试解码
-                except UnicodeDecodeError:
-                    self.log("A message is not in utf-8 encoding.")
-                else:
-                    self.need_handle_messages.append(data.inbytes)
-                data.inbytes = b""
+            if received is None:  # 暂时没有数据可读，连接仍然有效
+                return
+            if received:
+                read_at = time.perf_counter_ns() if self.tracer.sample_every > 0 else 0
+                self.metrics.bytes_in += received
+                if self.capture:  # 录制原始数据，回放时原样发送
+                    self.capture.data(sock, self.recv_buffer.view[self.recv_buffer.end - received:self.recv_buffer.end].tobytes())
+                data.last_active = time.monotonic()
+                if frames is None:
+                    self.log(f"Connection {address[0]}:{address[1]} sent a frame over {settings.max_frame_bytes} bytes, closing.")
+                    self.closeConnection(sock, address)
+                    return
+                for frame in frames:
+                    if data.getUserName() is None and not self.isPreAuthFrame(frame):
+                        continue  # 未登录的连接只能登录、注册或回复心跳，其余消息直接丢弃
+                    if self.rate_limit and not self.checkRateLimit(sock, data, frame):
+                        continue  # 超限的消息直接丢弃，不再解码
+                    self.need_handle_messages.append(frame)
+                if self.need_handle_messages:  # 只追踪会交给processMessage的消息
+                    trace = self.tracer.begin(read_at)
+                    if trace:
+                        trace.mark("frame")
             else:
-                self.closeConnection(sock, data.address)  # 如果读取失败，则关闭连接
+                self.closeConnection(sock, address, resumable=True)  # 如果读取失败，则关闭连接
                 return
 
-        if mask & selectors.EVENT_WRITE:  # 如果可写，向客户端发送消息
-            if self.need_handle_messages:
-                for processing_message in self.need_handle_messages:
-                    try:
-                        # 如果该项为空，就转到下一个遍历，反之处理它
-                        if processing_message:
-                            self.processMessage(processing_message, sock, data.address)
-                        else:
-                            continue
-                    except ConnectionResetError:  # 服务端断开连接
-                        self.closeConnection(sock, data.address)
-                        return
-                self.need_handle_messages.clear()
-                self.sync()  # 粘包现象很恶心，sleep暂时能解决
+        if self.need_handle_messages:  # 处理刚刚读到的消息
+            for processing_message in self.need_handle_messages:
+                if sock.fileno() == -1:  # 处理前面的消息时连接已经关闭
+                    break
+                try:
+                    self.processMessage(processing_message, sock, address, trace)
+                    if trace and trace.message_type is not None:  # 一次读取只追踪第一条处理了的消息
+                        self.tracer.finish(trace)
+                        trace = None
+                except ConnectionResetError:  # 服务端断开连接
+                    self.closeConnection(sock, address, resumable=True)
+                    break
+            self.need_handle_messages.clear()
+
+    @staticmethod
+    def isPreAuthFrame(frame: bytes) -> bool:
+        """
+        判断消息是否允许由未登录的连接发送，与流量控制一样在解码前用字节查找粗筛，
+        正文里带有这些字样的其他消息会漏过，processMessage解码后还会按消息类型再检查一次
+        :param frame: 尚未解码的消息
+        :return: 是登录、注册、恢复会话或心跳消息时返回True
+        """
+        return b'"USER_NAME"' in frame or b'"REGISTER"' in frame or b'"HEARTBEAT"' in frame or b'"RESUME"' in frame
+
+    def checkRateLimit(self, sock: socket.socket, data: User, frame: bytes) -> bool:
+        """
+        流量控制，在解码之前按用户名和IP检查令牌桶，两者都有令牌时才各消耗一个
+        消息类型只用字节查找粗略判断，json.dumps会转义正文里的引号，所以正文不会被误判为命令
+        :param sock: 客户端连接
+        :param data: 连接记录
+        :param frame: 尚未解码的消息
+        :return: 允许处理时返回True，超限时返回False
+        """
+        address = data.getAddress()
+        if b'"HEARTBEAT"' in frame and self.isHeartbeat(frame):  # 心跳回复不计入限流
+            return True
+        if b'"COMMAND"' in frame:
+            checks = ((self.command_limiter, data.getUserName()), (self.ip_command_limiter, address[0]))
+        elif b'"USER_NAME"' in frame or b'"REGISTER"' in frame or b'"RESUME"' in frame:
+            checks = ((self.login_limiter, address[0]),)
+        else:
+            checks = ((self.chat_limiter, data.getUserName()), (self.ip_chat_limiter, address[0]))
+        checks = [(limiter, key) for limiter, key in checks if key is not None]
+        for limiter, key in checks:
+            if limiter.available(key):
+                continue
+            if limiter is self.login_limiter:
+                self.log(f"{address[0]} is logging in too frequently, connection refused.")
+                self.send(sock, pack("登录过于频繁，请稍后再试。", "Server", "", "KICK_NOTICE"), "KICK_NOTICE")
+                self.closeConnection(sock, address)
+            elif limiter.shouldWarn(key):
+                self.log(f"{key} is sending messages too frequently, messages dropped.")
+                self.send(sock, pack("你发送消息过于频繁，请稍后再试。", "Server", "", "TEXT_MESSAGE"))
+            return False
+        for limiter, key in checks:  # 都能通过才消耗，被IP限流拦下的消息不占用用户自己的额度
+            limiter.take(key)
+        return True
+
+    @staticmethod
+    def isHeartbeat(frame: bytes) -> bool:
+        """
+        确认消息是心跳回复，字节查找可能被其他字段中的"HEARTBEAT"骗过，心跳很短，这里解码确认
+        :param frame: 尚未解码的消息
+        :return: 是心跳回复时返回True
+        """
+        if len(frame) > 512:
+            return False
+        try:
+            decoded = json.loads(frame)
+        except ValueError:
+            return False
+        return isinstance(decoded, dict) and decoded.get("type") == "HEARTBEAT"
 
-    def processMessage(self, message: bytes, sock: socket.socket, address=None):
+    def getDedupKey(self, sock: socket.socket, message_id):
+        """
+        生成消息去重的键，按连接的登录用户名区分，不信任消息中的发送者
+        :param sock: 客户端连接
+        :param message_id: 客户端给出的消息编号
+        :return: 发送者和消息编号用\\0连接的字符串，不参与去重时返回None
+        """
+        if not message_id or self.dedup.capacity <= 0:  # 不带编号的消息不参与去重
+            return None
+        if not isinstance(message_id, str) or len(message_id) > settings.dedup_id_max:
+            return None
+        return f"{self.select.get_key(sock).data.getUserName()}\0{message_id}"
+
+    def processMessage(self, message: bytes, sock: socket.socket, address=None, trace=None):
         """
         处理消息，让服务器决定如何处理
         :param message: 待处理的消息
         :param sock: 客户端连接
         :param address: 客户端地址
+        :param trace: 被采样时的延迟追踪，未被采样时为None，消息被丢弃时其message_type保持为None
         :return: 无返回值
         """
         if not message:  # 客户端发送了空消息，于是直接断连
             self.closeConnection(sock, address)
             return
         recv_data = unpack(message)  # 解码消息
-        self.sync()  # 延迟，防止粘包
+        if recv_data[0] not in self.PRE_AUTH_TYPES:  # 读取时的字节查找只是粗筛，这里按解码后的类型确认已经登录
+            try:
+                logged_in = self.select.get_key(sock).data.getUserName() is not None
+            except (KeyError, ValueError):  # 连接已经关闭
+                return
+            if not logged_in:
+                return
+        self.metrics.countIn(recv_data[0])
+        if trace:
+            trace.message_type = recv_data[0]
+            trace.mark("decode")
         if recv_data[0] == "TEXT_MESSAGE":  # 如果能正常解析，则进行处理
+            dedup_key = self.getDedupKey(sock, recv_data[5])
+            # 带编号的消息处理完都回复确认，客户端收到确认后不再重发
+            ack = pack(recv_data[5], "Server", recv_data[1], "MESSAGE_ACK") if recv_data[5] else None
+            if dedup_key is not None and self.dedup.seen(dedup_key):  # 客户端重发的消息已经分发过，只回复确认
+                self.send(sock, ack, "MESSAGE_ACK")
+                if trace:  # 重发的消息不计入延迟
+                    trace.restart()
+                return
+            message += b"\0"  # 转发时补上结束符，同一连接的多条消息会合并写入，客户端靠它切分
+            if trace:
+                trace.mark("dispatch")
             if recv_data[1] in self.chatting_rooms:  # 如果是公开聊天室的群聊
-                self.record(message)
+                self.record(message[:-1])
+                if trace:
+                    trace.mark("record")
+                self.room_history.append(recv_data[1], message)
                 print(f'[{time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(float(recv_data[3])))}] '
                       f'({recv_data[1]}) <{recv_data[2]}> {recv_data[4]}')
-                for sending_client in self.user_connections.values():
-                    if recv_data[1] in sending_client.getRooms():  # 如果该用户在该聊天室
-                        sending_client.getSocket().send(message)
+                if trace:
+                    trace.mark("fanout_start")
+                fanout_start = time.perf_counter()
+                if self.presence.count(recv_data[1]) >= settings.fanout_threshold:  # 大聊天室，本轮交给写出线程写
+                    self.fanout_round = True
+                for sending_client in list(self.user_connections.values()):  # 登录线程可能同时修改用户表
+                    if sending_client.inRoom(recv_data[1]):  # 如果该用户在该聊天室
+                        self.send(sending_client.getSocket(), message, chat=True)
+                for session in list(self.detached_users.values()):  # 暂时断线的用户，消息留到恢复时补发
+                    if recv_data[1] in session.rooms:
+                        session.missed.append(message)
+                self.metrics.fanout_seconds.observe(time.perf_counter() - fanout_start)
+                if trace:
+                    trace.mark("fanout_end")
+                if ack:
+                    self.send(sock, ack, "MESSAGE_ACK")
             else:  # 私聊
                 print(f"[{recv_data[3]}] Private message received.")
                 # 显然遍历没下标好
                 if recv_data[1] in self.user_connections:
-                    sock.send(message)
-                    self.user_connections[recv_data[1]].getSocket().send(message)
+                    self.send(sock, message, chat=True)
+                    self.send(self.user_connections[recv_data[1]].getSocket(), message, chat=True)
+                    if ack:
+                        self.send(sock, ack, "MESSAGE_ACK")
+                elif recv_data[1] in self.detached_users:  # 暂时断线，恢复时补发
+                    self.send(sock, message, chat=True)
+                    self.detached_users[recv_data[1]].missed.append(message)
+                    if ack:
+                        self.send(sock, ack, "MESSAGE_ACK")
+                elif settings.mailbox and recv_data[1] in self.sql_exist_user:  # 注册用户不在线，存入离线信箱
+                    if self.mailbox.store(recv_data[1], message):
+                        self.send(sock, message, chat=True)
+                        self.send(sock, pack("对方不在线，消息已存入离线信箱。", "Server", "", "TEXT_MESSAGE"))
+                        if ack:
+                            self.send(sock, ack, "MESSAGE_ACK")
+                    else:
+                        self.send(sock, pack("对方的离线信箱已满，消息未送达。", "Server", "", "TEXT_MESSAGE"))
+                        if dedup_key is not None:  # 没有送达，重发时重新处理
+                            self.dedup.discard(dedup_key)
                 else:
-                    sock.send(pack("私聊目标用户不存在。", "Server", "", "TEXT_MESSAGE"))
+                    self.send(sock, pack("私聊目标用户不存在。", "Server", "", "TEXT_MESSAGE"))
+                    if dedup_key is not None:
+                        self.dedup.discard(dedup_key)
 
         elif recv_data[0] == "SEND_FILE":
             print(f"{recv_data[1]} File send request received")
@@ -236,9 +592,9 @@ class Server:
 
         elif recv_data[0] == "COMMAND":
             # 客户端会发送命令，于是服务器应该根据命令进行相应的处理
+            if trace:
+                trace.mark("dispatch")
             command = recv_data[2].split(" ")  # 分割命令
-            self.sync()
-            self.sync()
             try:
                 if command[0] == "room":
                     room_name = " ".join(command[2:])  # 将命令分割后的后面的部分合并为一个字符串
@@ -247,7 +603,8 @@ class Server:
                         if self.user_connections[recv_data[1]].getPermission() != "User":  # 如果不是普通用户
                             if (room_name in self.chatting_rooms) or (room_name in self.user_connections):
                                 self.log(f"Room {room_name} already exists, abort creating.")
-                                sock.send(
+                                self.send(
+                                    sock,
                                     pack(
                                         f"Room {room_name} already exists, abort creating.",
                                         "Server",
@@ -256,12 +613,14 @@ class Server:
                                     )
                                 )
                             else:  # 如果聊天室不存在，则创建聊天室
-                                self.chatting_rooms.append(room_name)
+                                self.createRoom(room_name, recv_data[1])
                                 self.log(f"Room {room_name} created.")
                                 for name, user in self.user_connections.items():
                                     if name == recv_data[1]:
                                         user.addRoom(room_name)
-                                        sock.send(
+                                        self.presence.join(name, (room_name,), user)
+                                        self.send(
+                                            sock,
                                             pack(
                                                 f"Room {room_name} created.",
                                                 "Server",
@@ -271,7 +630,8 @@ class Server:
                                         )
                         else:
                             self.log(f"User {recv_data[1]} is not allowed to create room.")
-                            sock.send(
+                            self.send(
+                                sock,
                                 pack(f"你没有创建聊天室的权限。",
                                      "Server",
                                      "",
@@ -283,8 +643,11 @@ class Server:
                         if room_name in self.chatting_rooms:
                             for name, user in self.user_connections.items():
                                 if name == recv_data[1]:
+                                    joined = user.inRoom(room_name)
                                     user.addRoom(room_name)
-                                    sock.send(
+                                    self.presence.join(name, (room_name,), user)
+                                    self.send(
+                                        sock,
                                         pack(
                                             f"你已成功加入聊天室 {room_name}。",
                                             "Server",
@@ -292,9 +655,13 @@ class Server:
                                             "TEXT_MESSAGE",
                                         )
                                     )
+                                    history = self.room_history.replay(room_name)
+                                    if history and not joined:  # 回放最近消息，与上面的通知合并为一次写入
+                                        self.send(sock, history, "HISTORY", chat=True)
                         else:
                             self.log(f"Room {room_name} does not exist, abort joining.")
-                            sock.send(
+                            self.send(
+                                sock,
                                 pack(
                                     f"{room_name} 不存在，无法加入。",
                                     "Server",
@@ -304,22 +671,51 @@ class Server:
                             )
                     elif command[1] == "list":  # 列出所有聊天室
                         self.log(f"{recv_data[1]} requests to check online rooms.")
-                        sock.send(
+                        self.send(
+                            sock,
                             pack(
-                                f"Now online rooms: {self.chatting_rooms}\n"
+                                f"Now online rooms: {list(self.chatting_rooms)}\n"
                                 f"You joined: {self.user_connections[recv_data[1]].getRooms()}",
                                 "Server",
                                 "",
                                 "TEXT_MESSAGE",
                             )
                         )
+                    elif command[1] == "info":  # 查看聊天室信息
+                        room = self.getRoom(room_name)
+                        if room:
+                            self.send(
+                                sock,
+                                pack(
+                                    f"Room {room_name}\n"
+                                    f"Owner: {room.getOwner()}\n"
+                                    f'Created: {time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(room.getCreatedTime()))}\n'
+                                    f"Settings: {room.dumpSettings()}",
+                                    "Server",
+                                    "",
+                                    "TEXT_MESSAGE",
+                                )
+                            )
+                        else:
+                            self.send(
+                                sock,
+                                pack(
+                                    f"{room_name} 不存在。",
+                                    "Server",
+                                    "",
+                                    "TEXT_MESSAGE",
+                                )
+                            )
                     elif command[1] == "leave":  # 离开聊天室
                         self.log(f"{recv_data[1]} requests to leave room {room_name}")
                         if room_name in self.chatting_rooms:
                             for name, user in self.user_connections.items():
                                 if name == recv_data[1]:
                                     user.removeRoom(room_name)
-                                    sock.send(
+                                    if not user.inRoom(room_name):  # 默认聊天室不能退出
+                                        self.presence.leave(name, (room_name,))
+                                    self.send(
+                                        sock,
                                         pack(
                                             f"你已成功退出聊天室 {room_name}。",
                                             "Server",
@@ -329,7 +725,8 @@ class Server:
                                     )
                         else:
                             self.log(f"Room {room_name} does not exist, abort leaving.")
-                            sock.send(
+                            self.send(
+                                sock,
                                 pack(
                                     f"{room_name} 不存在，无法退出。",
                                     "Server",
@@ -341,30 +738,31 @@ class Server:
                         self.log(f"{recv_data[1]} requests to delete room {room_name}")
                         if self.user_connections[recv_data[1]].getPermission() == "Admin":
                             if room_name in self.chatting_rooms:
-                                self.chatting_rooms.remove(room_name)
+                                members = self.deleteRoom(room_name)
                                 self.log(f"Room {room_name} deleted.")
-                                for user in self.user_connections.values():
-                                    if room_name in user.getRooms():
-                                        user.removeRoom(room_name)
-                                        user.getSocket().send(
-                                            pack(
-                                                f"{room_name} 聊天室已被管理员删除，已自动退出本聊天室。",
-                                                "Server",
-                                                "",
-                                                "TEXT_MESSAGE",
-                                            )
-                                        )
-                                    sock.send(
+                                for user in members:
+                                    self.send(
+                                        user.getSocket(),
                                         pack(
-                                            f"Room {room_name} deleted.",
+                                            f"{room_name} 聊天室已被管理员删除，已自动退出本聊天室。",
                                             "Server",
                                             "",
                                             "TEXT_MESSAGE",
                                         )
                                     )
+                                self.send(
+                                    sock,
+                                    pack(
+                                        f"Room {room_name} deleted.",
+                                        "Server",
+                                        "",
+                                        "TEXT_MESSAGE",
+                                    )
+                                )
                             else:
                                 self.log(f"Room {room_name} does not exist, abort deleting.")
-                                sock.send(
+                                self.send(
+                                    sock,
                                     pack(
                                         f"{room_name} 不存在，无法删除。",
                                         "Server",
@@ -374,7 +772,8 @@ class Server:
                                 )
                         else:
                             self.log(f"{recv_data[1]} do not have the permission to delete {room_name}.")
-                            sock.send(
+                            self.send(
+                                sock,
                                 pack(
                                     f"你没有权限删除聊天室 {room_name}。",
                                     "Server",
@@ -382,14 +781,15 @@ class Server:
                                     "TEXT_MESSAGE",
                                 )
                             )
-                    self.sync()
-                    sock.send(
+                    self.send(
+                        sock,
                         pack(
                             json.dumps(self.user_connections[recv_data[1]].getRooms()),
                             "Server",
                             "",
                             "ROOM_MANIFEST",
-                        )
+                        ),
+                        "ROOM_MANIFEST",
                     )
 
                 elif command[0] == "manager":  # 维护者任免命令
@@ -411,12 +811,14 @@ class Server:
                                 self.log(
                                     f"{operate_user} permission changed to Manager."
                                 )
-                                self.user_connections[operate_user].getSocket().send(
+                                self.send(
+                                    self.user_connections[operate_user].getSocket(),
                                     pack(
                                         f"你已被最高管理员添加为维护者。", "Server", "", "TEXT_MESSAGE"
                                     )
                                 )
-                                sock.send(
+                                self.send(
+                                    sock,
                                     pack(
                                         f"{operate_user} permission changed to Manager.",
                                         "Server",
@@ -425,7 +827,8 @@ class Server:
                                     )
                                 )
                             else:
-                                sock.send(
+                                self.send(
+                                    sock,
                                     pack(
                                         f"{operate_user} does not exist or has a higher permission, "
                                         f"abort prompting.",
@@ -447,12 +850,14 @@ class Server:
                                     "User"
                                 )
                                 self.log(f"{operate_user} permission changed to User.")
-                                self.user_connections[operate_user].getSocket().send(
+                                self.send(
+                                    self.user_connections[operate_user].getSocket(),
                                     pack(
                                         f"你已被最高管理员撤掉维护者。", "Server", "", "TEXT_MESSAGE"
                                     )
                                 )
-                                sock.send(
+                                self.send(
+                                    sock,
                                     pack(
                                         f"{operate_user} permission changed to User.",
                                         "Server",
@@ -461,7 +866,8 @@ class Server:
                                     )
                                 )
                             else:
-                                sock.send(
+                                self.send(
+                                    sock,
                                     pack(
                                         f"{operate_user} does not exist or has a higher permission, "
                                         f"abort removing.",
@@ -472,30 +878,35 @@ class Server:
                                 )
                         elif command[1] == "list":
                             self.log(f"{recv_data[1]} requests to list all managers.")
-                            sock.send(
+                            self.send(
+                                sock,
                                 pack(
                                     json.dumps(self.getManagers()),
                                     "Server",
                                     "",
                                     "MANAGER_LIST",
-                                )
+                                ),
+                                "MANAGER_LIST",
                             )
                     else:
                         if command[1] == "list":
                             self.log(f"{recv_data[1]} requests to list all managers.")
-                            sock.send(
+                            self.send(
+                                sock,
                                 pack(
                                     json.dumps(self.getManagers()),
                                     "Server",
                                     "",
                                     "MANAGER_LIST",
-                                )
+                                ),
+                                "MANAGER_LIST",
                             )
                         else:
                             self.log(
                                 f"{recv_data[1]} do not have the permission to manage users."
                             )
-                            sock.send(
+                            self.send(
+                                sock,
                                 pack(f"你没有最高权限以用于管理用户。", "Server", "", "TEXT_MESSAGE")
                             )
 
@@ -512,17 +923,20 @@ class Server:
                                 f'，{" ".join(command[3:])}' if len(command) > 2 else ""
                             )
 
-                            self.user_connections[command[1]].getSocket().send(
+                            self.send(
+                                self.user_connections[command[1]].getSocket(),
                                 pack(
                                     f"你已被管理员踢出服务器{reason}。", "Server", "", "KICK_NOTICE"
-                                )
+                                ),
+                                "KICK_NOTICE",
                             )
                             self.closeConnection(
                                 self.user_connections[command[1]].getSocket(),
                                 self.user_connections[command[1]].getAddress(),
                             )
                             self.log(f"{command[1]} kicked.")
-                            sock.send(
+                            self.send(
+                                sock,
                                 pack(
                                     f"{command[1]} kicked.",
                                     "Server",
@@ -533,7 +947,8 @@ class Server:
                         else:
                             if recv_data[1] == command[1]:
                                 self.log(f"{recv_data[1]} tried to kick himself.")
-                                sock.send(
+                                self.send(
+                                    sock,
                                     pack(
                                         f"You cannot kick yourself!!!",
                                         "Server",
@@ -544,7 +959,8 @@ class Server:
                                 for (
                                         sending_client
                                 ) in self.user_connections.values():  # 直接发送
-                                    sending_client.getSocket().send(
+                                    self.send(
+                                        sending_client.getSocket(),
                                         pack(
                                             f"[新闻] 人类迷惑行为: {recv_data[1]} 试图把自己踢出服务器。",
                                             "Server",
@@ -554,7 +970,8 @@ class Server:
                                     )
                             else:
                                 self.log(f"{command[1]} does not exist, abort kicking.")
-                                sock.send(
+                                self.send(
+                                    sock,
                                     pack(
                                         f"{command[1]} does not exist or is a Manager, abort kicking.",
                                         "Server",
@@ -566,7 +983,8 @@ class Server:
                         self.log(
                             f"{recv_data[1]} do not have the permission to kick {command[1]}."
                         )
-                        sock.send(
+                        self.send(
+                            sock,
                             pack(
                                 f"You do not have the permission to kick {command[1]}.",
                                 "Server",
@@ -575,20 +993,45 @@ class Server:
                             )
                         )
 
+                elif command[0] == "update" and len(command) > 1 and command[1] == "page":  # 分页查询在线用户
+                    # 用法：update page [页大小] [prefix 前缀] [after 上一页最后一个用户名]
+                    try:
+                        limit = int(command[2]) if len(command) > 2 else settings.user_page_size
+                        options = dict(zip(command[3::2], command[4::2]))
+                    except ValueError:
+                        self.send(sock, pack("用法：update page [页大小] [prefix 前缀] [after 用户名]", "Server", "", "TEXT_MESSAGE"))
+                    else:
+                        users, cursor, total = self.online_index.page(
+                            min(max(limit, 1), settings.user_page_max),
+                            options.get("prefix", ""),
+                            options.get("after", ""),
+                        )
+                        self.send(
+                            sock,
+                            pack(
+                                json.dumps({"users": users, "next": cursor, "total": total}),
+                                "Server",
+                                self.default_room,
+                                "USER_PAGE",
+                            ),
+                            "USER_PAGE",
+                        )
+
                 elif command[0] == "update":  # 有的用户可能无法及时更新用户列表，所以可以手动更新
                     self.log(
                         f"{recv_data[1]} requests to update his user manifest manually."
                     )
-                    sock.send(
+                    self.send(
+                        sock,
                         pack(
                             json.dumps(self.getOnlineUsers()),
                             "Server",
                             self.default_room,
                             "USER_MANIFEST",
-                        )
+                        ),
+                        "USER_MANIFEST",
                     )
-                    self.sync()
-                    sock.send(pack("你已成功更新用户列表。", "Server", "", "TEXT_MESSAGE"))
+                    self.send(sock, pack("你已成功更新用户列表。", "Server", "", "TEXT_MESSAGE"))
 
                 elif command[0] == "user":  # 用户系统相关命令
                     self.log(f"{recv_data[1]} requests to operate the SQL database.")
@@ -600,7 +1043,7 @@ class Server:
                                     and command[2] not in self.user_connections
                                     and command[2] != "Server"
                             ):
-                                self.sql_cursor.execute(
+                                self.sqlExecute(
                                     "INSERT INTO USERS (USER_NAME, PASSWORD, PERMISSION, BAN) "
                                     "VALUES (?, ?, ?, ?)",
                                     (
@@ -613,11 +1056,13 @@ class Server:
                                     ),
                                 )
                                 self.sql_connection.commit()
-                                self.sql_exist_user.append(command[2])
+                                self.sql_exist_user.add(command[2])
+                                self.restored_users.pop(command[2], None)  # 新账户不继承同名旧账户快照中的权限
                                 self.log(
                                     f"{command[2]} created, permission: {command[3]}."
                                 )
-                                sock.send(
+                                self.send(
+                                    sock,
                                     pack(
                                         f"{command[2]} created, permission: {command[3]}.",
                                         "Server",
@@ -627,7 +1072,8 @@ class Server:
                                 )
                             else:
                                 self.log(f"{command[2]} already exists.")
-                                sock.send(
+                                self.send(
+                                    sock,
                                     pack(
                                         f"{command[2]} already exists.",
                                         "Server",
@@ -641,7 +1087,7 @@ class Server:
                                 f"{recv_data[1]} requests to set password of {command[2]}."
                             )
                             if command[2] in self.sql_exist_user:
-                                self.sql_cursor.execute(
+                                self.sqlExecute(
                                     "UPDATE USERS SET PASSWORD = ? WHERE USER_NAME = ?",
                                     (
                                         hashlib.md5(
@@ -652,7 +1098,8 @@ class Server:
                                 )
                                 self.sql_connection.commit()
                                 if command[2] in self.user_connections:
-                                    self.user_connections[command[2]].getSocket().send(
+                                    self.send(
+                                        self.user_connections[command[2]].getSocket(),
                                         pack(
                                             f'你的密码已被更改为 {" ".join(command[3:])}。',
                                             "Server",
@@ -660,7 +1107,8 @@ class Server:
                                             "TEXT_MESSAGE",
                                         )
                                     )
-                                sock.send(
+                                self.send(
+                                    sock,
                                     pack(
                                         f"{command[2]} password set.",
                                         "Server",
@@ -670,7 +1118,8 @@ class Server:
                                 )
                             else:
                                 self.log(f"{command[2]} does not exist.")
-                                sock.send(
+                                self.send(
+                                    sock,
                                     pack(
                                         f"{command[2]} does not exist.",
                                         "Server",
@@ -687,7 +1136,8 @@ class Server:
                                 self.log(
                                     f"{recv_data[1]} tried to set permission of root."
                                 )
-                                sock.send(
+                                self.send(
+                                    sock,
                                     pack(
                                         f"You cannot set the permission of root.",
                                         "Server",
@@ -696,16 +1146,18 @@ class Server:
                                     )
                                 )
                             elif command[2] in self.sql_exist_user:
-                                self.sql_cursor.execute(
+                                self.sqlExecute(
                                     "UPDATE USERS SET PERMISSION = ? WHERE USER_NAME = ?",
                                     (command[3], command[2]),
                                 )
                                 self.sql_connection.commit()
+                                self.restored_users.pop(command[2], None)  # 快照中的旧权限不再恢复
                                 if command[2] in self.user_connections:
                                     self.user_connections[command[2]].setPermission(
                                         command[3]
                                     )
-                                    self.user_connections[command[2]].getSocket().send(
+                                    self.send(
+                                        self.user_connections[command[2]].getSocket(),
                                         pack(
                                             f"你的权限已被更改为 {command[3]}。",
                                             "Server",
@@ -713,7 +1165,8 @@ class Server:
                                             "TEXT_MESSAGE",
                                         )
                                     )
-                                sock.send(
+                                self.send(
+                                    sock,
                                     pack(
                                         f"Successfully changed {command[2]} permission to {command[3]}。",
                                         "Server",
@@ -723,7 +1176,8 @@ class Server:
                                 )
                             else:
                                 self.log(f"{command[2]} does not exist.")
-                                sock.send(
+                                self.send(
+                                    sock,
                                     pack(
                                         f"{command[2]} does not exist.",
                                         "Server",
@@ -735,18 +1189,18 @@ class Server:
                         elif command[1] == "delete":  # 删除用户
                             self.log(f"{recv_data[1]} requests to delete {command[2]}.")
                             # 查看数据库中要删除的用户的权限
-                            self.sql_cursor.execute(
+                            temp_permission = self.sqlExecute(
                                 "SELECT PERMISSION FROM USERS WHERE USER_NAME = ?",
                                 (command[2],),
-                            )
-                            temp_permission = self.sql_cursor.fetchone()
+                            ).fetchone()
                             if temp_permission:
                                 permission = temp_permission[0]
                             else:
                                 permission = "User"
                             if recv_data[1] == command[2] or command[2] == "root":
                                 self.log(f"{recv_data[1]} tried to ban himself.")
-                                sock.send(
+                                self.send(
+                                    sock,
                                     pack(
                                         f"You cannot delete yourself or root.",
                                         "Server",
@@ -756,7 +1210,8 @@ class Server:
                                 )
                             elif permission == "Admin" and recv_data[1] != "root":
                                 self.log(f"{command[2]} cannot be deleted.")
-                                sock.send(
+                                self.send(
+                                    sock,
                                     pack(
                                         f"{command[2]} is an administrator, only root can delete him.",
                                         "Server",
@@ -765,26 +1220,32 @@ class Server:
                                     )
                                 )
                             elif command[2] in self.sql_exist_user:
-                                self.sql_cursor.execute(
+                                self.sqlExecute(
                                     "DELETE FROM USERS WHERE USER_NAME = ?",
                                     (command[2],),
                                 )
                                 self.sql_connection.commit()
                                 if command[2] in self.user_connections:
-                                    self.user_connections[command[2]].getSocket().send(
+                                    self.send(
+                                        self.user_connections[command[2]].getSocket(),
                                         pack(
                                             f"你已被管理员踢出服务器，你的账户也一并被删除。",
                                             "Server",
                                             "",
                                             "KICK_NOTICE",
-                                        )
+                                        ),
+                                        "KICK_NOTICE",
                                     )
                                     self.closeConnection(
                                         self.user_connections[command[2]].getSocket(),
                                         self.user_connections[command[2]].getAddress(),
                                     )
-                                self.sql_exist_user.remove(command[2])
-                                sock.send(
+                                self.discardSession(command[2])  # 断线后保留的会话也不能再恢复
+                                self.restored_users.pop(command[2], None)
+                                self.sql_exist_user.discard(command[2])
+                                self.mailbox.clear(command[2])
+                                self.send(
+                                    sock,
                                     pack(
                                         f"{command[2]} deleted",
                                         "Server",
@@ -794,7 +1255,8 @@ class Server:
                                 )
                             else:
                                 self.log(f"{command[2]} does not exist.")
-                                sock.send(
+                                self.send(
+                                    sock,
                                     pack(
                                         f"{command[2]} does not exist",
                                         "Server",
@@ -805,16 +1267,16 @@ class Server:
 
                         elif command[1] == "ban":  # 封禁用户
                             self.log(f"{recv_data[1]} requests to ban {command[2]}")
-                            self.sql_cursor.execute(
+                            permission = self.sqlExecute(
                                 "SELECT PERMISSION FROM USERS WHERE USER_NAME = ?",
                                 (command[2],),
-                            )
-                            permission = self.sql_cursor.fetchone()
+                            ).fetchone()
                             if permission:
                                 permission = permission[0]
                             else:
                                 self.log(f"{command[2]} does not exist.")
-                                sock.send(
+                                self.send(
+                                    sock,
                                     pack(
                                         f"{command[2]} does not exist",
                                         "Server",
@@ -825,7 +1287,8 @@ class Server:
                                 return
                             if recv_data[1] == command[2] or command[2] == "root":
                                 self.log(f"{recv_data[1]} tried to ban himself.")
-                                sock.send(
+                                self.send(
+                                    sock,
                                     pack(
                                         f"You cannot ban yourself or root.",
                                         "Server",
@@ -835,7 +1298,8 @@ class Server:
                                 )
                             elif permission == "Admin" and recv_data[1] != "root":
                                 self.log(f"{command[2]} cannot be deleted.")
-                                sock.send(
+                                self.send(
+                                    sock,
                                     pack(
                                         f"{command[2]} is an administrator, only root can ban him.",
                                         "Server",
@@ -844,7 +1308,7 @@ class Server:
                                     )
                                 )
                             elif command[2] in self.sql_exist_user:
-                                self.sql_cursor.execute(
+                                self.sqlExecute(
                                     "UPDATE USERS SET BAN = ? WHERE USER_NAME = ?",
                                     (1, command[2]),
                                 )
@@ -855,19 +1319,24 @@ class Server:
                                         if len(command) > 2
                                         else ""
                                     )
-                                    self.user_connections[command[2]].getSocket().send(
+                                    self.send(
+                                        self.user_connections[command[2]].getSocket(),
                                         pack(
                                             f"你已被管理员踢出服务器并封禁{reason}。",
                                             "Server",
                                             "",
                                             "KICK_NOTICE",
-                                        )
+                                        ),
+                                        "KICK_NOTICE",
                                     )
                                     self.closeConnection(
                                         self.user_connections[command[2]].getSocket(),
                                         self.user_connections[command[2]].getAddress(),
                                     )
-                                sock.send(
+                                self.discardSession(command[2])  # 断线后保留的会话也不能再恢复
+                                self.restored_users.pop(command[2], None)
+                                self.send(
+                                    sock,
                                     pack(
                                         f"{command[2]} banned.",
                                         "Server",
@@ -877,7 +1346,8 @@ class Server:
                                 )
                             else:
                                 self.log(f"{command[2]} does not exist.")
-                                sock.send(
+                                self.send(
+                                    sock,
                                     pack(
                                         f"{command[2]} does not exist",
                                         "Server",
@@ -889,13 +1359,13 @@ class Server:
                         elif command[1] == "restore":  # 解封用户
                             self.log(f"{recv_data[1]} requests to restore {command[2]}")
                             if command[2] in self.sql_exist_user:
-                                self.sql_cursor.execute(
+                                self.sqlExecute(
                                     "UPDATE USERS SET BAN = ? WHERE USER_NAME = ?",
                                     (0, command[2]),
                                 )
                                 self.sql_connection.commit()
-                                self.sql_exist_user.append(command[2])
-                                sock.send(
+                                self.send(
+                                    sock,
                                     pack(
                                         f"{command[2]} unbanned.",
                                         "Server",
@@ -905,7 +1375,8 @@ class Server:
                                 )
                             else:
                                 self.log(f"{command[2]} does not exist.")
-                                sock.send(
+                                self.send(
+                                    sock,
                                     pack(
                                         f"{command[2]} does not exist.",
                                         "Server",
@@ -914,9 +1385,13 @@ class Server:
                                     )
                                 )
 
+                        elif command[1] in ("bulkcreate", "bulkban", "bulksetper"):  # 批量操作，在单独的线程中执行
+                            self.startBulkJob(sock, recv_data[1], command[1], command[2:])
+
                         else:
                             self.log(f"{command[1]} is not a valid operation.")
-                            sock.send(
+                            self.send(
+                                sock,
                                 pack(
                                     f"{command[1]} is not a valid operation.",
                                     "Server",
@@ -928,14 +1403,30 @@ class Server:
                 elif command[0] == "option":  # 服务器管理设置
                     if command[1] == "show":
                         self.log(f"{recv_data[1]} checked the server options.")
-                        sock.send(
+                        self.send(
+                            sock,
                             pack(
                                 f"Server Management Settings\n"
                                 f"logable: {self.logable}\n"
                                 f"recordable: {self.recordable}\n"
                                 f"forceAccount: {self.force_account}\n"
                                 f"allowRegister: {self.allow_register}\n"
-                                f"lockServer: {self.lock_server}",
+                                f"lockServer: {self.lock_server}\n"
+                                f"rateLimit: {self.rate_limit}\n"
+                                f"chatRate: {self.chat_limiter.rate}\n"
+                                f"chatBurst: {self.chat_limiter.burst}\n"
+                                f"commandRate: {self.command_limiter.rate}\n"
+                                f"commandBurst: {self.command_limiter.burst}\n"
+                                f"loginRate: {self.login_limiter.rate}\n"
+                                f"loginBurst: {self.login_limiter.burst}\n"
+                                f"ipChatRate: {self.ip_chat_limiter.rate}\n"
+                                f"ipChatBurst: {self.ip_chat_limiter.burst}\n"
+                                f"ipCommandRate: {self.ip_command_limiter.rate}\n"
+                                f"ipCommandBurst: {self.ip_command_limiter.burst}\n"
+                                f"heartbeatInterval: {self.heartbeat_interval}\n"
+                                f"idleTimeout: {self.idle_timeout}\n"
+                                f"loginTimeout: {self.login_timeout}\n"
+                                f"latencySample: {self.tracer.sample_every}",
                                 "Server",
                                 "",
                                 "TEXT_MESSAGE",
@@ -945,8 +1436,27 @@ class Server:
                         self.log(
                             f"{recv_data[1]} tried to set {command[2]} to {command[3]}"
                         )
+                        # 按连接记录判断权限，不信任消息中的发送者
+                        if self.select.get_key(sock).data.getPermission() == "User":
+                            self.log(f"{recv_data[1]} is not allowed to set options.")
+                            self.send(sock, pack("你没有修改服务器设置的权限。", "Server", "", "TEXT_MESSAGE"))
+                            return
                         vaild_option = True
-                        if command[2] == "logable":
+                        option_value = command[3] == "true"
+                        if command[2] in self.getNumericOptions():  # 数值选项
+                            try:
+                                option_value = float(command[3])
+                            except ValueError:
+                                option_value = math.nan
+                            # 为0表示关闭的选项可以设为0，其余必须为正数，nan和inf一律拒绝
+                            minimum_ok = option_value >= 0 if command[2] in self.getZeroableOptions() else option_value > 0
+                            if not (math.isfinite(option_value) and minimum_ok):
+                                self.send(sock, pack(f"{command[3]} is not a valid value for {command[2]}.",
+                                                     "Server", "", "TEXT_MESSAGE"))
+                                return
+                            owner, field = self.getNumericOptions()[command[2]]
+                            setattr(owner, field, option_value)
+                        elif command[2] == "logable":
                             self.logable = command[3] == "true"
                         elif command[2] == "recordable":
                             self.recordable = command[3] == "true"
@@ -956,12 +1466,15 @@ class Server:
                             self.allow_register = command[3] == "true"
                         elif command[2] == "lockServer":
                             self.lock_server = command[3] == "true"
+                        elif command[2] == "rateLimit":
+                            self.rate_limit = command[3] == "true"
                         else:
                             vaild_option = False
 
-                        sock.send(
+                        self.send(
+                            sock,
                             pack(
-                                f'Option {command[2]} has been set to {command[3] == "true"}'
+                                f'Option {command[2]} has been set to {option_value}'
                                 if vaild_option  # 如果选项有效，则发送上面的句子，反之发送下面的
                                 else f"Option {command[2]} not found, please check typing.",
                                 "Server",
@@ -970,17 +1483,117 @@ class Server:
                             )
                         )
 
+                elif command[0] == "profile":  # 运行时性能分析，需要Admin权限
+                    self.log(f"{recv_data[1]} requests to profile: {recv_data[2]}")
+                    if self.user_connections[recv_data[1]].getPermission() != "Admin":
+                        reply = "你没有权限进行性能分析。"
+                    elif command[1] == "cpu" and command[2] == "start":
+                        try:
+                            seconds = float(command[3]) if len(command) > 3 else 10.0
+                        except ValueError:
+                            seconds = 0.0
+                        if self.profiler.active:
+                            reply = "CPU profiling is already running."
+                        elif not math.isfinite(seconds) or seconds <= 0:  # nan和inf会让采样永不到期
+                            reply = f"{command[3]} is not a valid duration."
+                        else:
+                            seconds = min(seconds, settings.profile_max_seconds)
+                            self.profiler.startCpu(seconds, recv_data[1])
+                            reply = f"CPU profiling started for {seconds} seconds."
+                    elif command[1] == "cpu" and command[2] == "stop":
+                        if self.profiler.active:
+                            reply = f"CPU profile saved to {self.profiler.stopCpu()}."
+                        else:
+                            reply = "CPU profiling is not running."
+                    elif command[1] == "mem" and command[2] == "start":
+                        if self.profiler.memoryTracing():
+                            reply = "Memory tracing is already running."
+                        else:
+                            self.profiler.startMemory()
+                            reply = "Memory tracing started, baseline snapshot taken."
+                    elif command[1] == "mem" and command[2] == "snapshot":
+                        if self.profiler.memoryTracing():
+                            reply = f"Memory snapshot saved to {self.profiler.snapshotMemory()}."
+                        else:
+                            reply = "Memory tracing is not running."
+                    elif command[1] == "mem" and command[2] == "stop":
+                        if self.profiler.memoryTracing():
+                            self.profiler.stopMemory()
+                            reply = "Memory tracing stopped."
+                        else:
+                            reply = "Memory tracing is not running."
+                    else:
+                        reply = f"{recv_data[2]} is not a valid profile command."
+                    self.send(sock, pack(reply, "Server", "", "TEXT_MESSAGE"))
+
+                elif command[0] == "stats":  # 查看运行统计，需要Manager以上权限
+                    self.log(f"{recv_data[1]} requests stats: {recv_data[2]}")
+                    if self.user_connections[recv_data[1]].getPermission() == "User":
+                        reply = "你没有权限查看运行统计。"
+                    elif command[1] == "latency" and len(command) > 2 and command[2] == "reset":
+                        self.tracer.reset()
+                        reply = "Latency histograms have been reset."
+                    elif command[1] == "latency":
+                        reply = self.tracer.report()
+                    else:
+                        reply = f"{recv_data[2]} is not a valid stats command."
+                    self.send(sock, pack(reply, "Server", "", "TEXT_MESSAGE"))
+
+                elif command[0] == "capture":  # 流量录制，需要Admin权限
+                    self.log(f"{recv_data[1]} requests to capture traffic: {recv_data[2]}")
+                    if self.user_connections[recv_data[1]].getPermission() != "Admin":
+                        reply = "你没有权限录制流量。"
+                    elif command[1] == "start":
+                        if self.capture:
+                            reply = f"Capture is already running, writing to {self.capture.path}."
+                        else:
+                            self.capture = Capture("records", settings.capture_limit)
+                            reply = f"Capture started, writing to {self.capture.path}."
+                    elif command[1] == "stop":
+                        if self.capture:
+                            full = self.capture.full
+                            reply = f"Capture saved to {self.capture.stop()}" + \
+                                    (", size limit reached." if full else ".")
+                            self.capture = None
+                        else:
+                            reply = "Capture is not running."
+                    else:
+                        reply = f"{recv_data[2]} is not a valid capture command."
+                    self.send(sock, pack(reply, "Server", "", "TEXT_MESSAGE"))
+
+                elif command[0] == "snapshot":  # 立即保存运行状态快照，需要Admin权限
+                    self.log(f"{recv_data[1]} requests to save a snapshot.")
+                    if self.user_connections[recv_data[1]].getPermission() != "Admin":
+                        reply = "你没有权限保存快照。"
+                    elif self.snapshot.worker is not None:
+                        reply = "A snapshot is already being written."
+                    elif self.bulk_running:
+                        reply = "A bulk user operation is running, save the snapshot after it finishes."
+                    else:
+                        self.saveSnapshot()
+                        reply = f"Saving snapshot to {self.snapshot.path}."
+                    self.send(sock, pack(reply, "Server", "", "TEXT_MESSAGE"))
+
+                elif command[0] == "upgrade":  # 平滑升级，启动新进程并交出所有连接，需要Admin权限
+                    self.log(f"{recv_data[1]} requests to upgrade the server.")
+                    if self.user_connections[recv_data[1]].getPermission() != "Admin":
+                        self.send(sock, pack("你没有权限升级服务器。", "Server", "", "TEXT_MESSAGE"))
+                    else:
+                        error = self.startUpgrade(sock)  # 由事件循环逐步推进，成功时进程直接退出
+                        self.send(sock, pack(error or "正在启动新进程并交接连接……", "Server", "", "TEXT_MESSAGE"))
+
                 elif command[0] == "resetpwd":  # 自助重置密码
                     self.log(f"{recv_data[1]} requests to reset password.")
                     if not command[1]:
                         self.log(
                             f"{recv_data[1]} tried to reset password without a password."
                         )
-                        sock.send(
+                        self.send(
+                            sock,
                             pack(f"Password needed!", "Server", "", "TEXT_MESSAGE")
                         )
                     elif recv_data[1] in self.sql_exist_user:
-                        self.sql_cursor.execute(
+                        self.sqlExecute(
                             "UPDATE USERS SET PASSWORD = ? WHERE USER_NAME = ?",
                             (
                                 hashlib.md5(
@@ -990,7 +1603,8 @@ class Server:
                             ),
                         )
                         self.sql_connection.commit()
-                        sock.send(
+                        self.send(
+                            sock,
                             pack(
                                 f'Successfully changed the password to {" ".join(command[1:])}',
                                 "Server",
@@ -1000,7 +1614,8 @@ class Server:
                         )
                     else:
                         self.log(f"{recv_data[1]} does not exist.")
-                        sock.send(
+                        self.send(
+                            sock,
                             pack(
                                 f"{recv_data[1]} 不存在于数据库，无法重置密码。",
                                 "Server",
@@ -1010,7 +1625,8 @@ class Server:
                         )
 
                 else:
-                    sock.send(
+                    self.send(
+                        sock,
                         pack(
                             f"{recv_data[2]} is not a valid command.",
                             "Server",
@@ -1021,121 +1637,165 @@ class Server:
 
             except IndexError:
                 self.log(f"There is something wrong with {recv_data[1]} command.")
-                sock.send(
+                self.send(
+                    sock,
                     pack(f"SyntaxError: {recv_data[2]}", "Server", "", "TEXT_MESSAGE")
                 )
 
         elif recv_data[0] == "DO_NOT_PROCESS":  # 如果收到的是一个无效的消息，则先尝试直接发送
-            for sending_client in self.user_connections.values():
-                sending_client.getSocket().send(message)
+            message += b"\0"
+            for sending_client in list(self.user_connections.values()):
+                self.send(sending_client.getSocket(), message, "DO_NOT_PROCESS")
+
+        elif recv_data[0] == "HEARTBEAT":  # 心跳回复，活跃时间在读取时已经更新
+            pass
 
         elif recv_data[0] == "USER_NAME":  # 如果是用户名
+            data = self.select.get_key(sock).data
+            if data.getUserName() is not None or data.login_deadline == 0:  # 已经登录或正在登录
+                return
+            if self.upgrade_phase is not None:  # 升级期间不开始新的登录，客户端重新连接后由新进程处理
+                self.refuseLogin(sock, address, "服务器正在升级，请稍后重新登录。")
+                return
+            data.login_deadline = 0  # 登录处理中，不再计时
+            self.scheduleIdleCheck(sock, data.last_active)  # 登录期限的定时器换成空闲检查，否则要等到期限才开始心跳
             threading.Thread(
                 target=self.processNewLogin, args=(sock, address, recv_data[1])
             ).start()
 
+        elif recv_data[0] == "RESUME":  # 用恢复令牌恢复断线前的会话
+            data = self.select.get_key(sock).data
+            if data.getUserName() is not None or data.login_deadline == 0:  # 已经登录或正在登录
+                return
+            self.resumeSession(sock, data, recv_data[1])
+
         elif recv_data[0] == "REGISTER":  # 用户系统注册信息
             self.log(f"New register information received.")
             if not self.allow_register:  # 如果禁止注册新用户
-                sock.send(bytes("failed\0", "utf-8"))
+                self.send(sock, bytes("failed\0", "utf-8"), "REGISTER")
                 return
             try:
                 user, passwd = recv_data[1].split("\r\n")
             except ValueError:
                 self.log("This is not a valid register information.")
-                sock.send(bytes("failed\0", "utf-8"))
+                self.send(sock, bytes("failed\0", "utf-8"), "REGISTER")
                 self.closeConnection(sock, address)
                 return
             if passwd:
                 if user in self.user_connections:
                     self.log(f"{user} tried to register again.")
-                    sock.send(bytes("failed\0", "utf-8"))  # 注册信息无法重复
+                    self.send(sock, bytes("failed\0", "utf-8"), "REGISTER")  # 注册信息无法重复
                     self.closeConnection(sock, address)
                     return
             else:
                 self.log(f"{user} tried to register without password.")
-                sock.send(bytes("failed\0", "utf-8"))  # 如果没有密码，则返回失败
+                self.send(sock, bytes("failed\0", "utf-8"), "REGISTER")  # 如果没有密码，则返回失败
                 self.closeConnection(sock, address)
                 return
             if user in self.sql_exist_user:
                 self.log(f"{user} is already in the database.")
-                sock.send(bytes("failed\0", "utf-8"))  # 如果用户已存在，则返回失败
+                self.send(sock, bytes("failed\0", "utf-8"), "REGISTER")  # 如果用户已存在，则返回失败
                 self.closeConnection(sock, address)
                 return
             elif user == "Server":
                 self.log(f"{user} tried to register as Server.")
-                sock.send(bytes("failed\0", "utf-8"))  # 不允许注册为Server
+                self.send(sock, bytes("failed\0", "utf-8"), "REGISTER")  # 不允许注册为Server
                 self.closeConnection(sock, address)
                 return
             elif len(user) > 20:
                 self.log(f"{user} tried to register with a over-length name.")
-                sock.send(bytes("failed\0", "utf-8"))  # 不允许注册为Server
+                self.send(sock, bytes("failed\0", "utf-8"), "REGISTER")  # 不允许注册为Server
                 self.closeConnection(sock, address)
                 return
             else:
-                self.sql_cursor.execute(
+                self.sqlExecute(
                     "INSERT INTO USERS (USER_NAME, PASSWORD, PERMISSION, BAN) VALUES (?, ?, ?, ?)",
                     (user, passwd, "User", 0),
                 )
                 self.sql_connection.commit()
-                self.sql_exist_user.append(user)
+                self.sql_exist_user.add(user)
+                self.restored_users.pop(user, None)  # 新账户不继承同名旧账户快照中的权限
                 self.log(f"{user} has been registered.")
-                sock.send(bytes("successful\0", "utf-8"))  # 注册成功
+                self.send(sock, bytes("successful\0", "utf-8"), "REGISTER")  # 注册成功
                 self.closeConnection(sock, address)
 
     def processNewLogin(self, sock, address, user_info):
-        """处理新登录的客户端"""
+        """
+        处理新登录的客户端，在登录线程中执行：只查询账户信息，其余的检查和登录都交给事件循环
+        :param sock: 客户端连接
+        :param address: 客户端地址
+        :param user_info: 用户名和密码，用\r\n分隔
+        :return: 无返回值
+        """
+        login_start = time.perf_counter()
         try:
             user, passwd = user_info.split("\r\n")  # 分割用户名和密码
         except ValueError:
             user = user_info.strip()
             passwd = ""
+        query_result = None
         if passwd:
-            if user in self.user_connections:
-                self.log(f"{user} tried to login again.")
-                sock.send(pack(f"另一处已登录你的账户，请不要重复登录。", "Server", "", "KICK_NOTICE"))
-                self.closeConnection(sock, address)
-                return
             try:
-                self.sql_cursor.execute(
+                query_result = self.sqlExecute(
                     "SELECT * FROM USERS WHERE USER_NAME = ? AND PASSWORD = ?",
                     (user, passwd),
-                )
+                ).fetchone()
             except sqlite3.OperationalError:
-                self.log(f"{user} tried to login with a wrong password.")
-                sock.send(pack(f"用户名或密码错误。", "Server", "", "KICK_NOTICE"))
-                self.closeConnection(sock, address)
-                return
-            else:
-                # 暂时保存查询信息
-                query_result: list = self.sql_cursor.fetchone()
+                query_result = None
+        # 在线列表、会话和发送队列都只在事件循环中修改
+        self.callInLoop(self.finishLogin, sock, address, user, passwd, query_result, login_start)
 
+    def refuseLogin(self, sock, address, reason: str):
+        """
+        拒绝登录：发送踢出通知并关闭连接
+        :param sock: 客户端连接
+        :param address: 客户端地址
+        :param reason: 发给客户端的原因
+        :return: 无返回值
+        """
+        self.send(sock, pack(reason, "Server", "", "KICK_NOTICE"), "KICK_NOTICE")
+        self.closeConnection(sock, address)
+
+    def finishLogin(self, sock, address, user: str, passwd: str, query_result, login_start: float):
+        """
+        在事件循环中完成登录：检查重名、封禁和锁定，通过后加入在线列表，发放恢复令牌，回放历史消息并投递离线消息
+        :param sock: 客户端连接
+        :param address: 客户端地址
+        :param user: 用户名
+        :param passwd: 密码，为空时以游客身份登录
+        :param query_result: 登录线程查到的账户信息，密码错误时为None
+        :param login_start: 开始处理登录的时间
+        :return: 无返回值
+        """
+        try:
+            record: User = self.select.get_key(sock).data  # 连接建立时创建的连接记录
+        except (KeyError, ValueError):  # 查询期间连接已经断开
+            return
+        if passwd:
+            if user in self.user_connections:
+                self.log(f"{user} tried to login again.")
+                self.refuseLogin(sock, address, "另一处已登录你的账户，请不要重复登录。")
+                return
             if not query_result:
                 self.log(f"{user} tried to login with a wrong password.")
-                sock.send(pack(f"用户名或密码错误。", "Server", "", "KICK_NOTICE"))
-                self.closeConnection(sock, address)
+                self.refuseLogin(sock, address, "用户名或密码错误。")
                 return
-            else:
-                logged_user = True
+            logged_user = True
         elif self.force_account:
             self.log(f"{user} tried to login without password.")
-            sock.send(pack("该服务器启用了强制用户系统，请使用账号密码登录。", "Server", "", "KICK_NOTICE"))
-            self.closeConnection(sock, address)
+            self.refuseLogin(sock, address, "该服务器启用了强制用户系统，请使用账号密码登录。")
             return
         elif user in self.sql_exist_user:
             self.log(f"{user} is already in the database.")
-            sock.send(pack(f"该用户名已存在于数据库。", "Server", "", "KICK_NOTICE"))
-            self.closeConnection(sock, address)
+            self.refuseLogin(sock, address, "该用户名已存在于数据库。")
             return
-        elif user in self.user_connections:  # 如果重名，直接阻止登录！
+        elif user in self.user_connections or user in self.detached_users:  # 如果重名，直接阻止登录！
             self.log(f"{user} is already in the online list.")
-            sock.send(pack(f"该用户名已存在于在线列表。", "Server", "", "KICK_NOTICE"))
-            self.closeConnection(sock, address)
+            self.refuseLogin(sock, address, "该用户名已存在于在线列表。")
             return
         elif user == "Server":
             self.log(f"{user} tried to login as Server.")
-            sock.send(pack(f"该用户名为保留名。", "Server", "", "KICK_NOTICE"))
-            self.closeConnection(sock, address)
+            self.refuseLogin(sock, address, "该用户名为保留名。")
             return
         else:
             logged_user = False
@@ -1143,56 +1803,1134 @@ class Server:
 
         if query_result[3]:
             self.log(f"{user} is banned.")
-            sock.send(pack(f"你已被管理员封禁。", "Server", "", "KICK_NOTICE"))
-            self.closeConnection(sock, address)
+            self.refuseLogin(sock, address, "你已被管理员封禁。")
             return
         elif query_result[2] != "Admin" and self.lock_server:
             self.log(
                 f"{user} tried to login the locked server without an Admin permission."
             )
-            sock.send(pack(f"此服务器已锁定，请使用管理员权限的用户登入。", "Server", "", "KICK_NOTICE"))
-            self.closeConnection(sock, address)
+            self.refuseLogin(sock, address, "此服务器已锁定，请使用管理员权限的用户登入。")
             return
 
         new_port = str(address[1])
-        sock.send(pack(self.default_room, "", "", "DEFAULT_ROOM"))  # 发送默认群聊
+        self.send(sock, pack(self.default_room, "", "", "DEFAULT_ROOM"), "DEFAULT_ROOM")  # 发送默认群聊
         if user == "用户名不存在" or not user:  # 如果客户端未设定用户名
             user = address[0] + ":" + new_port  # 直接使用IP和端口号
         while user in self.chatting_rooms:  # 如果用户名已经存在
             user += new_port  # 用户名和端口号
         user = user[:20].strip()  # 如果用户名过长，则截断并去除首尾空格
 
-        # 将用户名加入连接列表
-
-        # User类的实例化参数: conn, address, permission, passwd, id_num, name
         if logged_user and query_result:
-            # 用数据库的信息初始化User类
-            self.user_connections[user] = User(
-                sock, address, query_result[2], self.client_id, user
-            )
+            # 用数据库的信息填入用户信息
+            record.login(query_result[2], self.client_id, user)
         else:
-            self.user_connections[user] = User(
-                sock, address, "User", self.client_id, user
-            )  # 将用户名和连接加入连接列表
-
-        online_users = self.getOnlineUsers()  # 获取在线用户
-        time.sleep(0.2)  # 等待一下，否则可能会出现粘包
-        for sending_sock in self.user_connections.values():  # 开始发送用户列表
-            sending_sock.getSocket().send(
-                pack(json.dumps(online_users), "", self.default_room, "USER_MANIFEST")
-            )
+            record.login("User", self.client_id, user)
+        restored = self.restored_users.pop(user, None)
+        if restored is not None:  # 重启前在线，恢复manager命令任免的权限和所在聊天室
+            permission, rooms = restored[:2]
+            if logged_user and {permission, record.getPermission()} <= {"User", "Manager"}:  # 游客不恢复权限
+                record.setPermission(permission)
+            for room in rooms:
+                if room in self.chatting_rooms and not record.inRoom(room):
+                    record.addRoom(room)
+            self.send(sock, pack(json.dumps(record.getRooms()), "Server", "", "ROOM_MANIFEST"), "ROOM_MANIFEST")
+        self.discardSession(user)  # 重新登录后，断线前保留的会话不再需要
+        self.user_connections[user] = record  # 将用户名和连接记录加入在线列表
+        self.online_index.add(user)
+        self.presence.join(user, record.getRooms(), record)  # 用户列表由事件循环在本轮结束时广播
+        self.issueSessionToken(sock, user)
         self.log(f"{user} logged in.")
-        return
+        history = self.room_history.replay(self.default_room)
+        if history:  # 回放默认聊天室的最近消息
+            self.send(sock, history, "HISTORY", chat=True)
+        if logged_user and self.mailbox.count(user):  # 先上线再投递，投递期间的新消息直接在线发送，不会丢失
+            delivered = 0
+            for frames, frame_count in self.mailbox.fetch(user, settings.mailbox_page):
+                self.send(sock, frames, chat=True)  # 每页只放入一次发送队列
+                delivered += frame_count
+            self.log(f"{delivered} offline messages delivered to {user}.")
+        self.metrics.login_seconds.observe(time.perf_counter() - login_start)
+
+    def scheduleIdleCheck(self, sock: socket.socket, last_active: float):
+        """
+        为连接安排下一次空闲检查，时间为下一次该发心跳或该断开的时刻中较早的一个
+        :param sock: 客户端连接
+        :param last_active: 连接最后一次收到数据的时间
+        :return: 无返回值
+        """
+        now = time.monotonic()
+        deadlines = []
+        if self.heartbeat_interval > 0:  # 空闲期间每隔一个心跳间隔发送一次
+            beats = int((now - last_active) / self.heartbeat_interval) + 1
+            deadlines.append(last_active + beats * self.heartbeat_interval)
+        if self.idle_timeout > 0:
+            deadlines.append(last_active + self.idle_timeout)
+        if deadlines:
+            self.timer_wheel.schedule(sock, min(deadlines) - now)
+        else:  # 心跳和空闲断开都已关闭，隔一段时间再检查设置是否被修改
+            self.timer_wheel.schedule(sock, 60)
+
+    def reapIdleConnections(self):
+        """
+        处理时间轮中到期的连接：空闲太久的断开，需要心跳的发送心跳，其余的重新安排检查
+        断开的连接不单独广播用户列表，本轮结束时按聊天室统一广播
+        :return: 无返回值
+        """
+        expired = self.timer_wheel.advance()
+        if not expired:
+            return
+        now = time.monotonic()
+        for sock in expired:
+            if isinstance(sock, Session):  # 断线后保留的会话到期，此时才算真正下线
+                if self.sessions.get(sock.token) is sock:
+                    self.log(f"Session of {sock.name} expired.")
+                    self.discardSession(sock.name)
+                continue
+            try:
+                data = self.select.get_key(sock).data
+            except (KeyError, ValueError):  # 连接已经关闭
+                continue
+            address = data.getAddress()
+            if data.getUserName() is None and data.login_deadline:  # 未登录的连接
+                if now >= data.login_deadline:
+                    self.log(f"Connection {address[0]}:{address[1]} did not login in time, closing.")
+                    self.closeConnection(sock, address)
+                else:
+                    self.timer_wheel.schedule(sock, data.login_deadline - now)
+                continue
+            idle = now - data.last_active
+            if 0 < self.idle_timeout <= idle:
+                self.log(f"Connection {address[0]}:{address[1]} idle for {int(idle)}s, closing.")
+                self.closeConnection(sock, address, resumable=True)
+                continue
+            if 0 < self.heartbeat_interval <= idle:
+                try:
+                    self.send(sock, pack("", "Server", "", "HEARTBEAT"), "HEARTBEAT")
+                except OSError:  # 发送失败说明对端已经不在了
+                    self.closeConnection(sock, address, resumable=True)
+                    continue
+            self.scheduleIdleCheck(sock, data.last_active)
+
+    def checkProfiler(self):
+        """
+        检查CPU采样是否到期，到期后保存报告并通知发起者
+        :return: 无返回值
+        """
+        report = self.profiler.tick()
+        if report:
+            self.log(f"CPU profile saved to {report}.")
+            if self.profiler.requester in self.user_connections:
+                self.send(
+                    self.user_connections[self.profiler.requester].getSocket(),
+                    pack(f"CPU profile saved to {report}.", "Server", "", "TEXT_MESSAGE"),
+                )
+
+    def send(self, sock: socket.socket, message: bytes, message_type: str = "TEXT_MESSAGE", chat: bool = False):
+        """
+        向客户端发送消息，所有发往客户端的消息都应经过这里
+        消息先放入该连接的发送队列，本轮事件循环结束时由flushWrites合并为一次写入
+        :param sock: 客户端连接
+        :param message: 已打包的消息，必须以结束符结尾
+        :param message_type: 消息类型，用于统计
+        :param chat: 是否为转发的聊天消息（含回放），聊天消息排在踢出通知、用户列表、命令回复等控制消息后面
+        :return: 无返回值
+        """
+        self.metrics.countOut(message_type)
+        pending = self.pending_chat if chat else self.pending_writes
+        with self.send_lock:
+            frames = pending.get(sock)
+            if frames is None:
+                pending[sock] = [message]
+            else:
+                frames.append(message)
+        self.wakeLoop()
+
+    def wakeLoop(self):
+        """
+        其他线程有消息要发送或有用户列表要广播时，唤醒事件循环
+        :return: 无返回值
+        """
+        if threading.get_ident() != self.loop_thread:
+            try:
+                self.wakeup_writer.send(b"\0")
+            except OSError:  # 唤醒数据已经写满，事件循环肯定会醒来
+                pass
+
+    def callInLoop(self, func, *args):
+        """
+        在事件循环线程中执行一个操作，从其他线程调用时排队并唤醒事件循环
+        :param func: 要执行的函数
+        :param args: 函数的参数
+        :return: 无返回值
+        """
+        if threading.get_ident() == self.loop_thread:
+            func(*args)
+        else:
+            self.loop_calls.append((func, args))
+            self.wakeLoop()
+
+    def drainWakeup(self):
+        """
+        读掉唤醒用的数据
+        :return: 无返回值
+        """
+        try:
+            while self.wakeup_reader.recv(4096):
+                pass
+        except OSError:
+            pass
+
+    def flushWrites(self):
+        """
+        把本轮所有待发送的消息写出，每个连接只调用一次send()，控制消息在前、聊天消息在后
+        写不完的数据按优先级留在积压队列里，等可写事件时再写，积压过多的连接视为慢速连接并断开
+        :return: 无返回值
+        """
+        with self.send_lock:
+            if not self.pending_writes and not self.pending_chat:
+                return
+            pending, self.pending_writes = self.pending_writes, {}
+            pending_chat, self.pending_chat = self.pending_chat, {}
+        fanout_round, self.fanout_round = self.fanout_round, False
+        if self.fanout_pool is not None and fanout_round:
+            self.writeParallel(pending, pending_chat)
+        else:
+            for sock, chat in pending_chat.items():  # 群聊分发时绝大多数连接只有聊天消息
+                self.writeFrames(sock, pending.pop(sock, None), chat)
+            for sock, control in pending.items():
+                self.writeFrames(sock, control, None)
+        # 没有积压的连接，本轮的消息都在同一时刻写出，每轮只记录一次排队时间
+        waited = time.perf_counter() - self.round_started
+        if pending_chat:
+            self.metrics.chat_wait_seconds.observe(waited)
+        if pending:
+            self.metrics.control_wait_seconds.observe(waited)
+        for sock in [sock for sock, queue in self.blocked_writes.items() if queue.size > settings.max_outbound_bytes]:
+            self.log("A connection is reading too slowly, closing.")
+            self.closeBrokenConnection(sock)
+
+    def writeFrames(self, sock: socket.socket, control, chat):
+        """
+        把一个连接本轮的消息合并为一次写入，写不完时建立积压队列
+        :param sock: 客户端连接
+        :param control: 控制消息列表，没有时为None
+        :param chat: 聊天消息列表，没有时为None
+        :return: 无返回值
+        """
+        queue = self.blocked_writes.get(sock)
+        if queue is not None:  # 还有没写完的数据，按优先级排队
+            if control:
+                queue.push(control, self.round_started, False)
+            if chat:
+                queue.push(chat, self.round_started, True)
+            return
+        frames = control + chat if control and chat else control or chat
+        data = frames[0] if len(frames) == 1 else b"".join(frames)
+        try:
+            sent = sock.send(data)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError:  # 连接已断开或已关闭
+            self.closeBrokenConnection(sock)
+            return
+        self.metrics.send_calls += 1
+        self.metrics.frames_sent += len(frames)
+        self.metrics.bytes_out += sent
+        if sent < len(data):
+            self.queueRemainder(sock, control, frames, sent)
+
+    def writeParallel(self, pending: dict, pending_chat: dict):
+        """
+        把本轮的消息交给写出线程池，分发完立即返回，结果由finishFanout在事件循环中处理。
+        有积压或上一轮还没写完的连接仍在事件循环线程中排队；交出去的连接在写完之前也放一个空的积压队列，
+        这期间产生的新消息排在后面，写完后再接着写
+        :param pending: 连接 -> 控制消息列表
+        :param pending_chat: 连接 -> 聊天消息列表
+        :return: 无返回值
+        """
+        for sock, queue in self.blocked_writes.items():
+            control = pending.pop(sock, None)
+            chat = pending_chat.pop(sock, None)
+            if control:
+                queue.push(control, self.round_started, False)
+            if chat:
+                queue.push(chat, self.round_started, True)
+        for sock in itertools.chain(pending_chat, pending):
+            if sock not in self.fanout_inflight:
+                self.fanout_inflight[sock] = None
+                self.blocked_writes[sock] = OutboundQueue()  # 不关注可写事件，只用来暂存新消息
+        self.fanout_pool.dispatch(pending, pending_chat, self.fanoutDone)
+
+    def fanoutDone(self, batch: list, unfinished: list, frame_count: int, byte_count: int):
+        """
+        写出线程写完一份后的回调，在写出线程中调用，把结果交给事件循环
+        :param batch: 这一份的(连接, 控制消息列表, 聊天消息列表)
+        :param unfinished: 没写完或写失败的连接
+        :param frame_count: 写出的消息数
+        :param byte_count: 写出的字节数
+        :return: 无返回值
+        """
+        self.callInLoop(self.finishFanout, batch, unfinished, frame_count, byte_count)
+
+    def finishFanout(self, batch: list, unfinished: list, frame_count: int, byte_count: int):
+        """
+        处理写出线程写完的一份：没写完的剩余数据排在写的期间产生的新消息前面，写失败的连接关闭，
+        写的期间已被关闭的连接，补发关闭前剩下的数据后再真正关闭
+        :param batch: 这一份的(连接, 控制消息列表, 聊天消息列表)
+        :param unfinished: 没写完或写失败的连接，(连接, 控制消息列表, 本次写入的所有消息, 写出的字节数)
+        :param frame_count: 写出的消息数
+        :param byte_count: 写出的字节数
+        :return: 无返回值
+        """
+        self.metrics.send_calls += len(batch)
+        self.metrics.frames_sent += frame_count
+        self.metrics.bytes_out += byte_count
+        unfinished = {item[0]: item for item in unfinished}
+        for sock, _, _ in batch:
+            closing = self.fanout_inflight.pop(sock, None)
+            item = unfinished.get(sock)
+            if closing is not None:  # 写的期间连接已被关闭，文件描述符留到现在才释放，不会被新连接复用
+                remainder = b"".join(item[2])[item[3]:] if item is not None and item[3] >= 0 else b""
+                if remainder or closing:
+                    try:
+                        sock.send(remainder + closing)
+                    except OSError:
+                        pass
+                sock.close()
+                continue
+            if item is None:
+                if self.blocked_writes[sock].size:  # 写的期间有新消息，暂存的队列转为积压队列，等可写时接着写
+                    self.select.modify(
+                        sock, selectors.EVENT_READ | selectors.EVENT_WRITE, data=self.select.get_key(sock).data
+                    )
+                else:
+                    del self.blocked_writes[sock]
+            elif item[3] < 0:
+                self.closeBrokenConnection(sock)
+            else:
+                self.queueRemainder(sock, item[1], item[2], item[3], self.blocked_writes.pop(sock))
+
+    def waitFanout(self):
+        """
+        等待写出线程写完所有交出去的连接，在事件循环线程中调用，例如平滑升级交接连接之前
+        :return: 无返回值
+        """
+        while self.fanout_inflight:
+            if self.loop_calls:
+                func, args = self.loop_calls.popleft()
+                func(*args)
+            else:
+                time.sleep(0.001)
+
+    def queueRemainder(self, sock: socket.socket, control, frames: list, sent: int, later: OutboundQueue = None):
+        """
+        一次写入没写完时，为连接建立积压队列，并开始关注可写事件
+        正在写的那条消息必须写完，剩下的消息按优先级排队，之后的控制消息可以插到聊天消息前面
+        :param sock: 客户端连接
+        :param control: 本次写入的控制消息列表，没有时为None，写入时排在frames的最前面
+        :param frames: 本次写入的所有消息
+        :param sent: 已经写出的字节数
+        :param later: 写出线程写的期间暂存的新消息，排在本次剩下的消息后面
+        :return: 无返回值
+        """
+        queue = OutboundQueue()
+        offset = 0
+        for index, frame in enumerate(frames):
+            if offset + len(frame) > sent:
+                break
+            offset += len(frame)
+        queue.head += frames[index][sent - offset:]
+        queue.size = len(queue.head)
+        control_count = len(control) if control else 0
+        queue.push(frames[index + 1:control_count], self.round_started, False)
+        queue.push(frames[max(index + 1, control_count):], self.round_started, True)
+        if later is not None:
+            queue.control.extend(later.control)
+            queue.chat.extend(later.chat)
+            queue.size += later.size
+        self.blocked_writes[sock] = queue
+        self.select.modify(
+            sock, selectors.EVENT_READ | selectors.EVENT_WRITE, data=self.select.get_key(sock).data
+        )
+
+    def resumeWrite(self, sock: socket.socket, data: User) -> bool:
+        """
+        连接可写时继续写积压的数据，每写完一批再按优先级取下一批，全部写完后不再关注可写事件
+        :param sock: 客户端连接
+        :param data: 连接记录
+        :return: 连接仍然有效时返回True
+        """
+        queue = self.blocked_writes.get(sock)
+        if queue is None:
+            return True
+        while True:
+            if not queue.head:
+                taken = queue.fill(settings.write_batch, settings.control_burst)
+                if not taken:  # 全部写完
+                    del self.blocked_writes[sock]
+                    self.select.modify(sock, selectors.EVENT_READ, data=data)
+                    return True
+                now = time.perf_counter()
+                for since, chat in taken:
+                    (self.metrics.chat_wait_seconds if chat else self.metrics.control_wait_seconds).observe(now - since)
+            try:
+                sent = sock.send(queue.head)
+            except (BlockingIOError, InterruptedError):
+                return True
+            except OSError:
+                self.closeConnection(sock, data.getAddress(), resumable=True)
+                return False
+            self.metrics.send_calls += 1
+            self.metrics.bytes_out += sent
+            queue.written(sent)
+            if queue.head:  # 发送缓冲区又满了
+                return True
+
+    def closeBrokenConnection(self, sock: socket.socket):
+        """
+        关闭一个写入失败的连接
+        :param sock: 客户端连接
+        :return: 无返回值
+        """
+        try:
+            address = self.select.get_key(sock).data.getAddress()
+        except (KeyError, ValueError):  # 已经关闭
+            self.blocked_writes.pop(sock, None)
+            return
+        self.closeConnection(sock, address, resumable=True)
+
+    def startBulkJob(self, sock: socket.socket, operator: str, operation: str, args: list):
+        """
+        开始批量用户操作，在单独的线程中准备数据并在一个事务中写入数据库，不阻塞事件循环
+        用法：user bulkcreate 权限 用户名:密码 ...，user bulkban 用户名 ...，user bulksetper 权限 用户名 ...
+        用户列表也可以写成@文件名，引用已经上传到files目录的文件，每行一条，创建用户时每行为"用户名 密码"
+        :param sock: 发起操作的管理员的连接
+        :param operator: 发起操作的管理员
+        :param operation: bulkcreate、bulkban或bulksetper
+        :param args: 命令中操作名之后的部分
+        :return: 无返回值
+        """
+        if self.bulk_running:
+            self.send(sock, pack("另一个批量操作正在执行，请稍后再试。", "Server", "", "TEXT_MESSAGE"))
+            return
+        if self.upgrade_phase is not None:  # 升级期间用户表要保持不变
+            self.send(sock, pack("服务器正在升级，请稍后再试。", "Server", "", "TEXT_MESSAGE"))
+            return
+        self.bulk_running = True
+        self.log(f"{operator} started {operation}.")
+        threading.Thread(target=self.runBulkJob, args=(sock, operator, operation, args), daemon=True).start()
+
+    @staticmethod
+    def readBulkEntries(args: list) -> list:
+        """
+        读取批量操作的条目
+        :param args: 命令中列出的条目，或者只有一个以@开头的文件名
+        :return: 条目列表
+        """
+        if len(args) == 1 and args[0].startswith("@"):
+            path = os.path.join("files", os.path.basename(args[0][1:]))  # 只允许读取files目录中的文件
+            with open(path, encoding="utf-8") as f:
+                return [line.strip() for line in f if line.strip() and not line.startswith("#")]
+        return [arg for arg in args if arg]
+
+    def runBulkJob(self, sock: socket.socket, operator: str, operation: str, args: list):
+        """
+        执行批量用户操作：先逐条检查并准备好要写入的行，再用独立的数据库连接执行一个事务，
+        不占用共享连接和它的锁；提交后把内存中的用户名、在线用户和汇总回复交给事件循环处理
+        :param sock: 发起操作的管理员的连接
+        :param operator: 发起操作的管理员
+        :param operation: bulkcreate、bulkban或bulksetper
+        :param args: 命令中操作名之后的部分
+        :return: 无返回值
+        """
+        job_start = time.perf_counter()
+        try:
+            permission = args[0] if operation != "bulkban" else None
+            entries = self.readBulkEntries(args[1:] if permission else args)
+            if permission is not None and permission not in ("User", "Manager", "Admin"):
+                raise ValueError(f"invalid permission {permission}")
+        except (IndexError, ValueError) as error:
+            self.send(sock, pack(f"Usage: user {operation}{' <permission>' if operation != 'bulkban' else ''} "
+                                 f"<names or @file>, {error}", "Server", "", "TEXT_MESSAGE"))
+            self.bulk_running = False
+            return
+        except OSError as error:
+            self.send(sock, pack(f"Cannot read {args[-1][1:]}: {error.strerror}", "Server", "", "TEXT_MESSAGE"))
+            self.bulk_running = False
+            return
+        try:
+            if operation == "bulkban" and operator != "root":  # 只有root可以封禁管理员
+                admins = {name for name, in self.sqlExecute("SELECT USER_NAME FROM USERS WHERE PERMISSION = 'Admin'")}
+            else:
+                admins = set()
+            rows, names, skipped, seen = [], [], [], set()
+            for index, entry in enumerate(entries, 1):
+                if operation == "bulkcreate":
+                    name, _, password = entry.partition(" ") if " " in entry else entry.partition(":")
+                    name, password = name.strip(), password.strip()
+                    valid = (
+                            name and password and len(name) <= 20 and name != "Server"
+                            and name not in self.sql_exist_user and name not in self.user_connections
+                    )
+                    row = (name, hashlib.md5(password.encode()).hexdigest(), permission, 0)
+                elif operation == "bulkban":
+                    name = entry
+                    valid = name in self.sql_exist_user and name not in (operator, "root") and name not in admins
+                    row = (1, name)
+                else:
+                    name = entry
+                    valid = name in self.sql_exist_user and name != "root"
+                    row = (permission, name)
+                if valid and name not in seen:
+                    rows.append(row)
+                    names.append(name)
+                    seen.add(name)
+                else:
+                    skipped.append(name or entry)
+                if index % settings.bulk_progress == 0:
+                    self.send(sock, pack(f"{operation}: {index}/{len(entries)} checked.", "Server", "", "TEXT_MESSAGE"))
+            self.send(sock, pack(f"{operation}: writing {len(rows)} users in one transaction.", "Server", "", "TEXT_MESSAGE"))
+            sql = {
+                "bulkcreate": "INSERT OR IGNORE INTO USERS (USER_NAME, PASSWORD, PERMISSION, BAN) VALUES (?, ?, ?, ?)",
+                "bulkban": "UPDATE USERS SET BAN = ? WHERE USER_NAME = ?",
+                "bulksetper": "UPDATE USERS SET PERMISSION = ? WHERE USER_NAME = ?",
+            }[operation]
+            query_start = time.perf_counter()
+            self.writeBulkRows(sql, rows)
+            self.metrics.sql_seconds.observe(time.perf_counter() - query_start)
+            summary = f"{operation} finished in {time.perf_counter() - job_start:.2f}s: " \
+                      f"{len(names)} succeeded, {len(skipped)} skipped."
+            self.log(summary)
+            if skipped:
+                summary += f"\nSkipped: {', '.join(skipped[:20])}{' ...' if len(skipped) > 20 else ''}"
+        except sqlite3.Error as error:
+            summary = f"{operation} failed, nothing was changed: {error}"
+            self.log(summary)
+            names = []
+        # 内存中的用户名、踢出、修改权限会改动事件循环中遍历的状态，交给事件循环执行
+        self.callInLoop(self.applyBulkJob, sock, operation, permission, names, summary)
+
+    def writeBulkRows(self, sql: str, rows: list):
+        """
+        在一个事务中写入批量操作的所有行，失败时回滚，在批量操作线程中调用。
+        使用独立的连接：共享连接上事件循环执行过、还没提交的语句不会被这里的回滚撤销，
+        事件循环的查询也不必等整个事务结束
+        :param sql: SQL语句
+        :param rows: 每行的参数
+        :return: 无返回值
+        """
+        if self.database == ":memory:":  # 内存数据库不能被第二个连接打开（例如基准测试），只能在锁内使用共享的连接
+            with self.sql_lock:
+                try:
+                    self.sql_connection.executemany(sql, rows)
+                    self.sql_connection.commit()
+                except sqlite3.Error:
+                    self.sql_connection.rollback()
+                    raise
+            return
+        connection = sqlite3.connect(self.database)
+        try:
+            with connection:  # 正常结束时提交，出错时回滚
+                connection.executemany(sql, rows)
+        finally:
+            connection.close()
+
+    def applyBulkJob(self, sock: socket.socket, operation: str, permission, names: list, summary: str):
+        """
+        批量操作写入数据库后，在事件循环线程中处理涉及的用户：封禁的踢出并丢弃保留的会话，修改权限的立即生效，
+        快照中的旧状态一律不再恢复，最后发送汇总回复
+        :param sock: 发起操作的管理员的连接
+        :param operation: bulkcreate、bulkban或bulksetper
+        :param permission: bulkcreate和bulksetper的权限
+        :param names: 写入成功的用户名
+        :param summary: 汇总回复
+        :return: 无返回值
+        """
+        if operation == "bulkcreate":
+            self.sql_exist_user.update(names)
+        self.bulk_running = False  # 内存中的用户名已与数据库一致，快照可以继续保存
+        for name in names:
+            self.restored_users.pop(name, None)  # 快照中的旧权限和聊天室不再恢复
+            if operation == "bulkban":
+                self.discardSession(name)  # 断线后保留的会话也不能再恢复
+            elif operation == "bulksetper" and name in self.detached_users:
+                self.detached_users[name].permission = permission
+            record = self.user_connections.get(name)
+            if record is None:
+                continue
+            if operation == "bulkban":
+                self.send(record.getSocket(), pack("你已被管理员踢出服务器并封禁。", "Server", "", "KICK_NOTICE"), "KICK_NOTICE")
+                self.closeConnection(record.getSocket(), record.getAddress())
+            elif operation == "bulksetper":
+                record.setPermission(permission)
+                self.send(record.getSocket(), pack(f"你的权限已被更改为 {permission}。", "Server", "", "TEXT_MESSAGE"))
+        self.send(sock, pack(summary, "Server", "", "TEXT_MESSAGE"))
+
+    def sqlExecute(self, sql: str, parameters=()) -> sqlite3.Cursor:
+        """
+        执行SQL语句，并统计耗时
+        登录线程和事件循环会同时查询，每次查询使用独立的游标，避免互相覆盖结果
+        :param sql: SQL语句
+        :param parameters: SQL参数
+        :return: 本次查询的游标
+        """
+        query_start = time.perf_counter()
+        try:
+            with self.sql_lock:
+                return self.sql_connection.execute(sql, parameters)
+        finally:
+            self.metrics.sql_seconds.observe(time.perf_counter() - query_start)
+
+    def startUpgrade(self, sock: socket.socket) -> str | None:
+        """
+        开始平滑升级：启动新的服务器进程，通过Unix socket用SCM_RIGHTS把监听socket和所有客户端连接交给它，
+        连同每个连接的用户信息、所在聊天室和没写完的数据，以及断线后保留的会话，客户端不需要重新连接。
+        整个过程由事件循环逐步推进，等待期间照常服务其他客户端：
+        先拒绝新的登录并等正在进行的登录和并行写出完成，再启动新进程，新进程准备好接收后发送状态，
+        发送后暂停服务这些连接，等新进程确认接管后本进程退出；失败或超时时恢复服务。
+        :param sock: 发起升级的管理员的连接，失败时通知
+        :return: 不能开始升级时返回原因
+        """
+        if self.upgrade_phase is not None:
+            return "An upgrade is already in progress."
+        if self.bulk_running:
+            return "A bulk user operation is running, upgrade after it finishes."
+        self.upgrade_phase = "draining"
+        self.upgrade_deadline = time.monotonic() + settings.upgrade_timeout
+        self.upgrade_requester = sock
+        return None
+
+    def stepUpgrade(self):
+        """
+        每轮事件循环结束时推进平滑升级：检查是否超时，正在进行的登录和并行写出都完成后启动新进程
+        :return: 无返回值
+        """
+        if time.monotonic() > self.upgrade_deadline:
+            self.abortUpgrade("the new process did not take over in time")
+            return
+        if self.upgrade_phase != "draining" or self.fanout_inflight or any(
+                isinstance(key.data, User) and key.data.login_deadline == 0 and key.data.getUserName() is None
+                for key in self.select.get_map().values()  # 登录线程还在查询，结果会交给事件循环
+        ):
+            return
+        if settings.snapshot_interval > 0:  # 新进程启动时恢复当前的选项
+            self.saveSnapshot(background=False)
+        if self.metrics_server:  # 释放指标端口，由新进程重新监听
+            self.metrics_server.stop()
+        self.upgrade_phase = "starting"
+        channel, child_channel = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.upgrade_child = subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), "--takeover", str(child_channel.fileno())],
+                pass_fds=(child_channel.fileno(),),
+            )
+        except OSError as e:
+            channel.close()
+            self.abortUpgrade(str(e))
+            return
+        finally:
+            child_channel.close()
+        channel.setblocking(False)
+        self.upgrade_channel = channel
+        self.select.register(channel, selectors.EVENT_READ, data="upgrade")  # 新进程启动需要时间，不在这里等
+
+    def continueUpgrade(self):
+        """
+        新进程发来消息时推进平滑升级：准备好接收时发送所有状态并暂停服务这些连接，确认接管后退出
+        :return: 无返回值
+        """
+        try:
+            reply = self.upgrade_channel.recv(16)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self.abortUpgrade(str(e))
+            return
+        if self.upgrade_phase == "starting" and reply == b"start":
+            self.flushPresence()
+            self.flushWrites()
+            self.waitFanout()  # 写出线程写完后，剩下的数据都在积压队列里，可以一并交接
+            try:
+                self.upgrade_channel.settimeout(settings.upgrade_timeout)  # 新进程正在接收，很快就能发完
+                self.sendState(self.upgrade_channel)
+                self.upgrade_channel.setblocking(False)
+            except OSError as e:
+                self.abortUpgrade(str(e))
+                return
+            # 状态已经交出去，本进程不再读写这些连接，也不再接收新连接，等待确认期间的消息由新进程处理
+            self.upgrade_parked = []
+            for key in list(self.select.get_map().values()):
+                if isinstance(key.data, User) or key.fileobj is self.main_sock:
+                    self.upgrade_parked.append((key.fileobj, key.events, key.data))
+                    self.select.unregister(key.fileobj)
+            self.upgrade_phase = "confirming"
+        elif self.upgrade_phase == "confirming" and reply == b"ready":
+            self.log(f"Server handed over to process {self.upgrade_child.pid}, exiting.")
+            self.sql_connection.close()
+            os._exit(0)  # 不关闭任何socket，连接已经由新进程持有
+        else:
+            self.abortUpgrade("the new process exited before taking over")
+
+    def sendState(self, channel: socket.socket):
+        """
+        把监听socket、断线后保留的会话和所有客户端连接的状态发给新进程
+        :param channel: 与新进程通信的Unix socket
+        :return: 无返回值
+        """
+        now = time.monotonic()
+        sessions = [{  # 断线后保留的会话没有连接，随第一条消息交接，连同剩余的有效期
+            "token": session.token,
+            "name": session.name,
+            "permission": session.permission,
+            "id": session.id_num,
+            "rooms": session.rooms,
+            "missed": [message.decode("latin-1") for message in session.missed],
+            "registered": session.registered,
+            "remaining": session.deadline - now,
+        } for session in self.detached_users.values() if session.deadline > now]
+        self.sendHandoff(channel, {"client_id": self.client_id, "sessions": sessions}, [self.main_sock.fileno()])
+        batch, fds = [], []
+        for key in list(self.select.get_map().values()):
+            if not isinstance(key.data, User):  # 跳过监听socket和唤醒socket
+                continue
+            record: User = key.data
+            with self.send_lock:
+                pending = bytes(self.blocked_writes.get(key.fileobj, b"")) + b"".join(
+                    self.pending_writes.get(key.fileobj, []) + self.pending_chat.get(key.fileobj, [])
+                )
+            batch.append({
+                "address": record.getAddress(),
+                "name": record.getUserName(),
+                "permission": record.getPermission(),
+                "id": record.getId(),
+                "rooms": record.getRooms(),
+                "idle": time.monotonic() - record.last_active,
+                "token": self.session_tokens.get(record.getUserName()),
+                "pending": pending.decode("latin-1"),  # 二进制数据原样放进JSON
+                "partial": self.recv_buffer.partial.get(key.fileobj, b"").decode("latin-1"),  # 没读完的半条消息
+            })
+            fds.append(key.fileobj.fileno())
+            if len(fds) >= settings.handoff_batch:
+                self.sendHandoff(channel, batch, fds)
+                batch, fds = [], []
+        if batch:
+            self.sendHandoff(channel, batch, fds)
+        self.sendHandoff(channel, None, [])  # 交接结束
+
+    def abortUpgrade(self, reason: str):
+        """
+        平滑升级失败，结束新进程并恢复服务
+        :param reason: 失败原因
+        :return: 无返回值
+        """
+        if self.upgrade_child is not None:
+            self.upgrade_child.kill()
+            self.upgrade_child.wait()
+            self.upgrade_child = None
+        if self.upgrade_channel is not None:
+            self.select.unregister(self.upgrade_channel)
+            self.upgrade_channel.close()
+            self.upgrade_channel = None
+        if self.upgrade_phase != "draining" and self.metrics_server:  # 指标服务已经停止
+            self.metrics_server = MetricsServer(self, settings.metrics_address, settings.metrics_port)
+            self.metrics_server.start()
+        now = time.monotonic()
+        for sock, events, data in self.upgrade_parked:  # 暂停期间定时器找不到这些连接，重新安排
+            self.select.register(sock, events, data=data)
+            if not isinstance(data, User):
+                continue
+            if data.login_deadline:
+                self.timer_wheel.schedule(sock, max(data.login_deadline - now, 0))
+            else:
+                self.scheduleIdleCheck(sock, data.last_active)
+        self.upgrade_parked = []
+        self.upgrade_phase = None
+        self.log(f"Upgrade failed: {reason}")
+        try:
+            self.select.get_key(self.upgrade_requester)
+        except (KeyError, ValueError):  # 发起升级的管理员已经断开
+            return
+        self.send(self.upgrade_requester, pack(f"升级失败：{reason}", "Server", "", "TEXT_MESSAGE"))
+
+    @staticmethod
+    def sendHandoff(channel: socket.socket, payload, fds: list):
+        """
+        发送一条交接消息：先发送带文件描述符的4字节长度，再发送JSON正文
+        :param channel: 与新进程通信的Unix socket
+        :param payload: 可以转换为JSON的数据
+        :param fds: 随消息传递的文件描述符
+        :return: 无返回值
+        """
+        body = json.dumps(payload).encode("utf-8")
+        socket.send_fds(channel, [struct.pack("!I", len(body))], fds)
+        channel.sendall(body)
+
+    @staticmethod
+    def receiveHandoff(channel: socket.socket) -> tuple:
+        """
+        接收一条交接消息
+        :param channel: 与旧进程通信的Unix socket
+        :return: 数据和文件描述符列表
+        """
+        header, fds, _, _ = socket.recv_fds(channel, 4, settings.handoff_batch)
+        if len(header) != 4:
+            raise ConnectionError("handoff channel closed")
+        length = struct.unpack("!I", header)[0]
+        body = bytearray()
+        while len(body) < length:
+            chunk = channel.recv(length - len(body))
+            if not chunk:
+                raise ConnectionError("handoff channel closed")
+            body += chunk
+        return json.loads(body), fds
+
+    def takeOver(self, handoff: socket.socket):
+        """
+        从旧进程接管监听socket和所有客户端连接
+        :param handoff: 与旧进程通信的Unix socket
+        :return: 无返回值
+        """
+        handoff.sendall(b"start")  # 旧进程收到后才开始发送状态，等待新进程启动期间不阻塞它的事件循环
+        header, fds = self.receiveHandoff(handoff)
+        self.main_sock.close()
+        self.main_sock = socket.socket(fileno=fds[0])
+        self.ip, self.port = self.main_sock.getsockname()[:2]  # 以实际监听的地址为准
+        self.client_id = header["client_id"]
+        for state in header.get("sessions", []):
+            self.adoptSession(state)
+        adopted = 0
+        while True:
+            batch, fds = self.receiveHandoff(handoff)
+            if batch is None:
+                break
+            for state, fd in zip(batch, fds):
+                self.adoptConnection(socket.socket(fileno=fd), state)
+                adopted += 1
+        handoff.sendall(b"ready")
+        handoff.close()
+        self.log(f"Took over the listening socket, {adopted} connections and {len(self.detached_users)} sessions.")
+
+    def adoptConnection(self, conn: socket.socket, state: dict):
+        """
+        恢复一个从旧进程接管的连接，并注册到IO多路复用
+        :param conn: 接管的连接
+        :param state: 旧进程中的连接状态
+        :return: 无返回值
+        """
+        address = tuple(state["address"])
+        name = state["name"]
+        self.connection_count += 1
+        self.ip_connections[address[0]] = self.ip_connections.get(address[0], 0) + 1
+        conn.setblocking(False)
+        now = time.monotonic()
+        record = User(
+            conn, address, state["permission"], state["id"], name,
+            last_active=now - state["idle"],
+            login_deadline=now + self.login_timeout if name is None and self.login_timeout > 0 else None,
+        )
+        for room in state["rooms"]:
+            if room in self.chatting_rooms and not record.inRoom(room):
+                record.addRoom(room)
+        events = selectors.EVENT_READ
+        pending = state["pending"].encode("latin-1")
+        if pending:  # 旧进程没写完的数据，等可写时继续写
+            self.blocked_writes[conn] = OutboundQueue(pending)
+            events |= selectors.EVENT_WRITE
+        partial = state.get("partial", "").encode("latin-1")
+        if partial:  # 旧进程没读完的半条消息，接着读
+            self.recv_buffer.partial[conn] = partial
+        self.select.register(conn, events, data=record)
+        if name is not None:
+            self.user_connections[name] = record
+            self.restored_users.pop(name, None)  # 升级前保存的快照里也有它，状态以交接的为准
+            self.online_index.add(name)
+            self.presence.join(name, record.getRooms(), record, announce=False)
+            if state.get("token"):
+                self.session_tokens[name] = state["token"]
+        if record.login_deadline is not None:
+            self.timer_wheel.schedule(conn, self.login_timeout)
+        else:
+            self.scheduleIdleCheck(conn, record.last_active)
+
+    def adoptSession(self, state: dict):
+        """
+        恢复一个从旧进程接管的断线会话，按剩余的有效期重新计时
+        :param state: 旧进程中的会话状态
+        :return: 无返回值
+        """
+        name = state["name"]
+        remaining = state["remaining"]
+        if remaining <= 0 or name in self.detached_users:
+            return
+        rooms = [room for room in state["rooms"] if room in self.chatting_rooms]
+        session = Session(
+            state["token"], name, state["permission"], state["id"], rooms, settings.session_missed,
+            registered=state["registered"], deadline=time.monotonic() + remaining,
+        )
+        session.missed.extend(message.encode("latin-1") for message in state["missed"])
+        self.sessions[session.token] = session
+        self.detached_users[name] = session
+        self.restored_users.pop(name, None)  # 升级前保存的快照里也有它，状态以交接的为准
+        self.online_index.add(name)
+        self.presence.join(name, rooms, None, announce=False)  # 仍然算作成员，但不向其发送
+        self.timer_wheel.schedule(session, remaining)
+
+    def issueSessionToken(self, sock: socket.socket, name: str):
+        """
+        为登录成功的用户发放恢复令牌，断线后客户端可以用它恢复会话，只能在事件循环线程中调用
+        :param sock: 客户端连接
+        :param name: 用户名
+        :return: 无返回值
+        """
+        if settings.session_ttl <= 0:
+            return
+        token = secrets.token_urlsafe(16)
+        self.session_tokens[name] = token
+        self.send(sock, pack(token, "Server", "", "SESSION_TOKEN"), "SESSION_TOKEN")
+
+    def resumeSession(self, sock: socket.socket, record: User, token: str):
+        """
+        用恢复令牌恢复断线前的会话：恢复用户名、权限和所在聊天室，补发错过的消息，
+        只向该用户发送用户列表，不向其他人广播
+        :param sock: 客户端连接
+        :param record: 连接记录
+        :param token: 恢复令牌
+        :return: 无返回值
+        """
+        session = self.sessions.get(token)
+        if session is None or self.detached_users.get(session.name) is not session:
+            self.log("A client tried to resume an expired session.")
+            self.send(sock, pack("会话已失效，请重新登录。", "Server", "", "TEXT_MESSAGE"))
+            return
+        reason = None
+        if session.registered:  # 断线期间账户可能被删除或封禁，和登录一样重新检查
+            row = self.sqlExecute(get_user_info, (session.name,)).fetchone()
+            if row is None:
+                reason = "你的账户已被删除。"
+            elif row[3]:
+                reason = "你已被管理员封禁。"
+            if reason is not None:
+                self.discardSession(session.name)
+                self.timer_wheel.cancel(session)
+        if reason is None and self.lock_server and session.permission != "Admin":
+            reason = "此服务器已锁定，请使用管理员权限的用户登入。"
+        if reason is not None:
+            self.log(f"{session.name} tried to resume the session, refused: {reason}")
+            self.send(sock, pack(reason, "Server", "", "KICK_NOTICE"), "KICK_NOTICE")
+            self.closeConnection(sock, record.getAddress())
+            return
+        self.discardSession(session.name, offline=False)
+        self.timer_wheel.cancel(session)
+        record.login(session.permission, session.id_num, session.name)
+        record.login_deadline = None
+        for room in session.rooms:
+            if room in self.chatting_rooms and not record.inRoom(room):
+                record.addRoom(room)
+        self.user_connections[session.name] = record
+        self.presence.join(session.name, record.getRooms(), record)  # 重新关联连接记录，成员没有变化，不广播
+        self.scheduleIdleCheck(sock, record.last_active)
+        self.send(sock, pack(self.default_room, "", "", "DEFAULT_ROOM"), "DEFAULT_ROOM")
+        self.issueSessionToken(sock, session.name)  # 令牌只能使用一次，恢复后换一个新的
+        self.sendRoomManifests(sock, record.getRooms())
+        self.send(sock, pack(json.dumps(record.getRooms()), "Server", "", "ROOM_MANIFEST"), "ROOM_MANIFEST")
+        if session.missed:  # 断线期间错过的消息，合并为一次写入
+            self.send(sock, b"".join(session.missed), "HISTORY", chat=True)
+        self.log(f"{session.name} resumed the session, {len(session.missed)} missed messages delivered.")
+
+    def discardSession(self, name: str, offline: bool = True):
+        """
+        丢弃用户断线后保留的会话，只能在事件循环线程中调用
+        :param name: 用户名
+        :param offline: 用户是否因此下线，恢复会话时为False
+        :return: 无返回值
+        """
+        session = self.detached_users.pop(name, None)
+        if session is not None:
+            self.sessions.pop(session.token, None)
+            if offline:
+                self.online_index.discard(name)
+                self.presence.leave(name, session.rooms)
+
+    def getRoom(self, name: str):
+        """
+        获取聊天室信息，第一次获取时从数据库读取
+        :param name: 聊天室名称
+        :return: 聊天室信息，聊天室不存在时返回None
+        """
+        if name not in self.chatting_rooms:
+            return None
+        room = self.chatting_rooms[name]
+        if room is None:
+            row = self.sqlExecute(get_room_info, (name,)).fetchone()
+            if row is None:  # 数据库被外部修改过
+                return None
+            room = self.chatting_rooms[name] = Room(*row)
+        return room
+
+    def createRoom(self, name: str, owner: str):
+        """
+        创建聊天室并写入数据库
+        :param name: 聊天室名称
+        :param owner: 创建者的用户名
+        :return: 无返回值
+        """
+        room = Room(name, owner, time.time())
+        self.sqlExecute(append_room, (name, owner, room.getCreatedTime(), room.dumpSettings()))
+        self.sql_connection.commit()
+        self.chatting_rooms[name] = room
+
+    def deleteRoom(self, name: str) -> list:
+        """
+        删除聊天室，同时删除数据库中的记录和内存中的最近消息，在线成员全部退出后释放聊天室编号
+        :param name: 聊天室名称
+        :return: 被移出该聊天室的在线用户
+        """
+        del self.chatting_rooms[name]
+        self.sqlExecute(delete_room, (name,))
+        self.sql_connection.commit()
+        self.room_history.drop(name)
+        self.presence.drop(name)
+        members = [user for user in self.user_connections.values() if user.inRoom(name)]
+        for user in members:
+            user.removeRoom(name)
+        releaseRoomId(name)  # 断线保留的会话只记录聊天室名称，恢复时聊天室已不存在，不会重新加入
+        return members
 
     def getOnlineUsers(self) -> list:
         """
-        获取在线用户
-        :return: 在线用户列表
+        获取在线用户，暂时断线的用户仍然显示为在线
+        :return: 按用户名排序的在线用户列表
+        """
+        return self.online_index.names()
+
+    def getNumericOptions(self) -> dict:
+        """
+        获取可以在运行时修改的数值选项
+        :return: 选项名到(对象, 属性名)的映射
+        """
+        return {
+            "chatRate": (self.chat_limiter, "rate"),
+            "chatBurst": (self.chat_limiter, "burst"),
+            "commandRate": (self.command_limiter, "rate"),
+            "commandBurst": (self.command_limiter, "burst"),
+            "loginRate": (self.login_limiter, "rate"),
+            "loginBurst": (self.login_limiter, "burst"),
+            "ipChatRate": (self.ip_chat_limiter, "rate"),
+            "ipChatBurst": (self.ip_chat_limiter, "burst"),
+            "ipCommandRate": (self.ip_command_limiter, "rate"),
+            "ipCommandBurst": (self.ip_command_limiter, "burst"),
+            "heartbeatInterval": (self, "heartbeat_interval"),
+            "idleTimeout": (self, "idle_timeout"),
+            "loginTimeout": (self, "login_timeout"),
+            "latencySample": (self.tracer, "sample_every"),
+        }
+
+    @staticmethod
+    def getZeroableOptions() -> set:
         """
-        online_users = []
-        for user in self.user_connections.values():
-            online_users.append(user.getUserName())
-        return online_users
+        获取设为0时表示关闭的数值选项，其余数值选项必须为正数
+        :return: 选项名集合
+        """
+        return {"heartbeatInterval", "idleTimeout", "loginTimeout", "latencySample"}
+
+    def getBooleanOptions(self) -> dict:
+        """
+        获取可以在运行时修改的开关选项
+        :return: 选项名到(对象, 属性名)的映射
+        """
+        return {
+            "logable": (self, "logable"),
+            "recordable": (self, "recordable"),
+            "forceAccount": (self, "force_account"),
+            "allowRegister": (self, "allow_register"),
+            "lockServer": (self, "lock_server"),
+            "rateLimit": (self, "rate_limit"),
+        }
+
+    def getOptionValues(self) -> dict:
+        """
+        获取所有运行时选项的当前值
+        :return: 选项名到值的映射
+        """
+        options = {**self.getNumericOptions(), **self.getBooleanOptions()}
+        return {name: getattr(owner, field) for name, (owner, field) in options.items()}
+
+    def getUserGeneration(self) -> int:
+        """
+        获取用户表版本号，由数据库触发器在每次增删用户时加一
+        :return: 版本号
+        """
+        return self.sqlExecute(get_meta, ("users_generation",)).fetchone()[0]
+
+    def getSnapshotState(self) -> dict:
+        """
+        收集快照中除用户名以外的状态，在事件循环线程中调用，返回的是一份副本，写快照的线程可以直接使用
+        :return: 可以转换为JSON的状态
+        """
+        now = time.time()
+        users = dict(self.restored_users)  # 重启后还没有重新登录的用户，继续保留，最后在线的时间不变
+        for record in self.user_connections.values():
+            users[record.getUserName()] = [record.getPermission(), record.getRooms(), now]
+        for session in self.detached_users.values():
+            users[session.name] = [session.permission, list(session.rooms), now]
+        values = self.getOptionValues()
+        return {
+            "saved": now,
+            "options": {name: [value, self.option_defaults[name]] for name, value in values.items()},
+            "users": users,
+        }
+
+    def saveSnapshot(self, background: bool = True):
+        """
+        保存运行状态快照
+        :param background: 是否在单独的线程中写，为False时在当前线程中写完再返回
+        :return: 无返回值
+        """
+        if self.bulk_running:  # 批量操作可能已经提交而内存中的用户名还没更新，等它完成后再保存
+            return
+        generation = self.getUserGeneration()  # 其余对用户表的修改都在事件循环线程中，与内存中的用户名一致
+
+        def copy():  # 在事件循环中复制，写快照期间用户名和连接可以照常变化
+            return self.snapshot.path, self.database_id, generation, list(self.sql_exist_user), self.getSnapshotState()
+
+        if not background:
+            Snapshot.write(*copy())
+        else:
+            self.snapshot.start(copy, Snapshot.write)
+
+    def checkSnapshot(self):
+        """
+        检查后台快照是否写完，到时间时开始新的快照
+        :return: 无返回值
+        """
+        if self.snapshot.worker is None:
+            self.saveSnapshot()
+            return
+        saved = self.snapshot.poll()
+        if saved:
+            self.log(f"Snapshot saved to {self.snapshot.path}, copying took {self.snapshot.copy_seconds * 1000:.1f}ms.")
+        elif saved is not None:
+            self.log(f"Failed to save the snapshot: {self.snapshot.error}")
+
+    def restoreSnapshot(self, state: dict):
+        """
+        启动时恢复快照中的选项，在线用户的权限和聊天室等到重新登录时恢复
+        :param state: 快照中除用户名以外的状态
+        :return: 无返回值
+        """
+        options = {**self.getNumericOptions(), **self.getBooleanOptions()}
+        restored = 0
+        for name, (value, default) in state.get("options", {}).items():
+            if name in options and self.option_defaults.get(name) == default:  # settings.py中改过的选项以新值为准
+                setattr(*options[name], value)
+                restored += 1
+        saved = state.get("saved", 0)
+        deadline = time.time() - settings.snapshot_user_ttl
+        users = state.get("users", {})
+        # 每项是[权限, 所在聊天室, 最后在线的时间]，太久没有重新登录的不再恢复
+        self.restored_users = {name: entry for name, entry in users.items() if (entry[2:] or [saved])[0] >= deadline}
+        self.log(f"Snapshot restored: {restored} options, {len(self.restored_users)} users to restore on login, "
+                 f"{len(users) - len(self.restored_users)} expired.")
 
     def getManagers(self) -> list:
         """
@@ -1200,29 +2938,90 @@ class Server:
         :return: 在线管理员列表
         """
         managers = []
-        for user in self.user_connections.values():
+        for user in list(self.user_connections.values()):
             if user.getPermission() == "Manager":
                 managers.append(user.getUserName())
         return managers
 
-    def closeConnection(self, sock: socket.socket, address: tuple):
+    def flushPresence(self):
+        """
+        为本轮成员有变化的聊天室广播成员列表，每个聊天室只打包一次，只发给该聊天室的在线成员
+        成员数超过settings.presence_max_members的聊天室不推送，客户端用update page查询
+        :return: 无返回值
+        """
+        for room, names, records in self.presence.takeDirty():
+            if 0 < settings.presence_max_members < len(names):
+                continue
+            manifest = pack(json.dumps(names), "", room, "USER_MANIFEST")
+            for record in records:
+                self.send(record.getSocket(), manifest, "USER_MANIFEST")
+
+    def sendRoomManifests(self, sock: socket.socket, rooms: list):
+        """
+        向一个用户发送其所在各聊天室的成员列表
+        :param sock: 客户端连接
+        :param rooms: 聊天室名称列表
+        :return: 无返回值
+        """
+        for room in rooms:
+            if 0 < settings.presence_max_members < self.presence.count(room):
+                continue
+            self.send(sock, pack(json.dumps(self.presence.members(room)), "", room, "USER_MANIFEST"), "USER_MANIFEST")
+
+    def closeConnection(self, sock: socket.socket, address: tuple, resumable=False) -> bool:
         """
         关闭连接
         :param sock: 已知的无效连接
         :param address: 连接的地址
-        :return: 无返回值
+        :param resumable: 是否为意外断线，意外断线的用户保留会话，等待客户端恢复
+        :return: 是否有已登录的用户因此下线
         """
         self.log(f"Connection closed: {address[0]}:{address[1]}")  # 日志
-        self.select.unregister(sock)  # 从IO多路复用中移除连接
-        for cid in list(self.user_connections):
-            if self.user_connections[cid].getSocket() == sock:
-                del self.user_connections[cid]  # 删除连接
-        online_users = self.getOnlineUsers()
-        for sending_sock in self.user_connections.values():
-            sending_sock.getSocket().send(
-                pack(json.dumps(online_users), "", self.default_room, "USER_MANIFEST")
+        record: User = self.select.unregister(sock).data  # 从IO多路复用中移除连接
+        self.timer_wheel.cancel(sock)
+        self.recv_buffer.partial.pop(sock, None)
+        if self.capture:
+            self.capture.close(sock)
+        with self.send_lock:  # 尽量把剩下的消息（例如踢出通知）发出去
+            leftover = bytes(self.blocked_writes.pop(sock, b"")) + b"".join(
+                self.pending_writes.pop(sock, []) + self.pending_chat.pop(sock, [])
             )
-        sock.close()
+        inflight = sock in self.fanout_inflight
+        if inflight:  # 写出线程还在写，剩下的消息和关闭都等它写完后由finishFanout处理
+            self.fanout_inflight[sock] = leftover
+        elif leftover:
+            try:
+                sock.send(leftover)
+            except OSError:
+                pass
+        self.connection_count -= 1
+        if self.ip_connections.get(address[0], 0) > 1:
+            self.ip_connections[address[0]] -= 1
+        else:
+            self.ip_connections.pop(address[0], None)
+        removed = False
+        name = record.getUserName()
+        if name is not None and self.user_connections.get(name) is record:  # 连接记录里有用户名，不必遍历在线列表
+            del self.user_connections[name]  # 删除连接
+            self.chat_limiter.forget(name)
+            self.command_limiter.forget(name)
+            token = self.session_tokens.pop(name, None)
+            if resumable and token is not None and settings.session_ttl > 0:  # 保留会话，暂不算下线
+                session = Session(
+                    token, name, record.getPermission(), record.getId(), record.getRooms(), settings.session_missed,
+                    registered=name in self.sql_exist_user, deadline=time.monotonic() + settings.session_ttl,
+                )
+                self.sessions[token] = session
+                self.detached_users[name] = session
+                self.timer_wheel.schedule(session, settings.session_ttl)
+                self.presence.detach(name, session.rooms)
+            else:
+                removed = True
+                self.online_index.discard(name)
+                self.presence.leave(name, record.getRooms())  # 本轮结束时向所在聊天室广播
+        if not inflight:
+            sock.close()
+        return removed
 
     def log(self, content: str, end="\n", show_time=True):
         """
@@ -1264,4 +3063,7 @@ class Server:
 
 if __name__ == "__main__":
     server = Server()  # 创建一个服务器对象
-    server.run()  # 启动服务器
+    if len(sys.argv) == 3 and sys.argv[1] == "--takeover":  # 由旧进程启动，用于平滑升级
+        server.run(socket.socket(fileno=int(sys.argv[2])))
+    else:
+        server.run()  # 启动服务器
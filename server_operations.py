@@ -2,14 +2,14 @@ import json
 import time
 
 
-def pack(raw_message, send_from, chat_with, message_type):
+def pack(raw_message, send_from, chat_with, message_type, message_id=None):
     """
     打包消息，用于发送
     :param raw_message: 正文消息
     :param send_from: 发送者
     :param chat_with: 聊天对象
     :param message_type: 消息类型
-    :param file_name: 文件名，如果不是文件类型，则为None
+    :param message_id: 消息编号，客户端重发同一条消息时使用同一个编号，服务器据此去重，为None时不带编号
     """
     message = {
         'by': send_from,
@@ -18,6 +18,8 @@ def pack(raw_message, send_from, chat_with, message_type):
         'time': time.time(),
         'message': raw_message,
     }  # 先把收集到的信息存储到字典里
+    if message_id is not None:
+        message['id'] = message_id
     return (json.dumps(message) + '\0').encode('utf-8')  # 再用json打包
 
 
@@ -52,9 +54,10 @@ def unpack(json_message: bytes):
         return None,
     if message['type'] == 'TEXT_MESSAGE' or \
             message['type'] == 'COLOR_MESSAGE':  # 如果是纯文本消息
-        return message['type'], message['to'], message['by'], message['time'], message['message']
+        return message['type'], message['to'], message['by'], message['time'], message['message'], message.get('id')
     elif message['type'] == 'USER_NAME' or \
-            message['type'] == 'REGISTER':  # 如果是用户名称
+            message['type'] == 'REGISTER' or \
+            message['type'] == 'RESUME':  # 如果是用户名称或恢复令牌
         try:
             username = message['message']
             return message['type'], username
@@ -62,5 +65,9 @@ def unpack(json_message: bytes):
             return 'MANIFEST_NOT_JSON',
     elif message['type'] == 'COMMAND':
         return message['type'], message['by'], message['message']
+    elif message['type'] == 'MESSAGE_ACK':  # 带编号的消息已被服务器接收的确认，正文是消息编号
+        return message['type'], message['message']
+    elif message['type'] == 'HEARTBEAT':  # 心跳回复，只用于保持连接活跃
+        return message['type'],
     else:
         return 'UNKNOWN_MESSAGE_TYPE',
@@ -0,0 +1,142 @@
+"""
+测试共用的夹具：进程内的服务器和假客户端，不监听端口，默认使用内存数据库
+"""
+import hashlib
+import itertools
+import json
+import os
+import selectors
+import sys
+import threading
+
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from defines import settings  # noqa: E402
+from server_operations import pack  # noqa: E402
+
+PASSWORD = hashlib.md5(b'test').hexdigest()
+
+
+class FakeSocket:
+    """
+    假的客户端socket，保存服务器写给它的数据
+    """
+    _fds = itertools.count(100000)  # 文件描述符只用于IO多路复用的字典键，不对应真实的文件
+
+    def __init__(self):
+        self._fd = next(self._fds)
+        self.sent = bytearray()
+        self.closed = False
+
+    def fileno(self) -> int:
+        return -1 if self.closed else self._fd
+
+    def send(self, data) -> int:
+        if self.closed:
+            raise OSError('socket is closed')
+        self.sent += data
+        return len(data)
+
+    def setblocking(self, flag):
+        pass
+
+    def setsockopt(self, *args):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class Client:
+    """
+    连接到进程内服务器的假客户端，消息直接交给processMessage处理
+    """
+    _ports = itertools.count(20000)
+
+    def __init__(self, server):
+        self.server = server
+        self.sock = FakeSocket()
+        self.address = ('127.0.0.1', next(self._ports))
+        server.acceptConnection(self.sock, self.address)
+
+    @property
+    def record(self):
+        return self.server.select.get_key(self.sock).data
+
+    def login(self, name: str, password: str = PASSWORD):
+        """
+        同步完成登录，不启动登录线程
+        """
+        self.record.login_deadline = 0
+        self.server.processNewLogin(self.sock, self.address, f'{name}\r\n{password}')
+
+    def send(self, message, to: str, message_type: str = 'TEXT_MESSAGE', message_id=None):
+        """
+        和serveClient一样去掉结束符后交给processMessage
+        """
+        by = self.record.getUserName() or ''
+        self.server.processMessage(pack(message, by, to, message_type, message_id).strip(b'\0'), self.sock, self.address)
+
+    def frames(self) -> list:
+        """
+        像事件循环的一轮结束时那样写出，返回这期间收到的所有消息
+        """
+        self.server.flushPresence()
+        self.server.flushWrites()
+        data, self.sock.sent = bytes(self.sock.sent), bytearray()
+        return [json.loads(frame) for frame in data.split(b'\0') if frame]
+
+
+@pytest.fixture
+def make_server(tmp_path, monkeypatch):
+    """
+    创建进程内服务器的函数，当前目录是临时目录，测试结束后恢复所有设置
+    """
+    monkeypatch.chdir(tmp_path)
+    for name, value in {
+        'log': False, 'record': False, 'rate_limit': False, 'metrics': False, 'capture': False,
+        'snapshot_interval': 0, 'fanout_workers': 0, 'force_account': False,
+    }.items():
+        monkeypatch.setattr(settings, name, value)
+    from lhat_server import Server
+    servers = []
+
+    def make(database: str = ':memory:'):
+        monkeypatch.setattr(Server, 'database', database)
+        server = Server()
+        server.main_sock.close()
+        server.select = selectors.SelectSelector()  # 只维护字典，不会对假文件描述符做系统调用
+        server.loop_thread = threading.get_ident()  # 测试线程就是事件循环线程
+        servers.append(server)
+        return server
+
+    yield make
+    for server in servers:
+        server.sql_connection.close()
+        server.wakeup_reader.close()
+        server.wakeup_writer.close()
+
+
+@pytest.fixture
+def server(make_server):
+    return make_server()
+
+
+@pytest.fixture
+def connect(server):
+    """
+    建立一个未登录的假连接的函数
+    """
+    return lambda: Client(server)
+
+
+def createAccount(server, name: str, permission: str = 'User'):
+    """
+    直接在数据库中创建账户，密码为PASSWORD
+    """
+    server.sqlExecute(settings.append_user, (name, PASSWORD, permission, 0))
+    server.sql_connection.commit()
+    server.sql_exist_user.add(name)
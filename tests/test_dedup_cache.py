@@ -0,0 +1,90 @@
+import pytest
+
+from defines import DedupCache as dedup_cache_module
+from defines import settings
+from defines.DedupCache import DedupCache
+
+
+class Clock:
+    """
+    手动推进的单调时间
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(dedup_cache_module, 'time', clock)
+    return clock
+
+
+def testSecondSightingIsDuplicate(clock):
+    cache = DedupCache(capacity=10, window=60)
+    assert not cache.seen('bob\0m1')
+    assert cache.seen('bob\0m1')
+    assert not cache.seen('alice\0m1')  # 按发送者区分
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def testEntriesExpireAfterWindow(clock):
+    cache = DedupCache(capacity=10, window=60)
+    cache.seen('bob\0m1')
+    clock.now += 61
+    assert not cache.seen('bob\0m1')
+
+
+def testHitRefreshesEntry(clock):
+    cache = DedupCache(capacity=10, window=60)
+    cache.seen('bob\0m1')
+    clock.now += 40
+    assert cache.seen('bob\0m1')
+    clock.now += 40  # 距离第一次见到已经超过窗口，但命中时刷新了时间
+    assert cache.seen('bob\0m1')
+
+
+def testCapacityEvictsLeastRecent(clock):
+    cache = DedupCache(capacity=2, window=60)
+    cache.seen('a')
+    cache.seen('b')
+    cache.seen('a')  # a移到末尾，b成为最旧的
+    cache.seen('c')
+    assert len(cache) == 2
+    assert cache.seen('a')
+    assert not cache.seen('b')
+
+
+def testDiscard(clock):
+    cache = DedupCache(capacity=10, window=60)
+    cache.seen('bob\0m1')
+    cache.discard('bob\0m1')
+    cache.discard('missing')
+    assert not cache.seen('bob\0m1')
+
+
+def testResentMessageIsAcknowledgedButNotRepeated(server, connect):
+    sender, listener = connect(), connect()
+    sender.login('guest_a', '')
+    listener.login('guest_b', '')
+    sender.frames()
+    listener.frames()
+    for _ in range(2):
+        sender.send('hello', settings.default_room, message_id='m1')
+    sent = [(frame['type'], frame['message']) for frame in sender.frames()]
+    assert sent.count(('MESSAGE_ACK', 'm1')) == 2  # 每次都确认
+    assert sent.count(('TEXT_MESSAGE', 'hello')) == 1
+    assert [frame['message'] for frame in listener.frames() if frame['type'] == 'TEXT_MESSAGE'] == ['hello']
+
+
+def testUndeliveredMessageCanBeResent(server, connect):
+    sender = connect()
+    sender.login('guest', '')
+    sender.frames()
+    sender.send('hello', 'nobody', message_id='m1')
+    assert 'MESSAGE_ACK' not in [frame['type'] for frame in sender.frames()]
+    assert not server.dedup.seen('guest\0m1')  # 没有送达的消息不记录，重发时重新处理
@@ -0,0 +1,93 @@
+import sqlite3
+
+import pytest
+
+from conftest import createAccount
+from defines import Mailbox as mailbox_module
+from defines import settings
+from defines.Mailbox import Mailbox
+
+
+@pytest.fixture
+def connection():
+    connection = sqlite3.connect(':memory:')
+    connection.execute(settings.create_mailbox_table)
+    connection.execute(settings.create_mailbox_index)
+    yield connection
+    connection.close()
+
+
+def makeMailbox(connection, quota: int = 10, expire: float = 0) -> Mailbox:
+    return Mailbox(connection.execute, connection.commit, quota, expire)
+
+
+def testStoreAndFetchInOrder(connection):
+    mailbox = makeMailbox(connection)
+    for index in range(5):
+        assert mailbox.store('bob', f'm{index}\0'.encode())
+    assert mailbox.count('bob') == 5
+    pages = list(mailbox.fetch('bob', page_size=2))
+    assert pages == [(b'm0\0m1\0', 2), (b'm2\0m3\0', 2), (b'm4\0', 1)]
+    assert mailbox.count('bob') == 0
+    assert list(mailbox.fetch('bob', page_size=2)) == []
+
+
+def testQuota(connection):
+    mailbox = makeMailbox(connection, quota=2)
+    assert mailbox.store('bob', b'a\0')
+    assert mailbox.store('bob', b'b\0')
+    assert not mailbox.store('bob', b'c\0')
+    assert mailbox.store('alice', b'c\0')  # 按收件人分别计数
+
+
+class Clock:
+    """
+    手动推进的时间
+    """
+
+    def __init__(self):
+        self.now = 1700000000.0
+
+    def time(self) -> float:
+        return self.now
+
+
+def testExpiredMessagesAreNotDelivered(connection, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(mailbox_module, 'time', clock)
+    mailbox = makeMailbox(connection, quota=2, expire=60)
+    mailbox.store('bob', b'old\0')
+    clock.now += 120
+    mailbox.store('bob', b'new\0')
+    assert mailbox.store('bob', b'newer\0')  # 信箱满时先清掉过期的消息
+    assert list(mailbox.fetch('bob', page_size=10)) == [(b'new\0newer\0', 2)]
+
+
+def testCountsSurviveRestart(connection):
+    makeMailbox(connection).store('bob', b'a\0')
+    assert makeMailbox(connection).count('bob') == 1
+
+
+def testClear(connection):
+    mailbox = makeMailbox(connection)
+    mailbox.store('bob', b'a\0')
+    mailbox.clear('bob')
+    assert mailbox.count('bob') == 0
+    assert list(mailbox.fetch('bob', page_size=10)) == []
+
+
+def testOfflineMessageDeliveredOnLogin(server, connect, monkeypatch):
+    monkeypatch.setattr(settings, 'mailbox', True)
+    createAccount(server, 'bob')
+    sender = connect()
+    sender.login('guest', '')
+    sender.frames()
+    sender.send('are you there?', 'bob')
+    replies = [frame['message'] for frame in sender.frames()]
+    assert 'are you there?' in replies and '对方不在线，消息已存入离线信箱。' in replies
+    assert server.mailbox.count('bob') == 1
+    bob = connect()
+    bob.login('bob')
+    delivered = [frame for frame in bob.frames() if frame['type'] == 'TEXT_MESSAGE' and frame['by'] == 'guest']
+    assert [frame['message'] for frame in delivered] == ['are you there?']
+    assert server.mailbox.count('bob') == 0
@@ -0,0 +1,100 @@
+from defines import RateLimiter as rate_limiter_module
+from defines.RateLimiter import RateLimiter
+
+
+class Clock:
+    """
+    手动推进的单调时间
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+def makeLimiter(monkeypatch, rate: float, burst: float):
+    clock = Clock()
+    monkeypatch.setattr(rate_limiter_module, 'time', clock)
+    return RateLimiter(rate, burst), clock
+
+
+def testBurstThenRefill(monkeypatch):
+    limiter, clock = makeLimiter(monkeypatch, rate=2.0, burst=3)
+    assert [limiter.allow('bob') for _ in range(4)] == [True, True, True, False]
+    clock.now += 0.5  # 补充一个令牌
+    assert limiter.allow('bob')
+    assert not limiter.allow('bob')
+    clock.now += 100  # 不超过桶容量
+    assert [limiter.allow('bob') for _ in range(4)] == [True, True, True, False]
+
+
+def testKeysAreIndependent(monkeypatch):
+    limiter, clock = makeLimiter(monkeypatch, rate=1.0, burst=1)
+    assert limiter.allow('alice')
+    assert not limiter.allow('alice')
+    assert limiter.allow('bob')
+
+
+def testAvailableDoesNotConsume(monkeypatch):
+    limiter, clock = makeLimiter(monkeypatch, rate=1.0, burst=1)
+    assert limiter.available('bob')
+    assert limiter.available('bob')
+    limiter.take('bob')
+    assert not limiter.available('bob')
+
+
+def testWarnOncePerOverrun(monkeypatch):
+    limiter, clock = makeLimiter(monkeypatch, rate=1.0, burst=1)
+    limiter.allow('bob')
+    assert not limiter.allow('bob')
+    assert limiter.shouldWarn('bob')
+    assert not limiter.shouldWarn('bob')
+    clock.now += 1
+    assert limiter.allow('bob')  # 通过后重新开始提醒
+    assert not limiter.allow('bob')
+    assert limiter.shouldWarn('bob')
+
+
+def testPruneKeepsBusyBuckets(monkeypatch):
+    limiter, clock = makeLimiter(monkeypatch, rate=1.0, burst=2)
+    limiter.allow('idle')
+    limiter.allow('busy')
+    limiter.allow('busy')
+    clock.now += 1  # idle已经补满，busy还差一个
+    limiter.prune(clock.now)
+    assert 'idle' not in limiter._buckets
+    assert 'busy' in limiter._buckets
+
+
+def testUserAndAddressBucketsAreSeparate(server, connect):
+    server.rate_limit = True
+    server.chat_limiter = RateLimiter(0.0, 2)
+    server.ip_chat_limiter = RateLimiter(0.0, 3)
+    first, second = connect(), connect()
+    first.login('guest_a', '')
+    second.login('guest_b', '')
+    assert first.record.getUserName() == 'guest_a' and second.record.getUserName() == 'guest_b'
+    frame = b'{"type": "TEXT_MESSAGE"}'
+    # 每个用户各有2个令牌，同一IP共3个；IP的令牌用完后，有令牌的用户也不能发送
+    assert server.checkRateLimit(first.sock, first.record, frame)
+    assert server.checkRateLimit(first.sock, first.record, frame)
+    assert not server.checkRateLimit(first.sock, first.record, frame)
+    assert server.checkRateLimit(second.sock, second.record, frame)
+    assert not server.checkRateLimit(second.sock, second.record, frame)
+    # 用户的令牌用完时不消耗IP的令牌
+    server.ip_chat_limiter = RateLimiter(0.0, 1)
+    assert not server.checkRateLimit(first.sock, first.record, frame)
+    assert server.checkRateLimit(second.sock, second.record, frame)
+
+
+def testHeartbeatIsExempt(server, connect):
+    server.rate_limit = True
+    server.chat_limiter = RateLimiter(0.0, 1)
+    client = connect()
+    client.login('guest', '')
+    heartbeat = b'{"by": "", "to": "", "type": "HEARTBEAT", "time": 0, "message": ""}'
+    for _ in range(5):
+        assert server.checkRateLimit(client.sock, client.record, heartbeat)
+    assert server.checkRateLimit(client.sock, client.record, b'{"type": "TEXT_MESSAGE"}')
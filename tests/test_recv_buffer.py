@@ -0,0 +1,88 @@
+import pytest
+
+from defines.RecvBuffer import RecvBuffer
+
+
+class ChunkSocket:
+    """
+    每次recv_into给出预先准备好的一段数据，为None时表示暂时没有数据可读
+    """
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    def recv_into(self, view) -> int:
+        chunk = self.chunks.pop(0)
+        if chunk is None:
+            raise BlockingIOError
+        view[:len(chunk)] = chunk
+        return len(chunk)
+
+
+class Record:
+    def __init__(self, read_size: int):
+        self.read_size = read_size
+
+
+@pytest.fixture
+def buffer():
+    return RecvBuffer(min_read=16, max_read=64, max_frame=32)
+
+
+def testSplitsSeveralFramesInOneRead(buffer):
+    sock = ChunkSocket([b'one\0two\0\0three\0'])
+    assert buffer.read(sock, Record(64)) == (15, [b'one', b'two', b'three'])  # 连续的结束符之间是空消息
+    assert sock not in buffer.partial
+
+
+def testJoinsFrameSplitAcrossReads(buffer):
+    sock = ChunkSocket([b'hel', b'lo\0wor', b'ld\0'])
+    record = Record(64)
+    assert buffer.read(sock, record) == (3, [])
+    assert buffer.partial[sock] == b'hel'
+    assert buffer.read(sock, record) == (6, [b'hello'])
+    assert buffer.read(sock, record) == (3, [b'world'])
+    assert sock not in buffer.partial
+
+
+def testStripsPaddingBytes(buffer):
+    sock = ChunkSocket([b'\xcc\xccabc\xcc\0\xcc\xcc\0'])
+    assert buffer.read(sock, Record(64))[1] == [b'abc']
+
+
+def testPartialsArePerConnection(buffer):
+    first, second = ChunkSocket([b'aa', b'a\0']), ChunkSocket([b'bb', b'b\0'])
+    record = Record(64)
+    buffer.read(first, record)
+    buffer.read(second, record)
+    assert buffer.read(first, record)[1] == [b'aaa']
+    assert buffer.read(second, record)[1] == [b'bbb']
+
+
+def testWouldBlockKeepsPartial(buffer):
+    sock = ChunkSocket([b'half', None, b'\0'])
+    record = Record(64)
+    buffer.read(sock, record)
+    assert buffer.read(sock, record) == (None, [])
+    assert buffer.read(sock, record) == (1, [b'half'])
+
+
+def testClosedConnectionReadsZero(buffer):
+    assert buffer.read(ChunkSocket([b'']), Record(16)) == (0, [])
+
+
+def testOversizedFrame(buffer):
+    sock = ChunkSocket([b'x' * 33])
+    assert buffer.read(sock, Record(64)) == (33, None)
+
+
+def testReadSizeAdapts(buffer):
+    record = Record(16)
+    buffer.read(ChunkSocket([b'x' * 15 + b'\0']), record)  # 读满，加倍
+    assert record.read_size == 32
+    buffer.read(ChunkSocket([b'x' * 31 + b'\0']), record)
+    assert record.read_size == 64
+    buffer.read(ChunkSocket([b'x' * 31 + b'\0' + b'y' * 31 + b'\0']), record)  # 不超过上限
+    assert record.read_size == 64
+    buffer.read(ChunkSocket([b'x\0']), record)  # 只用到四分之一，减半
+    assert record.read_size == 32
@@ -0,0 +1,66 @@
+import pytest
+
+from conftest import createAccount
+from defines import settings
+
+
+@pytest.fixture
+def detached(server, connect, monkeypatch):
+    """
+    bob登录后意外断线，返回他的恢复令牌
+    """
+    monkeypatch.setattr(settings, 'session_ttl', 60.0)
+    createAccount(server, 'bob')
+    bob = connect()
+    bob.login('bob')
+    token = next(frame['message'] for frame in bob.frames() if frame['type'] == 'SESSION_TOKEN')
+    server.closeConnection(bob.sock, bob.address, resumable=True)
+    return token
+
+
+def testDetachedUserStaysOnline(server, detached):
+    assert 'bob' in server.detached_users
+    assert 'bob' not in server.user_connections
+    assert 'bob' in server.getOnlineUsers()
+
+
+def testResumeRestoresSessionAndMissedMessages(server, connect, detached):
+    sender = connect()
+    sender.login('guest', '')
+    sender.send('while you were away', settings.default_room)
+    bob = connect()
+    bob.send(detached, '', 'RESUME')
+    frames = bob.frames()
+    assert bob.record.getUserName() == 'bob'
+    assert server.user_connections['bob'] is bob.record
+    assert 'bob' not in server.detached_users
+    assert 'while you were away' in [frame['message'] for frame in frames if frame['type'] == 'TEXT_MESSAGE']
+    new_token = [frame['message'] for frame in frames if frame['type'] == 'SESSION_TOKEN']
+    assert new_token and new_token[0] != detached  # 令牌只能使用一次
+
+
+def testTokenCannotBeReused(server, connect, detached):
+    connect().send(detached, '', 'RESUME')
+    again = connect()
+    again.send(detached, '', 'RESUME')
+    assert again.record.getUserName() is None
+    assert '会话已失效，请重新登录。' in [frame['message'] for frame in again.frames()]
+
+
+def testBannedUserCannotResume(server, connect, detached):
+    server.sqlExecute('UPDATE USERS SET BAN = 1 WHERE USER_NAME = ?', ('bob',))
+    bob = connect()
+    bob.send(detached, '', 'RESUME')
+    assert bob.sock.closed
+    assert 'bob' not in server.detached_users
+    assert 'bob' not in server.getOnlineUsers()
+
+
+def testLoginReplacesDetachedSession(server, connect, detached):
+    bob = connect()
+    bob.login('bob')
+    assert server.user_connections['bob'] is bob.record
+    assert 'bob' not in server.detached_users
+    late = connect()
+    late.send(detached, '', 'RESUME')
+    assert late.record.getUserName() is None
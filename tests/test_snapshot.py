@@ -0,0 +1,86 @@
+import pytest
+
+from conftest import Client, createAccount
+from defines import settings
+from defines.Snapshot import Snapshot
+
+ROOT_PASSWORD = '25d55ad283aa400af464c76d713c07ad'
+
+
+def testWriteAndLoad(tmp_path):
+    path = str(tmp_path / 'state.snapshot')
+    state = {'saved': 1.0, 'options': {'chatRate': [5.0, 10.0]}, 'users': {'bob': ['User', ['r1'], 1.0]}}
+    Snapshot.write(path, 42, 7, ['root', 'bob', '用户'], state)
+    db_id, generation, names, loaded = Snapshot.load(path)
+    assert (db_id, generation) == (42, 7)
+    assert names == {'root', 'bob', '用户'}
+    assert loaded == state
+
+
+def testEmptyNames(tmp_path):
+    path = str(tmp_path / 'state.snapshot')
+    Snapshot.write(path, 1, 0, [], {})
+    assert Snapshot.load(path) == (1, 0, set(), {})
+
+
+def testCorruptOrMissingFileIsIgnored(tmp_path):
+    path = tmp_path / 'state.snapshot'
+    assert Snapshot.load(str(path)) is None
+    Snapshot.write(str(path), 1, 0, ['root'], {})
+    data = bytearray(path.read_bytes())
+    data[-2] ^= 0xff  # 校验和对不上
+    path.write_bytes(bytes(data))
+    assert Snapshot.load(str(path)) is None
+    path.write_bytes(b'LHAT')  # 比文件头还短
+    assert Snapshot.load(str(path)) is None
+
+
+@pytest.fixture
+def database(tmp_path) -> str:
+    return str(tmp_path / 'server.db')
+
+
+def saveInBackground(server):
+    server.saveSnapshot()
+    server.snapshot.worker.join()
+    assert server.snapshot.poll() is True
+
+
+def testSaveAndRestore(make_server, database, monkeypatch):
+    server = make_server(database)
+    createAccount(server, 'bob')
+    server.createRoom('r1', 'root')
+    root = Client(server)
+    root.login('root', ROOT_PASSWORD)
+    root.send('option set chatRate 5', 'root', 'COMMAND')
+    bob = Client(server)
+    bob.login('bob')
+    bob.send('room join r1', 'bob', 'COMMAND')
+    saveInBackground(server)
+
+    monkeypatch.setattr(settings, 'snapshot_interval', 300.0)
+    restarted = make_server(database)
+    assert restarted.sql_exist_user == {'root', 'bob'}
+    assert restarted.chat_limiter.rate == 5
+    assert restarted.restored_users['bob'][1] == [settings.default_room, 'r1']
+    bob = Client(restarted)
+    bob.login('bob')
+    assert bob.record.getRooms() == [settings.default_room, 'r1']
+    assert 'bob' not in restarted.restored_users
+
+
+def testBackgroundSaveWritesACopy(make_server, database):
+    server = make_server(database)
+    server.saveSnapshot()
+    server.sql_exist_user.add('late')  # 复制之后的修改不会写进这次的快照
+    server.snapshot.worker.join()
+    assert server.snapshot.poll() is True
+    assert Snapshot.load(server.snapshot.path)[2] == {'root'}
+
+
+def testSnapshotIgnoredAfterUsersChange(make_server, database, monkeypatch):
+    server = make_server(database)
+    saveInBackground(server)
+    createAccount(server, 'carol')  # 快照之后用户表有变化
+    monkeypatch.setattr(settings, 'snapshot_interval', 300.0)
+    assert make_server(database).sql_exist_user == {'root', 'carol'}
@@ -0,0 +1,83 @@
+import pytest
+
+from defines import TimerWheel as timer_wheel_module
+from defines.TimerWheel import TimerWheel
+
+
+class Clock:
+    """
+    手动推进的单调时间
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(timer_wheel_module, 'time', clock)
+    return clock
+
+
+def testExpiresAfterDelay(clock):
+    wheel = TimerWheel(tick=1.0, slot_count=8)
+    wheel.schedule('a', 3)
+    clock.now += 2
+    assert wheel.advance() == []
+    clock.now += 1
+    assert wheel.advance() == ['a']
+    assert 'a' not in wheel and len(wheel) == 0
+
+
+def testRescheduleReplacesTimer(clock):
+    wheel = TimerWheel(tick=1.0, slot_count=8)
+    wheel.schedule('a', 1)
+    wheel.schedule('a', 5)
+    assert len(wheel) == 1
+    clock.now += 2
+    assert wheel.advance() == []
+    clock.now += 3
+    assert wheel.advance() == ['a']
+
+
+def testCancel(clock):
+    wheel = TimerWheel(tick=1.0, slot_count=8)
+    wheel.schedule('a', 1)
+    wheel.cancel('a')
+    wheel.cancel('missing')  # 不存在时什么也不做
+    clock.now += 2
+    assert wheel.advance() == []
+
+
+def testTimerLongerThanOneTurn(clock):
+    wheel = TimerWheel(tick=1.0, slot_count=4)
+    wheel.schedule('late', 10)
+    wheel.schedule('early', 2)
+    expired = []
+    for _ in range(9):
+        clock.now += 1
+        expired += wheel.advance()
+    assert expired == ['early']  # 转过一圈时同一个槽里的late还没到期
+    clock.now += 1
+    assert wheel.advance() == ['late']
+
+
+def testFallingBehindMoreThanOneTurn(clock):
+    wheel = TimerWheel(tick=1.0, slot_count=4)
+    for index in range(6):
+        wheel.schedule(index, index + 1)
+    clock.now += 100  # 很久没有推进，每个槽只看一次，所有定时器都到期
+    assert sorted(wheel.advance()) == list(range(6))
+    assert len(wheel) == 0
+
+
+def testZeroDelayFiresOnNextTick(clock):
+    wheel = TimerWheel(tick=1.0, slot_count=8)
+    wheel.schedule('now', 0)
+    assert wheel.advance() == []
+    clock.now += 1
+    assert wheel.advance() == ['now']